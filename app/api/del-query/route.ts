@@ -1,8 +1,6 @@
 import { NextRequest, NextResponse } from "next/server";
 import fs from 'fs/promises';
 import path from 'path';
-import { exec } from 'child_process';
-import { promisify } from 'util';
 
 export async function GET(request: NextRequest) {
     const sessionId = request.cookies.get('sessionId');
@@ -14,18 +12,26 @@ export async function GET(request: NextRequest) {
       );
     }
     
-    const mapperDir = path.join(process.cwd(), 'public', 'temp_uploads', sessionId.value);
-    const mapperDestination = path.join(mapperDir, 'mapper.json');
-    const mapperPath = path.join(mapperDir, 'copy_mapper.json');
+    const sessionDir = path.join(process.cwd(), 'public', 'temp_uploads', sessionId.value);
+    const resultsPath = path.join(sessionDir, 'results.json');
+    const mapperDestination = path.join(sessionDir, 'mapper.json');
+    const mapperPath = path.join(sessionDir, 'copy_mapper.json');
 
     try {
-        await fs.copyFile(mapperPath, mapperDestination);
-        await fs.unlink(mapperPath);
-        console.log(`mapper.json copied to ${mapperDestination}`);
+        // the query results live in their own file, mapper.json is never overwritten
+        await fs.rm(resultsPath, { force: true });
+        console.log(`${resultsPath} removed`);
+
+        // sessions queried before results.json existed still have the mapper backup
+        if (await fs.access(mapperPath).then(() => true).catch(() => false)) {
+          await fs.copyFile(mapperPath, mapperDestination);
+          await fs.unlink(mapperPath);
+          console.log(`mapper.json copied to ${mapperDestination}`);
+        }
       } catch (error) {
-        console.error('Error copying mapper.json:', error);
+        console.error('Error removing query results:', error);
         return NextResponse.json(
-          { success: false, message: 'Error copying mapper.json' },
+          { success: false, message: 'Error removing query results' },
           { status: 500 }
         );
       }
@@ -35,4 +41,4 @@ export async function GET(request: NextRequest) {
     message: "Query API is working",
     });
 
-}
\ No newline at end of file
+}
@@ -2,6 +2,11 @@ import { NextRequest, NextResponse } from 'next/server';
 import fs from 'fs/promises';
 import path from 'path';
 
+type ResultsFile = {
+  total: number;
+  results: MapperEntry[];
+};
+
 type MapperEntry = {
   audio_file: string;
   pic_name: string;
@@ -23,10 +28,24 @@ export async function GET(request: NextRequest) {
   const imageDir = path.join(uploadsDir, 'images');
   const audioDir = path.join(uploadsDir, 'audio');
   const mapperFilePath = path.join(uploadsDir, 'mapper.json');
+  const resultsFilePath = path.join(uploadsDir, 'results.json');
+
+  // ?page=&per_page= returns a single page, the whole list otherwise,
+  // ?search= keeps the songs whose name contains it
+  const pageParam = request.nextUrl.searchParams.get('page');
+  const perPageParam = request.nextUrl.searchParams.get('per_page');
+  const search = request.nextUrl.searchParams.get('search')?.toLowerCase() ?? '';
 
   try {
-    const rawData = await fs.readFile(mapperFilePath, 'utf-8');
-    const mapper: MapperEntry[] = JSON.parse(rawData);
+    // results of the last query take the place of the mapper until del-query removes them
+    let mapper: MapperEntry[];
+    try {
+      const results: ResultsFile = JSON.parse(await fs.readFile(resultsFilePath, 'utf-8'));
+      mapper = results.results;
+    } catch (error) {
+      const rawData = await fs.readFile(mapperFilePath, 'utf-8');
+      mapper = JSON.parse(rawData);
+    }
 
     if (!Array.isArray(mapper)) {
       return NextResponse.json(
@@ -72,9 +91,27 @@ export async function GET(request: NextRequest) {
       );
     }
 
+    const matches = search
+      ? dataset.filter((entry) => entry.song.toLowerCase().includes(search))
+      : dataset;
+
+    if (pageParam !== null) {
+      const page = Math.max(1, Number(pageParam) || 1);
+      const perPage = Math.max(1, Number(perPageParam ?? '10') || 10);
+      const start = (page - 1) * perPage;
+
+      return NextResponse.json({
+        success: true,
+        dataset: matches.slice(start, start + perPage),
+        total: matches.length,
+        page,
+        per_page: perPage,
+      });
+    }
+
     return NextResponse.json({
       success: true,
-      dataset,
+      dataset: matches,
     });
   } catch (error) {
     console.error('Error fetching data:', error);
@@ -1,10 +1,34 @@
 import { NextRequest, NextResponse } from "next/server";
 import fs from 'fs/promises';
 import path from 'path';
-import { exec } from 'child_process';
+import { execFile } from 'child_process';
 import { promisify } from 'util';
 
-const execAsync = promisify(exec);
+const execFileAsync = promisify(execFile);
+
+// The session ID cookie is used in paths and python arguments, only UUID-like IDs are accepted
+const sessionIdPattern = /^[A-Za-z0-9_-]+$/;
+
+// Resident python query service (src/query_server.py), falls back to spawning
+// src/retrieval.py when it is not running
+const queryServerUrl = process.env.QUERY_SERVER_URL ?? 'http://127.0.0.1:8000';
+
+// Results kept per query (retrieval.TOP_K), the page reads them through get-data?page=
+const queryTopK = 50;
+
+async function queryServer(sessionId: string): Promise<boolean> {
+  try {
+    const response = await fetch(`${queryServerUrl}/query?session=${encodeURIComponent(sessionId)}&top_k=${queryTopK}`);
+    if (!response.ok) {
+      console.error('Query server error:', response.status, await response.text());
+      return false;
+    }
+    return true;
+  } catch (error) {
+    console.log('Query server unavailable, spawning retrieval.py');
+    return false;
+  }
+}
 
 async function ensureDirectoryExists(dir: string) {
   try {
@@ -51,11 +75,17 @@ export async function GET(request: NextRequest) {
     );
   }
 
+  if (!sessionIdPattern.test(sessionId.value)) {
+    return NextResponse.json(
+      { success: false, message: 'Invalid session ID' },
+      { status: 400 }
+    );
+  }
+
   const queryDir = path.join(process.cwd(), 'public', 'temp_uploads', sessionId.value, 'query');
   const queryDir_image = path.join(queryDir, 'image');
   const queryDir_audio = path.join(queryDir, 'audio');
-  const mapperDir = path.join(process.cwd(), 'public', 'temp_uploads', sessionId.value);
-  
+
   await ensureDirectoryExists(queryDir);
   await ensureDirectoryExists(queryDir_image);
   await ensureDirectoryExists(queryDir_audio);
@@ -70,32 +100,20 @@ export async function GET(request: NextRequest) {
     );
   }
 
-  // Copy the mapper.json to the session directory
-  const mapperPath = path.join(mapperDir, 'mapper.json');
-  const mapperDestination = path.join(mapperDir, 'copy_mapper.json');
-  try {
-    await fs.copyFile(mapperPath, mapperDestination);
-    console.log(`mapper.json copied to ${mapperDestination}`);
-  } catch (error) {
-    console.error('Error copying mapper.json:', error);
-    return NextResponse.json(
-      { success: false, message: 'Error copying mapper.json' },
-      { status: 500 }
-    );
-  }
-
-  try {
-    const { stdout, stderr } = await execAsync(`python src/retrieval.py --session ${sessionId.value}`);
-    console.log('Python stdout:', stdout);
-    if (stderr) {
-      console.error('Python stderr:', stderr);
+  if (!(await queryServer(sessionId.value))) {
+    try {
+      const { stdout, stderr } = await execFileAsync('python', ['src/retrieval.py', '--session', sessionId.value, '--top-k', String(queryTopK)]);
+      console.log('Python stdout:', stdout);
+      if (stderr) {
+        console.error('Python stderr:', stderr);
+      }
+    } catch (error) {
+      console.error('Execution error:', error);
+      return NextResponse.json(
+        { success: false, message: 'Error executing Python script' },
+        { status: 500 }
+      );
     }
-  } catch (error) {
-    console.error('Execution error:', error);
-    return NextResponse.json(
-      { success: false, message: 'Error executing Python script' },
-      { status: 500 }
-    );
   }
 
   await clearFolderContents(queryDir_image);
@@ -1,10 +1,13 @@
 import { NextRequest, NextResponse } from 'next/server';
 import fs from 'fs/promises';
 import path from 'path';
-import {exec} from 'child_process'
+import {execFile} from 'child_process'
 
 const audioExtensions = ['.mid', '.wav'];
 
+// The session ID cookie is used in paths and python arguments, only UUID-like IDs are accepted
+const sessionIdPattern = /^[A-Za-z0-9_-]+$/;
+
 async function ensureDirectoryExists(dir: string) {
   try {
     await fs.access(dir);
@@ -35,6 +38,13 @@ export async function POST(request: NextRequest) {
     );
   }
 
+  if (!sessionIdPattern.test(sessionId.value)) {
+    return NextResponse.json(
+      { success: false, message: 'Invalid session ID' },
+      { status: 400 }
+    );
+  }
+
   try {
     const data = await request.formData();
     const audioFile = data.get('audio') as File | null;
@@ -73,7 +83,7 @@ export async function POST(request: NextRequest) {
     await fs.writeFile(savedFilePath, fileBuffer as any);
 
     if(fileExtension === '.wav'){
-      exec(`python src/processWavToMidi.py --path ${savedFilePath} --folder ${audioPath}`, (error, stdout, stderr) => {
+      execFile('python', ['src/processWavToMidi.py', '--path', savedFilePath, '--folder', audioPath], (error, stdout, stderr) => {
         if (error) {
           console.log(`error: ${error.message}`);
         }
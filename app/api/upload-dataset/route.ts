@@ -2,9 +2,26 @@ import { NextRequest, NextResponse } from 'next/server';
 import fs from 'fs/promises';
 import path from 'path';
 import AdmZip from 'adm-zip';
-import {exec} from 'child_process'
+import {execFile} from 'child_process'
 
 const imageExtensions = ['.jpg', '.jpeg', '.png'];
+
+// Resident python query service (src/query_server.py), it maps the feature
+// stores of the sessions it answered
+const queryServerUrl = process.env.QUERY_SERVER_URL ?? 'http://127.0.0.1:8000';
+
+// The session ID cookie is used in paths and python arguments, only UUID-like IDs are accepted
+const sessionIdPattern = /^[A-Za-z0-9_-]+$/;
+
+// drop the session from the query server before the ingest writes a new
+// version of its stores, so the old files are no longer mapped
+async function releaseSession(sessionId: string) {
+  try {
+    await fetch(`${queryServerUrl}/session?session=${encodeURIComponent(sessionId)}`, { method: 'DELETE' });
+  } catch (error) {
+    // query server not running, nothing is mapped
+  }
+}
 const audioExtensions = ['.mp3', '.wav', '.mid', '.midi'];
 
 async function getAllFiles(dir: string): Promise<string[]> {
@@ -51,6 +68,13 @@ export async function POST(request: NextRequest) {
     );
   }
 
+  if (!sessionIdPattern.test(sessionId.value)) {
+    return NextResponse.json(
+      { success: false, message: 'Invalid session ID' },
+      { status: 400 }
+    );
+  }
+
   try {
     const data = await request.formData();
     const coverZipFile = data.get('cover') as File | null;
@@ -179,7 +203,9 @@ export async function POST(request: NextRequest) {
 
     const [coverFiles, musicFiles] = await Promise.all([coverProcess(), musicProcess()]);
 
-    exec(`python src/datasetProcess.py --session ${sessionId.value}`, (error, stdout, stderr) => {
+    await releaseSession(sessionId.value);
+
+    execFile('python', ['src/datasetProcess.py', '--session', sessionId.value], (error, stdout, stderr) => {
       if (error) {
         console.log(`error: ${error.message}`);
       }
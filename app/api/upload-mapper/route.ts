@@ -1,6 +1,13 @@
 import { NextRequest, NextResponse } from 'next/server';
 import fs from 'fs/promises';
 import path from 'path';
+import { execFile } from 'child_process';
+import { promisify } from 'util';
+
+const execFileAsync = promisify(execFile);
+
+// Session ID dari cookie dipakai di path dan argumen python, hanya UUID / id sederhana
+const sessionIdPattern = /^[A-Za-z0-9_-]+$/;
 
 async function ensureDirectoryExists(dir: string) {
   try {
@@ -40,6 +47,13 @@ export async function POST(request: NextRequest) {
       );
     }
 
+    if (!sessionIdPattern.test(sessionId.value)) {
+      return NextResponse.json(
+        { success: false, message: 'Invalid session ID' },
+        { status: 400 }
+      );
+    }
+
     // Buat direktori yang diperlukan jika belum ada
     const uploadsDir = path.join(process.cwd(), 'public', 'temp_uploads', sessionId.value);
     await ensureDirectoryExists(uploadsDir);
@@ -54,10 +68,21 @@ export async function POST(request: NextRequest) {
       console.log('No previous mapper file to remove');
     }
 
+    // Hasil query lama tidak berlaku untuk mapper yang baru
+    await fs.rm(path.join(uploadsDir, 'results.json'), { force: true });
+
     // Simpan file mapper yang baru
     const mapperBytes = await mapperFile.arrayBuffer();
     await fs.writeFile(mapperFilePath, Buffer.from(mapperBytes) as any);
 
+    // Index lookup pic <-> audio dibangun sekali di sini, query tidak perlu memindai mapper.json
+    try {
+      await execFileAsync('python', ['src/mapper_index.py', '--session', sessionId.value]);
+    } catch (err) {
+      // query akan membangun index sendiri jika belum ada
+      console.error('Error building mapper index:', err);
+    }
+
     return NextResponse.json({
       success: true,
       message: 'Mapper uploaded successfully',
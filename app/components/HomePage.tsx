@@ -17,12 +17,13 @@ interface DatasetItem {
 
 interface HomepageProps {
   data: DatasetItem[];  
+  totalEntries: number;
   searchParams: { [key: string]: string | string[] | undefined };
   searchTerm: string;
 }
 
 
-const Homepage: FC<HomepageProps> = ({ data, searchParams, searchTerm }) => {
+const Homepage: FC<HomepageProps> = ({ data, totalEntries, searchParams, searchTerm }) => {
 
   const [sessionId, setSessionId] = useState<string | null>(null);
   const [filteredData, setFilteredData] = useState<DatasetItem[]>([]);
@@ -46,18 +47,9 @@ const Homepage: FC<HomepageProps> = ({ data, searchParams, searchTerm }) => {
     }
   }, []);
 
-  const page = searchParams["page"] ?? "1";
-  const per_page = searchParams["per_page"] ?? "10";
-
-  const start = (Number(page) - 1) * Number(per_page);
-  const end = start + Number(per_page);
-
+  // data is already the page on screen, searched and paged by get-data
   useEffect(() => {
-    const filtered = searchTerm
-      ? data.filter(entry =>
-          entry.song.toLowerCase().includes(searchTerm.toLowerCase())
-        )
-      : data;
+    const filtered = data;
     setFilteredData(filtered);
     console.log(filteredData);
     const hasQueried = filtered.some(
@@ -66,7 +58,7 @@ const Homepage: FC<HomepageProps> = ({ data, searchParams, searchTerm }) => {
     setQueried(hasQueried);
   }, [data, searchTerm]);
 
-  const entries = filteredData.slice(start, end);
+  const entries = filteredData;
   
 
   const [playingTracks, setPlayingTracks] = useState<{ [key: string]: boolean }>({});
@@ -711,7 +703,7 @@ const Homepage: FC<HomepageProps> = ({ data, searchParams, searchTerm }) => {
         <div className="">
           <PaginationControls
 
-            totalEntries={data.length}
+            totalEntries={totalEntries}
           />
         </div>
   
@@ -9,19 +9,25 @@ interface DatasetItem {
   cover: string;
 }
 
-const DatasetManager = () => {
+// Only the page on screen is fetched, get-data pages and filters the list
+const DatasetManager = (page: string, perPage: string, searchTerm: string) => {
   const [data, setData] = useState<DatasetItem[]>([]);
+  const [total, setTotal] = useState<number>(0);
+  const [refresh, setRefresh] = useState<number>(0);
   const [uploadStatus, setUploadStatus] = useState<string>('Waiting for dataset upload...');
   
   const fetchData = async () => {
     try {
-      const response = await fetch('/api/get-data');
+      const params = new URLSearchParams({ page, per_page: perPage, search: searchTerm });
+      const response = await fetch(`/api/get-data?${params}`);
       const result = await response.json();
 
-      if (result.success && result.dataset && result.dataset.length > 0) {
+      if (result.success && result.dataset) {
         setData(result.dataset); 
+        setTotal(result.total);
       } else {
         setData([]);  
+        setTotal(0);
         setUploadStatus('No dataset available. Please upload a dataset.');
       }
     } catch (error) {
@@ -32,7 +38,9 @@ const DatasetManager = () => {
 
   useEffect(() => {
     fetchData();
+  }, [page, perPage, searchTerm, refresh]);
 
+  useEffect(() => {
     const eventSource = new EventSource('/api/notify-upload');
 
     eventSource.onmessage = (event) => {
@@ -46,7 +54,7 @@ const DatasetManager = () => {
 
         if (eventData.status === 'file-uploaded') {
           console.log('File uploaded, refreshing data...');
-          fetchData();
+          setRefresh((count) => count + 1);
         }
       } catch (error) {
         console.error('Error parsing event data:', error);
@@ -58,7 +66,30 @@ const DatasetManager = () => {
     };
   }, []);
 
-  return { data, uploadStatus };
+  return { data, total, uploadStatus };
+};
+
+const DatasetView = ({
+  searchParams,
+  searchTerm,
+}: {
+  searchParams: Record<string, string>;
+  searchTerm: string;
+}) => {
+  const { data, total } = DatasetManager(
+    searchParams['page'] ?? '1',
+    searchParams['per_page'] ?? '10',
+    searchTerm
+  );
+
+  return (
+    <Homepage
+      data={data}
+      totalEntries={total}
+      searchParams={searchParams}
+      searchTerm={searchTerm}
+    />
+  );
 };
 
 const SearchParamHandler = ({
@@ -73,7 +104,6 @@ const SearchParamHandler = ({
 };
 
 export default function Home() {
-  const { data, uploadStatus } = DatasetManager();
   const [searchTerm, setSearchTerm] = useState<string>('');
 
   return (
@@ -82,11 +112,7 @@ export default function Home() {
       <Suspense fallback={<p>Loading...</p>}>
         <SearchParamHandler>
           {(params) => (
-            <Homepage
-              data={data}
-              searchParams={params}
-              searchTerm={searchTerm}
-            />
+            <DatasetView searchParams={params} searchTerm={searchTerm} />
           )}
         </SearchParamHandler>
       </Suspense>
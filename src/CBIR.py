@@ -1,61 +1,234 @@
 import numpy as np
 import ImageProcessing as ip
+import image_store
 from PIL import Image
 import pca as pcakw
+import distance
+import quantize
+import metrics
 # import matplotlib.pyplot as plt
+import os
 import time
 
-def CBIR(image_features_path: str, query_image_path: str, img_size: tuple): 
+def fit_pca(image_dataset: np.ndarray, num_components: int = 100, block_size: int = 4096, dtype=np.float32):
+    '''fit the PCA model of the image dataset, returns the state needed to answer queries
 
-    #set the timer at start of the program
-    start_time = time.time()
-
-    #Perform preprocessing methods for the dataset
+    The dataset (a uint8 memory map of the image store) is streamed in blocks of
+    rows and centered on the fly, the SVD runs in dtype.'''
 
-    #process the images into a matrix dataset
-    image_dataset, image_filenames = ip.load_preprocessed_images(image_features_path)
+    #perform PCA
+    pca_features, components, mean = pcakw.fit_transform_blocked(image_dataset, num_components, block_size, dtype)
+    print(f"PCA features shape: {pca_features.shape}")
 
-    #show the dataset shape
+    #the model is small, keep it in float64 for the incremental updates and queries,
+    #the dataset is projected again in float64 (U * S = X_centered @ V) so it is
+    #consistent with the projection of the query images
+    components = components.astype(np.float64)
+    pca_features = pcakw.centered_product(image_dataset, mean, components.T, block_size, np.float64)
+
+    #the columns of pca_features are U * S, their norms are the singular values
+    singular_values = np.sqrt(np.sum(pca_features ** 2, axis=0))
+
+    return {'pca_features': pca_features, 'components': components, 'mean': mean,
+            'singular_values': singular_values, 'drift': np.array(0.0)}
+
+def update_pca(model: dict, image_dataset: np.ndarray, image_filenames, max_drift: float = 0.05):
+    '''fold the images appended since the model was fitted into it with an incremental PCA update
+
+    Returns None when a full refit is needed: images were removed or changed, the
+    model has fewer components than asked for, or the accumulated drift of the
+    principal subspace since the last full fit went over max_drift.'''
+
+    n_old = len(model['filenames'])
+    image_filenames = np.asarray(image_filenames).astype(str)
+
+    # only appended rows can be folded in
+    if len(image_filenames) <= n_old or not np.array_equal(image_filenames[:n_old], model['filenames'].astype(str)):
+        return None
+    if model['components'].shape[0] < int(model['num_components']):
+        return None
+
+    X_new = image_dataset[n_old:]
+    mean, components, singular_values, _ = pcakw.partial_fit(
+        model['mean'], model['components'], model['singular_values'], n_old, X_new)
+
+    drift = float(model['drift']) + pcakw.subspace_drift(model['components'], components)
+    print(f"Incremental PCA update with {len(X_new)} images, drift since the last full fit: {drift:.4f}")
+    if drift > max_drift:
+        print("Drift is over the limit, a full refit is worth it")
+        return None
+
+    #old rows are corrected lazily from their stored projection, new rows are projected
+    old_features = pcakw.correct_features(model['pca_features'], model['mean'], model['components'], mean, components)
+    new_features = pcakw.transform(np.asarray(X_new, dtype=np.float64), components, mean)
+
+    updated = dict(model)
+    updated.update({
+        'pca_features': np.vstack((old_features, new_features)),
+        'components': components,
+        'mean': mean,
+        'singular_values': singular_values,
+        'drift': np.array(drift),
+        'filenames': image_filenames,
+    })
+    return updated
+
+def pca_model_path(image_store_path: str) -> str:
+    '''the fitted PCA model is saved in the session folder, next to the image store'''
+    return os.path.join(os.path.dirname(os.path.normpath(image_store_path)), "pca_model.npz")
+
+def dataset_hash(image_store_path: str) -> str:
+    '''content hash of the preprocessed dataset, used to detect a stale PCA model'''
+    return image_store.content_hash(image_store_path)
+
+def load_or_fit_pca(image_store_path: str, num_components: int = 100, refit: bool = False,
+                    incremental: bool = True, max_drift: float = 0.05) -> dict:
+    '''load the PCA model fitted at ingest time, update or refit and save it when the dataset changed'''
+
+    model_path = pca_model_path(image_store_path)
+    #the header is rewritten every time the store is saved
+    stat = os.stat(image_store.header_path(image_store_path))
+    model = None
+
+    if not refit and os.path.isfile(model_path):
+        with metrics.span('load_pca_model'):
+            model = pcakw.load_model(model_path)
+        if int(model['num_components']) != num_components:
+            model = None
+        else:
+            #same size and mtime as when it was fitted, no need to hash the dataset
+            if int(model['source_size']) == stat.st_size and float(model['source_mtime']) == stat.st_mtime:
+                return model
+            with metrics.span('hash_dataset'):
+                unchanged = str(model['dataset_hash']) == dataset_hash(image_store_path)
+            if unchanged:
+                model['source_size'] = np.array(stat.st_size)
+                model['source_mtime'] = np.array(stat.st_mtime)
+                pcakw.save_model(model_path, model)
+                return model
+            print("Dataset changed since the PCA model was fitted")
+
+    store = image_store.load_store(image_store_path)
+    image_dataset, image_filenames = store['pixels'], store['filenames']
     print(f"Loaded {len(image_dataset)} images with shape {image_dataset.shape}")
 
-    #standardize the dataset
-    #from now on, the dataset for PCA is X
-    X = image_dataset.copy()
-    X_centered, mean = pcakw.standardization(X)
+    #models saved before the incremental update did not keep these
+    if model is not None and 'singular_values' not in model:
+        model['singular_values'] = np.sqrt(np.sum(model['pca_features'] ** 2, axis=0))
+        model['drift'] = np.array(0.0)
+
+    with metrics.span('pca_update'):
+        updated = update_pca(model, image_dataset, image_filenames, max_drift) if (model is not None and incremental) else None
+    if updated is not None:
+        model = updated
+    else:
+        print("Refitting the PCA model")
+        with metrics.span('pca_refit'):
+            model = fit_pca(image_dataset, num_components)
+        model['filenames'] = np.asarray(image_filenames)
+
+    model['num_components'] = np.array(num_components)
+    with metrics.span('hash_dataset'):
+        model['dataset_hash'] = np.array(dataset_hash(image_store_path))
+    model['source_size'] = np.array(stat.st_size)
+    model['source_mtime'] = np.array(stat.st_mtime)
+
+    with metrics.span('save_pca_model'):
+        pcakw.save_model(model_path, model)
+    print(f"PCA model saved to {model_path}")
+
+    return model
+
+def project_query(pca_state: dict, query_image_path: str, img_size: tuple) -> np.ndarray:
+    '''PCA features of the query image'''
+    with metrics.span('project_query'):
+        query_image = ip.grayscaleConversion(Image.open(query_image_path))
+        query_image = query_image.resize(img_size)
+        query_image = np.array(query_image).flatten().reshape(1, -1)  # Flatten and reshape
+        return pcakw.transform(query_image, pca_state['components'], pca_state['mean'])
+
+def search(pca_state: dict, query_image_path: str, img_size: tuple, top_k: int = 10, metric: str = 'euclidean',
+           stages=distance.STAGES, exact: bool = True, rerank: int = quantize.RERANK):
+    '''rank the dataset images against the query image using a fitted PCA state
+
+    Euclidean searches prefilter on the leading principal components with the
+    given (dims, keep) stages, pass stages=None to scan at full dimension.
+    A state with compressed codes (quantize.attach_codes) scans the codes
+    (euclidean) and reranks the rerank closest images exactly.'''
+
+    query_features = project_query(pca_state, query_image_path, img_size)
+    return search_features(pca_state, query_features, top_k, metric, stages, exact, rerank)
+
+def search_features(pca_state: dict, query_features: np.ndarray, top_k: int = 10, metric: str = 'euclidean',
+                    stages=distance.STAGES, exact: bool = True, rerank: int = quantize.RERANK):
+    '''rank the dataset images against already projected query features, see search'''
+
+    pca_features = pca_state.get('pca_features')
+    image_filenames = pca_state['filenames']
+    compressed = pca_state.get('codes') is not None
+
+    #norms of the dataset rows only depend on the model, compute them once per loaded state
+    if 'feature_norms' not in pca_state and not compressed and not (stages and metric == 'euclidean'):
+        pca_state['feature_norms'] = distance.row_norms(pca_features)
+
+    metrics.count('images_scanned', len(image_filenames))
+    with metrics.span('distance_scan'):
+        if compressed:
+            top_indices, top_distances = quantize.search(pca_state['codes'], query_features, top_k, rerank,
+                                                         lambda rows: exact_features(pca_state, rows))
+        elif stages and metric == 'euclidean':
+            #contiguous copy of the components the first stage compares every image on
+            first_dims = min(dims for dims, _ in stages)
+            if pca_state.get('leading_features') is None or pca_state['leading_features'].shape[1] != first_dims:
+                pca_state['leading_features'] = np.ascontiguousarray(pca_features[:, :first_dims])
+
+            top_indices, top_distances = distance.coarse_to_fine_top_k(query_features, pca_features, top_k, stages, exact,
+                                                                       leading_features=pca_state['leading_features'])
+        else:
+            top_indices, top_distances = distance.top_k(query_features, pca_features, top_k, metric, feature_norms=pca_state['feature_norms'])
+
+    # Sort image_filenames based on top_indices
+    sorted_filenames = [image_filenames[i] for i in top_indices]
+    distance_between_query = list(top_distances)
+
+    return sorted_filenames, distance_between_query
 
-    #determine n components for PCA
-    num_components = 100
+def exact_features(pca_state: dict, rows) -> np.ndarray:
+    '''PCA features of the given dataset images, projected again from the image store when only codes are in memory'''
+    if pca_state.get('pca_features') is not None:
+        return pca_state['pca_features'][rows]
+    return pcakw.transform(np.asarray(pca_state['pixels'][rows], dtype=np.float64), pca_state['components'], pca_state['mean'])
 
-    #perform PCA
-    pca_features, components = pcakw.fit_transform(X_centered, num_components)
-    print(f"PCA features shape: {pca_features.shape}")
-    # print(pca_features)
+def search_rows(pca_state: dict, query_features: np.ndarray, rows, top_k: int = 10):
+    '''rank only the given dataset images (indices into the state filenames), exact euclidean'''
 
-    query_image = ip.grayscaleConversion(Image.open(query_image_path))
-    query_image = query_image.resize(img_size)
-    query_image = np.array(query_image).flatten().reshape(1, -1)  # Flatten and reshape
-    query_features = pcakw.transform(query_image, components, mean)
+    rows = np.asarray(rows, dtype=np.int64)
+    image_filenames = pca_state['filenames']
 
-    distance_between_query = np.zeros(len(pca_features))
-    for i in range(len(pca_features)):
-        image_data = pca_features[i].flatten().reshape(1, -1)
-        distance = ip.image_euclidean_distance(query_features, image_data)
-        distance_between_query[i] = distance
+    metrics.count('images_scanned', len(rows))
+    with metrics.span('distance_scan'):
+        if len(rows) == 0:
+            return [], []
+        top_indices, top_distances = distance.top_k(query_features, exact_features(pca_state, rows), top_k)
+
+    return [image_filenames[rows[i]] for i in top_indices], list(top_distances)
+
+def CBIR(image_store_path: str, query_image_path: str, img_size: tuple, num_components: int = 100,
+         stages=distance.STAGES, exact: bool = True):
+
+    #set the timer at start of the program
+    start_time = time.time()
+
+    #the PCA model is fitted at ingest time, only refit if the dataset changed
+    pca_state = load_or_fit_pca(image_store_path, num_components)
+
+    sorted_filenames, distance_between_query = search(pca_state, query_image_path, img_size, stages=stages, exact=exact)
 
     #stop the timer
     end_time = time.time()
 
     print("Total estimated time: ", end_time - start_time)
 
-    # for calling APIs this is not used
-    # #sort the distances
-    top_k = 10
-    top_indices = np.argsort(distance_between_query)[:top_k]
-
-    # Sort image_filenames based on top_indices
-    sorted_filenames = [image_filenames[i] for i in top_indices]
-    distance_between_query = [distance_between_query[i] for i in top_indices]
-
     return sorted_filenames, distance_between_query
     # Display results
     # print("Top matches:")
@@ -73,4 +246,4 @@ def CBIR(image_features_path: str, query_image_path: str, img_size: tuple):
 # #transform the query image
 # query_image_path = "input.png"
 # image_dataset, image_filenames = ip.load_preprocessed_images("features.npy")
-# CBIF(folder_path, query_image_path, img_size)
\ No newline at end of file
+# CBIF(folder_path, query_image_path, img_size)
@@ -2,6 +2,69 @@ from PIL import Image
 import numpy as np
 import os
 import math
+import itertools
+import concurrent.futures
+import image_store
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+# rows of the old store copied at a time when it is updated, about 60 MB of 120x120 images
+COPY_ROWS = 4096
+
+def preprocess_image(filepath, img_size=(120, 120)):
+    '''grayscale, resize and flatten one image'''
+    image = Image.open(filepath)
+    # JPEGs are decoded at a reduced DCT scale, still at least twice the target size
+    image.draft(None, (img_size[0] * 2, img_size[1] * 2))
+    image = grayscaleConversion(image)  # Convert to grayscale
+    image = image.resize(img_size)  # Default resize to (120, 120)
+    return np.array(image).flatten()  # Flatten into 1D vector
+
+def _preprocess_chunk(filepaths, img_size):
+    '''worker task, a few images per task so the pool overhead stays small'''
+    images = np.zeros((len(filepaths), img_size[0] * img_size[1]), dtype=np.uint8)
+    for i, filepath in enumerate(filepaths):
+        images[i] = preprocess_image(filepath, img_size)
+    return images
+
+def preprocess_images(filepaths, img_size=(120, 120), out=None, workers=None, chunk_size=64):
+    '''preprocess a list of images into a (n_images, width * height) matrix
+
+    Large lists are decoded in a process pool. Every finished chunk is copied
+    straight into its rows of out (allocated when not given, it can be a view or
+    a memory map), and only two chunks per worker are in flight at a time, so
+    the peak memory stays about one copy of the dataset.'''
+
+    if out is None:
+        out = np.zeros((len(filepaths), img_size[0] * img_size[1]), dtype=np.uint8)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    starts = range(0, len(filepaths), chunk_size)
+    if workers <= 1 or len(starts) <= 1:
+        for start in starts:
+            out[start:start + chunk_size] = _preprocess_chunk(filepaths[start:start + chunk_size], img_size)
+        return out
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        remaining = iter(starts)
+
+        def submit(start):
+            pending[executor.submit(_preprocess_chunk, filepaths[start:start + chunk_size], img_size)] = start
+
+        for start in itertools.islice(remaining, 2 * workers):
+            submit(start)
+
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                start = pending.pop(future)
+                out[start:start + chunk_size] = future.result()
+                for next_start in itertools.islice(remaining, 1):
+                    submit(next_start)
+
+    return out
 
 def preprocess_image_from_folder(folder_path, output_file, img_size=(120, 120)):
     '''note: img_size might subject to change to receive an integer instead of a tuple'''
@@ -10,19 +73,44 @@ def preprocess_image_from_folder(folder_path, output_file, img_size=(120, 120)):
         print(f"Preprocessed file {output_file} already exists. Skipping preprocessing.")
         return
 
-    images = []
-    image_filenames = []
-    for filename in os.listdir(folder_path):
-        if filename.endswith((".png", ".jpg", ".jpeg")):  # Supported image formats
-            filepath = os.path.join(folder_path, filename)
-            image = grayscaleConversion(Image.open(filepath))  # Convert to grayscale
-            image = image.resize(img_size)  # Default resize to (120, 120)
-            images.append(np.array(image).flatten())  # Flatten into 1D vector
-            image_filenames.append(filename)
-
-    np.save(output_file, {'dataset': np.array(images), 'filenames': np.array(image_filenames)})
+    image_filenames = [filename for filename in os.listdir(folder_path) if filename.endswith(IMAGE_EXTENSIONS)]  # Supported image formats
+    images = preprocess_images([os.path.join(folder_path, filename) for filename in image_filenames], img_size)
+
+    np.save(output_file, {'dataset': images, 'filenames': np.array(image_filenames)})
     print(f"Preprocessed data saved to {output_file}")
-    return np.array(images), image_filenames
+    return images, image_filenames
+
+def update_preprocessed_images(folder_path, store_path, new_filenames, removed_filenames, img_size=(120, 120)):
+    '''append the new or changed images to the image store and drop the removed ones'''
+
+    if image_store.is_store(store_path):
+        old_store = image_store.load_store(store_path)
+        dataset, filenames = old_store['pixels'], old_store['filenames']
+        del old_store
+    else:
+        dataset, filenames = np.zeros((0, img_size[0] * img_size[1]), dtype=np.uint8), np.array([], dtype=str)
+
+    # changed images are dropped here and processed again with the new ones
+    dropped = set(removed_filenames) | set(new_filenames)
+    keep = np.array([str(filename) not in dropped for filename in filenames], dtype=bool)
+    filenames = np.concatenate([np.asarray(filenames)[keep], np.array(new_filenames, dtype=str)])
+
+    # kept rows and new images are written straight into the memory map of the new store
+    n_keep = int(keep.sum())
+    updated = image_store.create_pixels(store_path, n_keep + len(new_filenames), img_size)
+    written = 0
+    for start in range(0, len(keep), COPY_ROWS):
+        block = dataset[start:start + COPY_ROWS][keep[start:start + COPY_ROWS]]
+        updated[written:written + len(block)] = block
+        written += len(block)
+    preprocess_images([os.path.join(folder_path, filename) for filename in new_filenames], img_size, out=updated[n_keep:])
+    updated.flush()
+
+    # the save removes old generations, a file still mapped here could not be removed (Windows)
+    del dataset, updated
+    store = image_store.save_store(store_path, filenames, img_size)
+    print(f"Image store updated in {store_path}: {len(new_filenames)} added or changed, {len(removed_filenames)} removed")
+    return store['pixels'], store['filenames']
 
 def load_preprocessed_images(output_file: str):
     """
@@ -70,7 +158,7 @@ def grayscaleConversion(image: Image.Image) -> Image:
 
 def image_euclidean_distance(image1: np.ndarray, image2: np.ndarray):
     '''Compute the Euclidean distance between two images'''
-    width = image1.shape[0]
+    width = image1.shape[1]
     distance_total = 0
     for x in range(width):
         distance_of_pixel = (image1[0,x] - image2[0,x]) ** 2
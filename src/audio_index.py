@@ -0,0 +1,167 @@
+import numpy as np
+import argparse
+import os
+import audio_store
+import audio_retriev as ar
+import metrics
+
+# Inverted file (IVF) index over the audio windows, so a humming query only
+# scores the windows of a few clusters to pick the songs worth scoring exactly.
+#
+# A window is embedded as z = [0.1 atb/|atb|, 0.45 rtb/|rtb|, 0.45 ftb/|ftb|],
+# its score against a query is then the single dot product <z, Q> where Q is
+# the concatenation of ar.query_vector. The embeddings are clustered with
+# k-means, a query probes the nprobe clusters whose centroid scores best.
+#
+# <session>/audio_ivf.npz
+#     centroids     float32 (nlist, 637)
+#     list_offsets  int64 (nlist + 1), windows of list i are list_windows[list_offsets[i]:list_offsets[i+1]]
+#     list_windows  int64 (n_windows,), store rows grouped by list
+#     filenames, offsets  layout of the store the index was built for
+
+INDEX_VERSION = 1
+
+# default speed/recall knobs, more probes or a longer shortlist is slower but misses less
+NPROBE = 8
+SHORTLIST = 100
+
+def index_path(dir_path: str) -> str:
+    '''the index is saved next to the audio features of the session'''
+    return os.path.join(dir_path, "audio_ivf.npz")
+
+def window_embeddings(store: dict, rows: np.ndarray) -> np.ndarray:
+    '''weighted unit-normalized (atb, rtb, ftb) embedding of the given store rows'''
+
+    rows = np.asarray(rows, dtype=np.int64)
+    inv_norms = np.asarray(store['inv_norms'])[rows]
+    blocks = []
+    for i, ((block, _), weight) in enumerate(zip(audio_store.BLOCKS, ar.FEATURE_WEIGHTS)):
+        values = audio_store.gather_rows(store, block, rows)
+        blocks.append(values * (weight * inv_norms[:, i:i + 1]).astype(np.float32))
+    return np.hstack(blocks)
+
+def _nearest_centroid(embeddings: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    #argmin ||z - c||^2 = argmax z.c - ||c||^2 / 2
+    half_norms = 0.5 * np.einsum('ij,ij->i', centroids, centroids)
+    return np.argmax(embeddings @ centroids.T - half_norms, axis=1)
+
+def kmeans(embeddings: np.ndarray, nlist: int, n_iter: int = 20, seed: int = 0) -> np.ndarray:
+    '''Lloyd k-means on the training embeddings, returns the centroids'''
+
+    rng = np.random.default_rng(seed)
+    centroids = embeddings[rng.choice(len(embeddings), nlist, replace=False)].copy()
+
+    for _ in range(n_iter):
+        labels = _nearest_centroid(embeddings, centroids)
+        counts = np.bincount(labels, minlength=nlist)
+
+        #sum the points of every cluster with one segmented reduction
+        order = np.argsort(labels, kind='stable')
+        non_empty = counts > 0
+        starts = (np.cumsum(counts) - counts)[non_empty]
+        sums = np.add.reduceat(embeddings[order].astype(np.float64), starts, axis=0)
+        centroids[non_empty] = sums / counts[non_empty, None]
+
+        #clusters that lost all their points restart from a random window
+        empty = np.flatnonzero(~non_empty)
+        if len(empty):
+            centroids[empty] = embeddings[rng.choice(len(embeddings), len(empty))]
+
+    return centroids
+
+def build_index(store: dict, nlist: int = None, n_iter: int = 20, sample_size: int = 100000,
+                chunk_size: int = 65536, seed: int = 0) -> dict:
+    '''cluster the windows of the store and build the inverted lists'''
+
+    n = audio_store.n_windows(store)
+    if nlist is None:
+        nlist = int(np.sqrt(n))
+    nlist = max(1, min(nlist, n))
+
+    index = {'version': INDEX_VERSION, 'filenames': np.asarray(store['filenames']),
+             'offsets': np.asarray(store['offsets'])}
+    if n == 0:
+        index.update({'centroids': np.zeros((0, 637), dtype=np.float32),
+                      'list_offsets': np.zeros(1, dtype=np.int64), 'list_windows': np.zeros(0, dtype=np.int64)})
+        return index
+
+    #train on a sample, the store may not fit in memory as float embeddings
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(n, min(n, max(sample_size, nlist)), replace=False))
+    centroids = kmeans(window_embeddings(store, sample), nlist, n_iter, seed)
+
+    labels = np.zeros(n, dtype=np.int64)
+    for start in range(0, n, chunk_size):
+        rows = np.arange(start, min(start + chunk_size, n))
+        labels[rows] = _nearest_centroid(window_embeddings(store, rows), centroids)
+
+    list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+    list_offsets[1:] = np.cumsum(np.bincount(labels, minlength=nlist))
+
+    index.update({'centroids': centroids.astype(np.float32), 'list_offsets': list_offsets,
+                  'list_windows': np.argsort(labels, kind='stable')})
+    print(f"Audio index built: {n} windows in {nlist} lists")
+    return index
+
+def save_index(path: str, index: dict):
+    np.savez(path, **{key: np.asarray(value) for key, value in index.items()})
+
+def load_index(path: str, store: dict) -> dict:
+    '''load the index of a store, None when there is none or it was built for another store'''
+
+    if store is None or not os.path.isfile(path):
+        return None
+    with np.load(path) as data:
+        index = {key: data[key] for key in data.files}
+
+    if int(index['version']) != INDEX_VERSION:
+        return None
+    if not (np.array_equal(index['offsets'], store['offsets'])
+            and np.array_equal(index['filenames'].astype(str), np.asarray(store['filenames']).astype(str))):
+        print("Audio index does not match the audio store, ignoring it")
+        return None
+    return index
+
+def candidate_songs(index: dict, store: dict, query, nprobe: int = NPROBE, shortlist: int = SHORTLIST) -> np.ndarray:
+    '''indices of the shortlist songs whose windows in the probed lists score best'''
+
+    query = np.concatenate(query)
+    nlist = len(index['centroids'])
+    if nlist == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    #probe the lists whose centroid scores best against the query
+    centroid_scores = index['centroids'].astype(np.float64) @ query
+    nprobe = min(nprobe, nlist)
+    probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+
+    list_offsets = index['list_offsets']
+    rows = np.concatenate([index['list_windows'][list_offsets[i]:list_offsets[i + 1]] for i in probes])
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    scores = window_embeddings(store, rows).astype(np.float64) @ query
+    metrics.count('index_windows_compared', len(rows))
+    songs = np.searchsorted(store['offsets'], rows, side='right') - 1
+
+    best = np.full(len(store['filenames']), float('-inf'))
+    np.maximum.at(best, songs, scores)
+    found = np.flatnonzero(best > float('-inf'))
+    if len(found) > shortlist:
+        found = found[np.argpartition(-best[found], shortlist - 1)[:shortlist]]
+    return np.sort(found)
+
+def main():
+    parser = argparse.ArgumentParser(description='build the approximate search index of the audio store')
+
+    parser.add_argument('--session', type=str, required=True)
+    parser.add_argument('--nlist', type=int, default=None, help='number of clusters, sqrt(windows) by default')
+
+    args = parser.parse_args()
+
+    dir_path = "public/temp_uploads/" + args.session
+    store = audio_store.load_store(audio_store.store_dir(dir_path))
+    save_index(index_path(dir_path), build_index(store, args.nlist))
+
+if __name__ == "__main__":
+    main()
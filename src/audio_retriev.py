@@ -1,5 +1,4 @@
 import multiprocessing.pool
-from mido import MidiFile
 import mido
 import json
 import pandas as pd
@@ -8,10 +7,15 @@ import sys
 import os
 import concurrent.futures
 import time
-from basic_pitch.inference import predict, Model
+from basic_pitch.inference import Model
 from basic_pitch import ICASSP_2022_MODEL_PATH
 import soundfile as sf
 import multiprocessing
+import shutil
+import audio_store
+import manifest
+import metrics
+import stream_query
 
 uploaded = True
 
@@ -23,9 +27,37 @@ def is_drum_channel(track):
                 return True
     return False
 
+def load_midi(file_path):
+    '''decode a MIDI file, an already decoded mido.MidiFile is returned as is'''
+    if isinstance(file_path, mido.MidiFile):
+        return file_path
+    return mido.MidiFile(file_path)
+
+def track_statistics(track):
+    '''name, note event count, channel 0 usage and drum program change of a track in one scan'''
+    track_name = None
+    track_event_count = 0
+    has_channel_zero = False
+    is_drum = False
+
+    for msg in track:
+        msg_type = msg.type
+        if msg_type == 'note_on' or msg_type == 'note_off':
+            if msg.channel == 0:
+                has_channel_zero = True
+            track_event_count += 1
+        elif msg_type == 'program_change':
+            if msg.channel == 9:
+                is_drum = True
+        elif msg_type == 'track_name' and track_name is None:
+            track_name = msg.name
+
+    track_name = track_name.strip().lower() if track_name else ""
+    return track_name, track_event_count, has_channel_zero, is_drum
+
 def choose_melody_track(file_path):
     try:
-        midi_file = mido.MidiFile(file_path)
+        midi_file = load_midi(file_path)
     except Exception as e:
         print(f"Error reading MIDI file: {e}")
         return
@@ -35,19 +67,12 @@ def choose_melody_track(file_path):
     tracks_with_channel_zero = []
 
     for i, track in enumerate(midi_file.tracks):
-        track_event_count = 0
-        has_channel_zero = False
-        for msg in track:
-            if msg.type in ('note_on', 'note_off'):
-                if msg.channel == 0:
-                    has_channel_zero = True
-                track_event_count += 1
+        track_name, track_event_count, has_channel_zero, is_drum = track_statistics(track)
 
         # Memeriksa apakah track memiliki nama "voice"
-        track_name = track.name.strip().lower() if track.name else ""
         if track_name == "voice":
             voice_track = i
-        elif not is_drum_channel(track) and has_channel_zero:
+        elif not is_drum and has_channel_zero:
             tracks_with_channel_zero.append((i, track_event_count))
 
         track_event_counts.append((i, track_event_count))
@@ -74,28 +99,26 @@ def choose_melody_track(file_path):
         return None
 
 
-def fix_overlap_and_extract_melody(file_path, track_idx):
-
-    mid = mido.MidiFile(file_path)
-    main_track = mid.tracks[track_idx]
+def extract_melody(main_track):
     abs_time = 0
     temp = []
-    melody = []  # format (pitch, time, bool, velocity, abs_time)
+    melody = []  # format (pitch, time, bool, abs_time, velocity)
 
     for massage in main_track:
         abs_time = abs_time+massage.time # Always update abs_time with message time
-        if massage.type == 'note_on':
+        massage_type = massage.type
+        if massage_type == 'note_on':
             if len(temp) == 0:
                 pitch = massage.note
                 time = massage.time
                 velocity = massage.velocity
                 temp.append(pitch)
                 melody.append((pitch, time, True, abs_time, velocity))
-            elif len(temp) != 0 and massage.time == 0:
+            elif massage.time == 0:
                 if temp[0] < massage.note:
                     temp[0] = massage.note
                     melody[-1] = (temp[0], *melody[-1][1:])
-            elif len(temp) != 0 and massage.time != 0: 
+            else:
                 if abs(temp[0]- massage.note)< 11:
                     pitch = massage.note
                     time = massage.time
@@ -104,19 +127,22 @@ def fix_overlap_and_extract_melody(file_path, track_idx):
                     melody.append((pitch, 0, True, abs_time, velocity))
                     temp[0] = pitch
 
-        elif massage.type == 'note_off':
+        elif massage_type == 'note_off':
             if massage.note in temp and abs(massage.note - melody[-1][0]) < 11:
                 pitch = massage.note
                 velocity = massage.velocity
-                time = massage.time
                 # Hitung waktu relatif terhadap sebelumnya
                 time_relative_to_predessecor = abs_time - melody[-1][3]
                 melody.append((pitch, time_relative_to_predessecor, False, abs_time, velocity))
                 temp.pop()
-            
 
     return melody
-    
+
+def fix_overlap_and_extract_melody(file_path, track_idx):
+
+    mid = load_midi(file_path)
+    return extract_melody(mid.tracks[track_idx])
+
 def calculate_interval_between_windows(window):
     try:
         RTB = []
@@ -145,34 +171,28 @@ def calculate_cosine_similarity(vector1, vector2):
         print(f"Error in calculate_cosine_similarity: {e}")
         return 0
 
-def windowing_midi(interval_time, stride, melody):
-    try:
-
-        pointer = 0
-        result = []
-        window_start_time = melody[pointer][3]
-        start_temp = 0
-        panjangnya = len(melody)
-
-        while pointer < panjangnya:
-            temp = []
-            while pointer < panjangnya and melody[pointer][3] < window_start_time + interval_time:
-                temp.append((melody[pointer][0], melody[pointer][1], melody[pointer][2], melody[pointer][3]))
-                pointer += 1
+def window_bounds(abs_times, interval_time, stride):
+    '''first and one past the last note index of every window, the windows start at
+    the first note and move by stride until one reaches the end of the melody'''
 
- 
-            result.append(temp)
+    abs_times = np.asarray(abs_times)
+    if len(abs_times) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
 
-            if pointer >= panjangnya:
-                break
+    # the last window is the first one whose end passes the last note
+    span = abs_times[-1] - abs_times[0] - interval_time
+    n_windows = 1 if span < 0 else int(span // stride) + 2
 
-            window_start_time += stride
-            while melody[start_temp][3] < window_start_time:
-                start_temp += 1
-            pointer = start_temp
+    window_start_times = abs_times[0] + stride * np.arange(n_windows)
+    starts = np.searchsorted(abs_times, window_start_times, side='left')
+    ends = np.searchsorted(abs_times, window_start_times + interval_time, side='left')
+    return starts.astype(np.int64), ends.astype(np.int64)
 
-
-        return result
+def windowing_midi(interval_time, stride, melody):
+    try:
+        notes = [note[:4] for note in melody]
+        starts, ends = window_bounds([note[3] for note in notes], interval_time, stride)
+        return [notes[start:end] for start, end in zip(starts, ends)]
     except Exception as e:
         print(f"Error in windowing_midi: {e}")
         return []
@@ -204,73 +224,254 @@ def extract_features(window):
         return [], [], []
     
 
+ATB_BINS = 127
+RTB_BINS = 255
+FTB_BINS = 255
+
+def _histogram_bins(values, n_bins):
+    '''bin of every value for np.histogram with bins 1..n_bins+1, -1 when outside'''
+    values = np.asarray(values)
+    inside = (values >= 1) & (values <= n_bins + 1)
+    bins = np.where(inside, np.floor(values).astype(np.int64) - 1, -1)
+    # the last bin of np.histogram is closed on the right
+    bins[values == n_bins + 1] = n_bins - 1
+    return bins
+
+def _window_pairs(starts, ends, skip=0):
+    '''(window, note index) of every note of every window, skipping its first skip notes'''
+    first = starts + skip
+    lengths = np.maximum(ends - first, 0)
+    windows = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    indices = np.arange(lengths.sum()) - np.repeat(offsets - first, lengths)
+    return windows, indices
+
+def _window_histograms(windows, bins, n_windows, n_bins):
+    '''histogram of the bins of every window with a single bincount'''
+    valid = bins >= 0
+    counts = np.bincount(windows[valid] * n_bins + bins[valid], minlength=n_windows * n_bins)
+    return counts.reshape(n_windows, n_bins)
+
+def _normalize_rows(histograms):
+    totals = histograms.sum(axis=1, keepdims=True)
+    return np.divide(histograms, totals, out=np.zeros(histograms.shape), where=totals != 0)
+
+def melody_features(melody, interval_time, stride):
+    '''ATB, RTB and FTB histograms of every non empty window of a melody in one
+    (n_windows x 637) matrix, same values as extract_features on windowing_midi'''
+
+    n_features = ATB_BINS + RTB_BINS + FTB_BINS
+    if len(melody) == 0:
+        return np.zeros((0, n_features))
+
+    # (pitch, time, bool, abs_time), np.histogram of a window counts all four
+    notes = np.array([note[:4] for note in melody])
+    pitches = notes[:, 0]
+
+    starts, ends = window_bounds(notes[:, 3], interval_time, stride)
+    non_empty = ends > starts
+    starts, ends = starts[non_empty], ends[non_empty]
+    n_windows = len(starts)
+
+    windows, indices = _window_pairs(starts, ends)
+    note_bins = _histogram_bins(notes, ATB_BINS)
+    atb = _window_histograms(np.repeat(windows, 4), note_bins[indices].reshape(-1), n_windows, ATB_BINS)
+
+    # RTB and FTB are defined from the second note of the window on
+    windows, indices = _window_pairs(starts, ends, skip=1)
+    rtb = _window_histograms(windows, _histogram_bins(pitches[indices - 1] - pitches[indices], RTB_BINS), n_windows, RTB_BINS)
+    ftb = _window_histograms(windows, _histogram_bins(pitches[starts[windows]] - pitches[indices], FTB_BINS), n_windows, FTB_BINS)
+
+    return np.hstack((_normalize_rows(atb), _normalize_rows(rtb), _normalize_rows(ftb)))
+
+def split_features(features):
+    '''rows of a melody_features matrix as (atb, rtb, ftb) tuples'''
+    return [(row[:ATB_BINS], row[ATB_BINS:ATB_BINS + RTB_BINS], row[ATB_BINS + RTB_BINS:]) for row in features]
+
 def process_file(file_path):
-    track_idx= choose_melody_track(file_path)
-    melody = fix_overlap_and_extract_melody(file_path, track_idx)
-    
-    mid = MidiFile(file_path)
-    tpb = mid.ticks_per_beat
+    # the file is decoded once, track selection and melody extraction reuse it
+    try:
+        with metrics.span('parse_midi'):
+            mid = load_midi(file_path)
+    except Exception as e:
+        print(f"Error reading MIDI file: {e}")
+        return []
 
-    bpm = None
-    for i, track in enumerate(mid.tracks):
-        for msg in track:
-            # Mencari event tempo
-            if msg.type == 'set_tempo':
-                tempo = msg.tempo
-                bpm = 60000000 / tempo
-                break
-        if bpm is not None:
-            break 
+    with metrics.span('extract_melody'):
+        track_idx= choose_melody_track(mid)
+        melody = fix_overlap_and_extract_melody(mid, track_idx)
+
+    tpb = mid.ticks_per_beat
 
     interval_time = tpb * 40
     stride = tpb * 4
 
-    windows = windowing_midi(interval_time, stride, melody)  # Contoh interval dan stride
-    features = [extract_features(window) for window in windows if (len(window)>0)]
+    # all windows at once, empty windows are dropped like before
+    with metrics.span('window_features'):
+        features = split_features(melody_features(melody, interval_time, stride))
+    metrics.count('query_windows', len(features))
 
 
     return features
 
 
-# Function to convert WAV to MIDI
-def convert_wav_to_midi(wav_path, output_folder):
+# memory one transcription worker needs for its copy of the model and the audio it holds
+TRANSCRIPTION_WORKER_MEMORY = 1536 * 1024 * 1024
+
+# WAV files one worker task transcribes together, their windows share the model batches
+TRANSCRIPTION_GROUP = 8
+
+# basic_pitch model of this process, loaded once and reused for every file
+transcription_model = None
+
+def init_transcription_worker():
+    '''load the basic_pitch model once for this process (pool initializer)'''
+    global transcription_model
+    if transcription_model is None:
+        transcription_model = Model(ICASSP_2022_MODEL_PATH)
+    return transcription_model
+
+def available_memory():
+    '''bytes of physical memory currently available, None when it cannot be read'''
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        pass
+
+    # Windows has no sysconf
+    try:
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong), ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong), ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong), ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong), ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+    except (AttributeError, OSError):
+        pass
+    return None
+
+def transcription_workers(n_files, worker_memory=TRANSCRIPTION_WORKER_MEMORY):
+    '''number of transcription processes, bounded by the free memory rather than the core count'''
+    workers = min(n_files, multiprocessing.cpu_count())
+    memory = available_memory()
+    if memory is not None:
+        workers = min(workers, memory // worker_memory)
+    return max(1, int(workers))
+
+def transcription_cache_dir(folder_path):
+    '''transcriptions are cached next to the audio folder, not in it, so they are not ingested'''
+    return os.path.join(os.path.dirname(os.path.normpath(folder_path)), "transcription_cache")
+
+# Function to convert several WAV files to MIDI
+# the model is loaded once per process and the audio windows of all the files
+# go through it in stacked batches (stream_query.transcribe_streams)
+def convert_wav_group(wav_paths, output_folder):
     # Ensure the output folder exists
     os.makedirs(output_folder, exist_ok=True)
 
-    # Define output MIDI file path
-    midi_file_name = os.path.splitext(os.path.basename(wav_path))[0] + ".mid"
-    midi_path = os.path.join(output_folder, midi_file_name)
+    streams = [stream_query.file_stream(wav_path) for wav_path in wav_paths]
+    stream_query.transcribe_streams(streams)
+
+    midi_paths = []
+    for wav_path, stream in zip(wav_paths, streams):
+        midi_path = os.path.join(output_folder, os.path.splitext(os.path.basename(wav_path))[0] + ".mid")
+        midi_data = stream_query.stream_notes(stream)
+        if midi_data is None:
+            # too short for a single frame, the MIDI file has no notes
+            mido.MidiFile().save(midi_path)
+        else:
+            midi_data.write(midi_path)
+        midi_paths.append(midi_path)
+    return midi_paths
+
+# Function to convert WAV to MIDI
+def convert_wav_to_midi(wav_path, output_folder):
+    return convert_wav_group([wav_path], output_folder)[0]
+
+# Function to convert the WAV files of a folder in parallel
+# WAV files transcribed before (same content hash) are copied from the cache
+def convert_wavs(folder_path, wav_names, cache_dir=None):
+    wav_paths = [os.path.join(folder_path, filename) for filename in wav_names]
+    if not wav_paths:
+        return []
+
+    midi_output_folder = folder_path
+    if cache_dir is None:
+        cache_dir = transcription_cache_dir(folder_path)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    midi_paths = []
+    pending = []
+    duplicates = []
+    pending_hashes = set()
+    for wav_path in wav_paths:
+        cached_path = os.path.join(cache_dir, manifest.file_hash(wav_path) + ".mid")
+        midi_path = os.path.join(midi_output_folder, os.path.splitext(os.path.basename(wav_path))[0] + ".mid")
+        if os.path.isfile(cached_path):
+            shutil.copyfile(cached_path, midi_path)
+        elif cached_path in pending_hashes:
+            # same content as a file transcribed in this batch
+            duplicates.append((cached_path, midi_path))
+        else:
+            pending.append((wav_path, cached_path))
+            pending_hashes.add(cached_path)
+        midi_paths.append(midi_path)
+
+    print(f"Transcribing {len(pending)} WAV files, reusing {len(wav_paths) - len(pending)} earlier transcriptions")
+    if not pending:
+        return midi_paths
 
-    # Run Basic Pitch to convert WAV to MIDI
-    model_output, midi_data, note_events = predict(wav_path)
+    # Convert WAV files to MIDI
+    groups = [[wav_path for wav_path, _ in pending[first:first + TRANSCRIPTION_GROUP]]
+              for first in range(0, len(pending), TRANSCRIPTION_GROUP)]
+    workers = transcription_workers(len(groups))
+    arguments = [(group, midi_output_folder) for group in groups]
+    if workers == 1:
+        generated = [convert_wav_group(*argument) for argument in arguments]
+    else:
+        with multiprocessing.Pool(processes=workers, initializer=init_transcription_worker) as pool:
+            generated = pool.starmap(convert_wav_group, arguments)
+    generated = [midi_path for group in generated for midi_path in group]
 
-    # Save the MIDI data to the output path
-    midi_data.write(midi_path)
+    for midi_path, (_, cached_path) in zip(generated, pending):
+        shutil.copyfile(midi_path, cached_path)
+    for cached_path, midi_path in duplicates:
+        shutil.copyfile(cached_path, midi_path)
 
-    return midi_path
+    return midi_paths
 
 # Function to process several files in parallel
-def process_database(folder_path):
-    file_paths = [os.path.join(folder_path, filename) for filename in os.listdir(folder_path) if filename.endswith('.mid')] 
-    wav_paths = [os.path.join(folder_path, filename) for filename in os.listdir(folder_path) if filename.endswith('.wav')] 
-    
-    # print(wav_paths)
+# midi_names / wav_names restrict the work to those files of the folder
+def process_database(folder_path, midi_names=None, wav_names=None):
+    if wav_names is None:
+        wav_names = [filename for filename in os.listdir(folder_path) if filename.endswith('.wav')]
 
-    midi_output_folder = folder_path
+    convert_wavs(folder_path, wav_names)
 
-    # Convert WAV files to MIDI
-    with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-        midi_paths = pool.starmap(convert_wav_to_midi, [(wav_path, midi_output_folder) for wav_path in wav_paths]) 
+    # listed after the conversion so the MIDI files generated from WAV are included
+    if midi_names is None:
+        midi_names = [filename for filename in os.listdir(folder_path) if filename.endswith('.mid')]
+    file_paths = [os.path.join(folder_path, filename) for filename in midi_names]
+
+    if not file_paths:
+        return {}
 
     with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
         results = pool.map(process_file, file_paths)
-    
+
 
     file_features = {}
     for file_path, features in zip(file_paths, results):
         file_name = os.path.basename(file_path)
         file_features[file_name] = features
-    
+
     return file_features
 
 
@@ -302,6 +503,106 @@ def rank_best_match(hummed_feature, feature_in_dir, n_jobs=-1):
 
 
 
+# weights of the (atb, rtb, ftb) cosine similarities, same as rank_best_match
+FEATURE_WEIGHTS = (0.1, 0.45, 0.45)
+
+def query_vector(hummed_feature):
+    '''sum of the unit-normalized query windows for each of the (atb, rtb, ftb) blocks'''
+
+    # sum over query windows of cos(q, w) is (sum of unit q) . w / |w|, so the whole
+    # query collapses into one vector per block
+    vectors = []
+    for i, size in enumerate((127, 255, 255)):
+        total = np.zeros(size)
+        for feature in hummed_feature:
+            vector = np.nan_to_num(np.asarray(feature[i], dtype=np.float64))
+            norm = np.linalg.norm(vector)
+            if len(vector) == size and norm != 0:
+                total += vector / norm
+        vectors.append(total)
+    return vectors
+
+def window_scores(store, query, start=0, end=None, chunk_size=65536):
+    '''weighted similarity of every store window in rows start:end against the query vectors'''
+
+    if end is None:
+        end = audio_store.n_windows(store)
+
+    scores = np.zeros(end - start)
+    for chunk_start in range(start, end, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, end)
+        inv_norms = np.asarray(store['inv_norms'][chunk_start:chunk_end])
+        chunk_scores = scores[chunk_start - start:chunk_end - start]
+        for i, (block, weight) in enumerate(zip(('atb', 'rtb', 'ftb'), FEATURE_WEIGHTS)):
+            dots = audio_store.block_dot(store, block, query[i], chunk_start, chunk_end)
+            chunk_scores += weight * dots * inv_norms[:, i]
+    return scores
+
+def song_max(scores, offsets):
+    '''segmented max of the window scores, one value per song (-inf for songs without windows)'''
+
+    offsets = np.asarray(offsets)
+    result = np.full(len(offsets) - 1, float('-inf'))
+    non_empty = np.diff(offsets) > 0
+    if non_empty.any():
+        result[non_empty] = np.maximum.reduceat(scores, offsets[:-1][non_empty] - offsets[0])
+    return result
+
+def top_k_order(scores, k=None):
+    '''indices of the k best scores, ties in index order, same as the first k of a stable sort
+
+    Only the candidates at or above the k-th best score are sorted, the rest of
+    the catalogue is discarded with a partial selection.'''
+
+    if k is None or k >= len(scores):
+        return np.argsort(-scores, kind='stable')
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    threshold = scores[np.argpartition(-scores, k - 1)[:k]].min()
+    candidates = np.flatnonzero(scores >= threshold)
+    return candidates[np.argsort(-scores[candidates], kind='stable')][:k]
+
+def rank_store(hummed_feature, store, songs=None, query=None, top_k=None):
+    '''rank_best_match over an audio store, scored with a few matrix products instead of per pair calls
+
+    songs restricts the ranking to a shortlist of song indices, for example the
+    candidates of the approximate index, only their windows are scored. top_k
+    keeps only the best songs, songs without any window are left out.'''
+
+    if query is None:
+        query = query_vector(hummed_feature)
+    offsets = np.asarray(store['offsets'])
+
+    with metrics.span('score_windows'):
+        if songs is None:
+            songs = np.arange(len(offsets) - 1)
+            scores = song_max(window_scores(store, query), offsets)
+            metrics.count('windows_compared', offsets[-1] - offsets[0])
+        else:
+            songs = np.asarray(songs, dtype=np.int64)
+            windows = (offsets[songs + 1] - offsets[songs]).sum()
+            if 2 * windows > offsets[-1] - offsets[0]:
+                #most of the store is asked for, one scan beats a call per song
+                scores = song_max(window_scores(store, query), offsets)[songs]
+                metrics.count('windows_compared', offsets[-1] - offsets[0])
+            else:
+                scores = np.full(len(songs), float('-inf'))
+                for i, song in enumerate(songs):
+                    if offsets[song + 1] > offsets[song]:
+                        scores[i] = window_scores(store, query, offsets[song], offsets[song + 1]).max()
+                metrics.count('windows_compared', windows)
+    metrics.count('songs_scored', len(songs))
+
+    # songs without windows (unreadable or note-less files) cannot match, they are left out
+    matched = scores > float('-inf')
+    songs, scores = songs[matched], scores[matched]
+
+    # stable sort on the negated scores keeps ties in dataset order like rank_best_match
+    order = top_k_order(scores, top_k)
+    return {str(store['filenames'][songs[i]]): float(scores[i]) for i in order}
+
+
 # Fungsi untuk menyimpan hasil ke file JSON
 def save_to_npy(data, output_file):
     np.save(output_file, data)
@@ -0,0 +1,384 @@
+import numpy as np
+import argparse
+import json
+import os
+import re
+
+# Columnar on-disk store of the audio window features.
+#
+# <session>/audio_store/
+#     header.json      format version, generation, encoding and shapes, replaced last
+#     inv_norms.G.npy  float64 (n_windows, 3), 1 / L2 norm of each window block (0 for empty blocks)
+#     offsets.G.npy    int64 (n_songs + 1), windows of song i are rows offsets[i]:offsets[i+1]
+#     filenames.G.npy  unicode (n_songs,)
+#
+# dense encoding, one matrix per block:
+#     atb.G.npy        float32 (n_windows, 127)
+#     rtb.G.npy        float32 (n_windows, 255)
+#     ftb.G.npy        float32 (n_windows, 255)
+#
+# sparse encoding, CSR arrays per block (a 40 beat window only fills a few bins):
+#     <block>_indptr.G.npy   int64 (n_windows + 1)
+#     <block>_indices.G.npy  uint8 (nnz,), every block has less than 256 bins
+#     <block>_values.G.npy   float32 (nnz,)
+#
+# Every file is a plain .npy array, so the store opens with mmap_mode='r'
+# without unpickling anything and the pages are shared between readers.
+#
+# G is the generation named in the header. A save writes a new generation and
+# switches to it by replacing the header, the files a reader (the query
+# server) still maps are never rewritten. Generations older than the previous
+# one are removed by later saves, a file that is still mapped on Windows is
+# left for the next one.
+
+STORE_VERSION = 4
+
+# version 1 stores have no inv_norms.npy, they are computed when loading
+# versions before 3 are always dense, versions before 4 have no generation
+SUPPORTED_VERSIONS = (1, 2, 3, 4)
+
+ENCODINGS = ('dense', 'sparse')
+
+BLOCKS = (('atb', 127), ('rtb', 255), ('ftb', 255))
+
+SPARSE_ARRAYS = ('indptr', 'indices', 'values')
+
+def store_dir(dir_path: str) -> str:
+    '''path of the audio store of a session'''
+    return os.path.join(dir_path, "audio_store")
+
+def n_windows(store: dict) -> int:
+    '''number of windows over all songs'''
+    return int(store['offsets'][-1])
+
+def build_store(file_features: dict, encoding: str = 'dense') -> dict:
+    '''convert {filename: [(atb, rtb, ftb), ...]} into the columnar arrays'''
+
+    filenames = list(file_features.keys())
+    counts = [len(file_features[name]) for name in filenames]
+
+    offsets = np.zeros(len(filenames) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    store = {'version': STORE_VERSION, 'encoding': 'dense', 'filenames': np.array(filenames, dtype=str), 'offsets': offsets}
+    for block, size in BLOCKS:
+        store[block] = np.zeros((n_windows(store), size), dtype=np.float32)
+
+    row = 0
+    for name in filenames:
+        for feature in file_features[name]:
+            for (block, size), values in zip(BLOCKS, feature):
+                # windows that failed extraction are stored as zero rows,
+                # they never match anything just like before
+                if len(values) == size:
+                    store[block][row] = values
+            row += 1
+
+    store['inv_norms'] = inverse_norms(store)
+
+    if encoding == 'sparse':
+        store = to_sparse(store)
+    elif encoding != 'dense':
+        raise ValueError(f"encoding must be one of {ENCODINGS}")
+
+    return store
+
+def to_sparse(store: dict) -> dict:
+    '''re-encode a dense store as CSR arrays'''
+
+    if store['encoding'] == 'sparse':
+        return store
+
+    sparse = {key: value for key, value in store.items() if key not in dict(BLOCKS)}
+    sparse['encoding'] = 'sparse'
+    for block, _ in BLOCKS:
+        values = np.asarray(store[block])
+        rows, columns = np.nonzero(values)
+        indptr = np.zeros(len(values) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=len(values)))
+        sparse[block + '_indptr'] = indptr
+        sparse[block + '_indices'] = columns.astype(np.uint8)
+        sparse[block + '_values'] = values[rows, columns].astype(np.float32)
+    return sparse
+
+def to_dense(store: dict) -> dict:
+    '''re-encode a sparse store as one matrix per block'''
+
+    if store['encoding'] == 'dense':
+        return store
+
+    dense = {key: value for key, value in store.items() if not key.endswith(tuple('_' + array for array in SPARSE_ARRAYS))}
+    dense['encoding'] = 'dense'
+    for block, _ in BLOCKS:
+        dense[block] = block_rows(store, block, 0, n_windows(store))
+    return dense
+
+def _ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    '''concatenation of arange(start, start + length) for every pair'''
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    shifts = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+    return np.arange(total) + shifts
+
+def select_songs(store: dict, indices) -> dict:
+    '''copy of the store that only holds the songs at the given indices'''
+
+    indices = np.asarray(indices, dtype=np.int64)
+    offsets = store['offsets']
+    counts = offsets[indices + 1] - offsets[indices]
+    rows = _ranges(offsets[indices], counts)
+
+    selected = {'version': store['version'], 'encoding': store['encoding']}
+    selected['filenames'] = np.asarray(store['filenames'])[indices]
+    selected['offsets'] = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    selected['inv_norms'] = np.asarray(store['inv_norms'])[rows]
+
+    for block, size in BLOCKS:
+        if store['encoding'] == 'dense':
+            selected[block] = np.asarray(store[block])[rows].reshape(-1, size)
+        else:
+            indptr = np.asarray(store[block + '_indptr'])
+            lengths = indptr[rows + 1] - indptr[rows]
+            positions = _ranges(indptr[rows], lengths)
+            selected[block + '_indptr'] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+            selected[block + '_indices'] = np.asarray(store[block + '_indices'])[positions]
+            selected[block + '_values'] = np.asarray(store[block + '_values'])[positions]
+    return selected
+
+def concat_stores(first: dict, second: dict) -> dict:
+    '''songs of first followed by the songs of second, both stores must share the encoding'''
+
+    combined = {'version': STORE_VERSION, 'encoding': first['encoding']}
+    combined['filenames'] = np.concatenate([first['filenames'], second['filenames']]).astype(str)
+    combined['offsets'] = np.concatenate([first['offsets'], second['offsets'][1:] + first['offsets'][-1]])
+    combined['inv_norms'] = np.concatenate([first['inv_norms'], second['inv_norms']])
+
+    for block, _ in BLOCKS:
+        if first['encoding'] == 'dense':
+            combined[block] = np.concatenate([first[block], second[block]])
+        else:
+            indptr = first[block + '_indptr']
+            combined[block + '_indptr'] = np.concatenate([indptr, second[block + '_indptr'][1:] + indptr[-1]])
+            for array in ('indices', 'values'):
+                combined[block + '_' + array] = np.concatenate([first[block + '_' + array], second[block + '_' + array]])
+    return combined
+
+def update_store(store: dict, file_features: dict, removed, encoding: str = 'dense') -> dict:
+    '''drop the removed songs, replace or append the songs in file_features
+
+    Only the new features are converted, the rows of the songs that did not
+    change are copied from the existing store.'''
+
+    new_store = build_store(file_features, encoding)
+    if store is None:
+        return new_store
+
+    store = to_sparse(store) if encoding == 'sparse' else to_dense(store)
+
+    dropped = set(removed) | set(file_features)
+    keep = [i for i, name in enumerate(store['filenames']) if str(name) not in dropped]
+
+    return concat_stores(select_songs(store, keep), new_store)
+
+def block_rows(store: dict, block: str, start: int, end: int) -> np.ndarray:
+    '''dense float32 rows start:end of one block, whatever the encoding'''
+
+    if store['encoding'] == 'dense':
+        return np.asarray(store[block][start:end])
+
+    size = dict(BLOCKS)[block]
+    indptr = np.asarray(store[block + '_indptr'][start:end + 1])
+    rows = np.zeros((end - start, size), dtype=np.float32)
+    row_ids = np.repeat(np.arange(end - start), np.diff(indptr))
+    columns = store[block + '_indices'][indptr[0]:indptr[-1]]
+    rows[row_ids, columns] = store[block + '_values'][indptr[0]:indptr[-1]]
+    return rows
+
+def gather_rows(store: dict, block: str, rows: np.ndarray) -> np.ndarray:
+    '''dense float32 rows of one block at arbitrary row indices, whatever the encoding'''
+
+    rows = np.asarray(rows, dtype=np.int64)
+    if store['encoding'] == 'dense':
+        return np.asarray(store[block][rows])
+
+    size = dict(BLOCKS)[block]
+    indptr = np.asarray(store[block + '_indptr'])
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    positions = _ranges(starts, lengths)
+    dense = np.zeros((len(rows), size), dtype=np.float32)
+    dense[np.repeat(np.arange(len(rows)), lengths), store[block + '_indices'][positions]] = store[block + '_values'][positions]
+    return dense
+
+def _segment_sum(values: np.ndarray, indptr: np.ndarray) -> np.ndarray:
+    '''sum of values[indptr[i]:indptr[i+1]] for every row i'''
+    sums = np.zeros(len(indptr) - 1)
+    non_empty = indptr[:-1] < indptr[1:]
+    if non_empty.any():
+        sums[non_empty] = np.add.reduceat(values, indptr[:-1][non_empty] - indptr[0])
+    return sums
+
+def block_dot(store: dict, block: str, vector: np.ndarray, start: int, end: int) -> np.ndarray:
+    '''dot product of rows start:end of one block with vector, computed in float64'''
+
+    if store['encoding'] == 'dense':
+        return np.asarray(store[block][start:end], dtype=np.float64) @ vector
+
+    indptr = np.asarray(store[block + '_indptr'][start:end + 1])
+    indices = store[block + '_indices'][indptr[0]:indptr[-1]]
+    values = store[block + '_values'][indptr[0]:indptr[-1]]
+    return _segment_sum(values * vector[indices], indptr)
+
+def inverse_norms(store: dict) -> np.ndarray:
+    '''1 / norm of every window of every block, so scoring never has to normalize the database'''
+    inv_norms = np.zeros((n_windows(store), len(BLOCKS)))
+    for i, (block, _) in enumerate(BLOCKS):
+        if store['encoding'] == 'dense':
+            values = store[block]
+            norms = np.sqrt(np.einsum('ij,ij->i', values, values, dtype=np.float64))
+        else:
+            values = np.asarray(store[block + '_values'], dtype=np.float64)
+            norms = np.sqrt(_segment_sum(values * values, np.asarray(store[block + '_indptr'])))
+        np.divide(1, norms, out=inv_norms[:, i], where=norms != 0)
+    return inv_norms
+
+def memory_report(store: dict) -> dict:
+    '''bytes taken by the window features in the store encoding against a dense float32 store'''
+
+    windows = n_windows(store)
+    dense_bytes = windows * sum(size for _, size in BLOCKS) * np.dtype(np.float32).itemsize
+    if store['encoding'] == 'dense':
+        stored_bytes = dense_bytes
+    else:
+        stored_bytes = sum(store[block + '_' + array].nbytes for block, _ in BLOCKS for array in SPARSE_ARRAYS)
+
+    return {
+        'encoding': store['encoding'],
+        'n_windows': windows,
+        'dense_bytes': dense_bytes,
+        'stored_bytes': stored_bytes,
+        'saved_bytes': dense_bytes - stored_bytes,
+        'ratio': dense_bytes / stored_bytes if stored_bytes else 1.0,
+    }
+
+def array_path(path: str, name: str, generation: int = None) -> str:
+    '''file of an array of the store, stores saved before generations have no suffix'''
+    if generation is None:
+        return os.path.join(path, name + ".npy")
+    return os.path.join(path, f"{name}.{generation}.npy")
+
+def read_header(path: str) -> dict:
+    with open(os.path.join(path, "header.json"), 'r') as header_file:
+        return json.load(header_file)
+
+def remove_stale(path: str, generation: int):
+    '''remove the arrays of the generations before generation - 1, the ones still mapped are skipped'''
+    for name in os.listdir(path):
+        match = re.fullmatch(r"[a-z_]+(?:\.(\d+))?\.npy", name)
+        if match is None:
+            continue
+        #arrays of stores saved before generations count as generation -1
+        if (int(match.group(1)) if match.group(1) is not None else -1) < generation - 1:
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+
+def save_store(store: dict, path: str):
+    '''write the store arrays as a new generation, the header is replaced last so readers never see a partial store'''
+
+    os.makedirs(path, exist_ok=True)
+
+    header_path = os.path.join(path, "header.json")
+    generation = read_header(path).get('generation', -1) + 1 if os.path.exists(header_path) else 0
+
+    for block, _ in BLOCKS:
+        if store['encoding'] == 'dense':
+            np.save(array_path(path, block, generation), np.ascontiguousarray(store[block], dtype=np.float32))
+        else:
+            for array in SPARSE_ARRAYS:
+                np.save(array_path(path, f"{block}_{array}", generation), store[block + '_' + array])
+    np.save(array_path(path, "inv_norms", generation), store['inv_norms'])
+    np.save(array_path(path, "offsets", generation), store['offsets'])
+    np.save(array_path(path, "filenames", generation), store['filenames'])
+
+    header = {
+        'version': STORE_VERSION,
+        'generation': generation,
+        'encoding': store['encoding'],
+        'n_songs': len(store['filenames']),
+        'n_windows': n_windows(store),
+        'blocks': dict(BLOCKS),
+        'dtype': 'float32',
+    }
+    temporary_path = header_path + ".tmp"
+    with open(temporary_path, 'w') as header_file:
+        json.dump(header, header_file, indent=4)
+    os.replace(temporary_path, header_path)
+
+    remove_stale(path, generation)
+
+def load_store(path: str, mmap_mode: str = 'r') -> dict:
+    '''open a saved store, the feature arrays are memory-mapped by default'''
+
+    header = read_header(path)
+
+    if header['version'] not in SUPPORTED_VERSIONS:
+        raise ValueError(f"Unsupported audio store version {header['version']}, expected one of {SUPPORTED_VERSIONS}")
+
+    generation = header.get('generation')
+    store = {'version': header['version'], 'encoding': header.get('encoding', 'dense')}
+    for block, _ in BLOCKS:
+        if store['encoding'] == 'dense':
+            store[block] = np.load(array_path(path, block, generation), mmap_mode=mmap_mode)
+        else:
+            for array in SPARSE_ARRAYS:
+                store[block + '_' + array] = np.load(array_path(path, f"{block}_{array}", generation), mmap_mode=mmap_mode)
+    store['offsets'] = np.load(array_path(path, "offsets", generation))
+    store['filenames'] = np.load(array_path(path, "filenames", generation))
+
+    if header['version'] >= 2:
+        store['inv_norms'] = np.load(array_path(path, "inv_norms", generation), mmap_mode=mmap_mode)
+    else:
+        store['inv_norms'] = inverse_norms(store)
+
+    return store
+
+def is_store(path: str) -> bool:
+    '''a store is complete once its header exists'''
+    return os.path.isfile(os.path.join(path, "header.json"))
+
+def song_features(store: dict, index: int) -> list:
+    '''windows of one song in the (atb, rtb, ftb) tuple format of audio_retriev.process_file'''
+    start, end = int(store['offsets'][index]), int(store['offsets'][index + 1])
+    blocks = [block_rows(store, block, start, end) for block, _ in BLOCKS]
+    return [tuple(rows[row] for rows in blocks) for row in range(end - start)]
+
+def to_feature_dict(store: dict) -> dict:
+    '''back to the {filename: features} layout used by audio_retriev.rank_best_match'''
+    return {str(name): song_features(store, i) for i, name in enumerate(store['filenames'])}
+
+def convert_legacy(npy_path: str, path: str, encoding: str = 'dense') -> dict:
+    '''convert a pickled audio_features.npy into a store'''
+    file_features = np.load(npy_path, allow_pickle=True).item()
+    store = build_store(file_features, encoding)
+    save_store(store, path)
+    print(f"Converted {npy_path} to the audio store in {path}")
+    return store
+
+def main():
+    parser = argparse.ArgumentParser(description='convert the pickled audio features of a session into the audio store')
+
+    parser.add_argument('--session', type=str, required=True)
+    parser.add_argument('--encoding', type=str, choices=ENCODINGS, default='dense')
+
+    args = parser.parse_args()
+
+    dir_path = "public/temp_uploads/" + args.session
+
+    store = convert_legacy(dir_path + "/audio_features.npy", store_dir(dir_path), args.encoding)
+    print(memory_report(store))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import numpy as np
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+import audio_retriev as ar
+import audio_store
+import image_store
+import audio_index
+import quantize
+import manifest
+import retrieval
+import CBIR as cbir
+import synthetic_dataset
+
+# Timed ingest and query scenarios on synthetic sessions of several sizes.
+# Run from the project root:
+#
+#     python src/benchmark.py --sizes 1000 10000 --output bench.json
+#     python src/benchmark.py --sizes 1000 10000 --baseline bench.json
+#
+# The sessions are generated once in public/temp_uploads/bench_<size> and
+# reused. Results are written as JSON:
+#
+# {
+#     "version": 1,
+#     "created": "2024-01-01T00:00:00",
+#     "environment": {"python": "3.11.4", "numpy": "1.26.0", "platform": "...", "cpu_count": 8},
+#     "results": [{"scenario": "image_query", "size": 1000, "items": 1,
+#                  "runs": [0.12, 0.11], "median": 0.115, "min": 0.11, "max": 0.12}]
+# }
+#
+# With a baseline the medians of the scenarios both runs have are compared,
+# a scenario slower than the baseline by more than the tolerance is a
+# regression and the exit status is 1.
+
+BENCHMARK_VERSION = 1
+SIZES = (1000, 10000, 100000)
+SCENARIOS = ('ingest', 'image_query', 'process_file', 'rank_best_match', 'rank_store', 'query')
+
+# rank_best_match scores song by song in Python, larger sessions take minutes and are skipped
+RANK_BEST_MATCH_MAX_SIZE = 10000
+
+# files written by ingest and queries, removed before a cold ingest
+GENERATED_FILES = ("features.npy", "image_store", "pca_model.npz", "pca_codes.npz", "audio_features.npy",
+                   "audio_store", "audio_ivf.npz", "melody_intervals.npz", "mapper.sqlite", "query_cache",
+                   "results.json", "time.txt", "query_metrics.json", "ingest_metrics.json")
+
+def session_name(size: int) -> str:
+    return f"bench_{size}"
+
+def measure(function, repeat: int) -> dict:
+    '''wall-clock seconds of repeat calls of function'''
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        runs.append(time.perf_counter() - start)
+    return {'runs': runs, 'median': float(np.median(runs)), 'min': min(runs), 'max': max(runs)}
+
+def clear_session(dir_path: str):
+    '''remove everything ingest produced so the next one starts from scratch'''
+    for name in GENERATED_FILES + (os.path.basename(manifest.manifest_path(dir_path)),):
+        path = os.path.join(dir_path, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+def run_ingest(session: str):
+    datasetProcess = os.path.join(os.path.dirname(os.path.abspath(__file__)), "datasetProcess.py")
+    subprocess.run([sys.executable, datasetProcess, '--session', session], check=True, stdout=subprocess.DEVNULL)
+
+def bench_ingest(session: str, dir_path: str, args) -> tuple:
+    '''cold ingest of the whole session in a new process, like the upload route runs it'''
+    def ingest():
+        clear_session(dir_path)
+        run_ingest(session)
+    return 1, measure(ingest, 1)
+
+def bench_image_query(session: str, dir_path: str, args) -> tuple:
+    query_image_path = os.path.join(dir_path, "query", "image", "input.png")
+    return 1, measure(lambda: cbir.CBIR(image_store.store_dir(dir_path), query_image_path, (120, 120)), args.repeat)
+
+def bench_process_file(session: str, dir_path: str, args) -> tuple:
+    '''feature extraction of a sample of the songs, items is the sample size'''
+    audios_dir_path = os.path.join(dir_path, "audio")
+    names = sorted(name for name in os.listdir(audios_dir_path) if name.endswith('.mid'))[:args.sample_files]
+    paths = [os.path.join(audios_dir_path, name) for name in names]
+    return len(paths), measure(lambda: [ar.process_file(path) for path in paths], args.repeat)
+
+def bench_rank_best_match(session: str, dir_path: str, args) -> tuple:
+    store = audio_store.load_store(audio_store.store_dir(dir_path))
+    feature_in_dir = audio_store.to_feature_dict(store)
+    hummed_feature = ar.process_file(os.path.join(dir_path, "query", "audio", "input.mid"))
+    return 1, measure(lambda: ar.rank_best_match(hummed_feature, feature_in_dir), args.repeat)
+
+def bench_rank_store(session: str, dir_path: str, args) -> tuple:
+    store = audio_store.load_store(audio_store.store_dir(dir_path))
+    hummed_feature = ar.process_file(os.path.join(dir_path, "query", "audio", "input.mid"))
+    return 1, measure(lambda: ar.rank_store(hummed_feature, store), args.repeat)
+
+def bench_query(session: str, dir_path: str, args) -> tuple:
+    '''image and audio query through the loaded session, like the query server answers it, without the result cache'''
+    state = retrieval.load_session(dir_path)
+    return 1, measure(lambda: retrieval.run_query(state, nprobe=audio_index.NPROBE, shortlist=audio_index.SHORTLIST,
+                                                  image_rerank=quantize.RERANK, use_cache=False), args.repeat)
+
+BENCHMARKS = {
+    'ingest': bench_ingest,
+    'image_query': bench_image_query,
+    'process_file': bench_process_file,
+    'rank_best_match': bench_rank_best_match,
+    'rank_store': bench_rank_store,
+    'query': bench_query,
+}
+
+def environment() -> dict:
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+def run_benchmarks(sizes, scenarios, args) -> list:
+    results = []
+    for size in sizes:
+        session = session_name(size)
+        dir_path = retrieval.session_dir(session)
+        synthetic_dataset.generate_session(dir_path, size, args.seed)
+
+        #the query scenarios need an ingested session
+        if 'ingest' not in scenarios and not os.path.exists(manifest.manifest_path(dir_path)):
+            run_ingest(session)
+
+        for scenario in SCENARIOS:
+            if scenario not in scenarios:
+                continue
+            if scenario == 'rank_best_match' and size > RANK_BEST_MATCH_MAX_SIZE:
+                print(f"Skipping {scenario} on {size} items, above {RANK_BEST_MATCH_MAX_SIZE}")
+                continue
+            print(f"Running {scenario} on {size} items")
+            items, timing = BENCHMARKS[scenario](session, dir_path, args)
+            result = {'scenario': scenario, 'size': size, 'items': items, **timing}
+            print(f"{scenario} {size}: median {result['median']:.4f} s over {len(result['runs'])} runs")
+            results.append(result)
+    return results
+
+def compare(results: list, baseline: dict, tolerance: float = 0.2) -> list:
+    '''median of every scenario against the baseline, ratio over 1 + tolerance is a regression'''
+
+    previous = {(entry['scenario'], entry['size']): entry for entry in baseline['results']}
+    comparison = []
+    for result in results:
+        entry = previous.get((result['scenario'], result['size']))
+        if entry is None:
+            continue
+        #per item, the sample of process_file may have another size
+        current = result['median'] / max(result['items'], 1)
+        before = entry['median'] / max(entry['items'], 1)
+        ratio = current / before if before > 0 else float('inf')
+        comparison.append({
+            'scenario': result['scenario'],
+            'size': result['size'],
+            'baseline': before,
+            'current': current,
+            'ratio': ratio,
+            'regression': ratio > 1 + tolerance,
+        })
+    return comparison
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark ingest and queries on synthetic sessions')
+
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES), help='numbers of items of the sessions')
+    parser.add_argument('--scenarios', type=str, nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--repeat', type=int, default=5, help='runs of every query scenario, ingest runs once')
+    parser.add_argument('--sample-files', type=int, default=100, help='songs extracted by process_file')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic sessions')
+    parser.add_argument('--output', type=str, default=None, help='JSON file the results are written to')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown against the baseline reported as a regression')
+
+    args = parser.parse_args()
+
+    report = {
+        'version': BENCHMARK_VERSION,
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'environment': environment(),
+        'results': run_benchmarks(args.sizes, args.scenarios, args),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=4)
+        print(f"Results written to {args.output}")
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+
+        comparison = compare(report['results'], baseline, args.tolerance)
+        for entry in comparison:
+            status = "REGRESSION" if entry['regression'] else "ok"
+            print(f"{entry['scenario']} {entry['size']}: {entry['baseline']:.4f} s -> {entry['current']:.4f} s "
+                  f"({entry['ratio']:.2f}x) {status}")
+
+        if any(entry['regression'] for entry in comparison):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,13 @@
 import ImageProcessing as ip
 import audio_retriev as ar
+import CBIR as cbir
+import audio_store
+import image_store
+import audio_index
+import dtw
+import quantize
+import manifest
+import metrics
 import os
 import argparse
 
@@ -10,6 +18,14 @@ def main():
     parser = argparse.ArgumentParser(description='path to the dataset')
 
     parser.add_argument('--session', type=str, required=True)
+    parser.add_argument('--refit', action='store_true', help='refit the PCA model even if the dataset did not change')
+    parser.add_argument('--audio-encoding', type=str, choices=audio_store.ENCODINGS, default='dense', help='encoding of the audio window features')
+    parser.add_argument('--audio-index', action='store_true', help='build the approximate search index of the audio windows')
+    parser.add_argument('--nlist', type=int, default=None, help='number of clusters of the audio index, sqrt(windows) by default')
+    parser.add_argument('--image-codes', type=str, choices=quantize.KINDS, default=None, help='compress the PCA features of the images for search')
+    parser.add_argument('--metrics', action='store_true', help='write the stage timings and counters of the ingest to ingest_metrics.json')
+    parser.add_argument('--subspaces', type=int, default=None, help=f'number of groups of dimensions of the pq image codes, {quantize.N_SUBSPACES} by default')
+    parser.add_argument('--dtw', action='store_true', help='store the melody interval sequences the DTW rerank of audio queries uses')
 
     args = parser.parse_args()
 
@@ -20,8 +36,8 @@ def main():
     images_dir_path = dir_path + "/images"
     audios_dir_path = dir_path + "/audio"
 
-    output_features_path = dir_path + "/features.npy"
-    audio_features_path = dir_path + "/audio_features.npy"
+    legacy_features_path = dir_path + "/features.npy"
+    image_store_path = image_store.store_dir(dir_path)
 
     if not os.path.exists(dir_path):
         print(dir_path)
@@ -30,13 +46,106 @@ def main():
         print("Directory does not exist")
         exit()
 
-    if os.path.exists(output_features_path):
-        image_dataset, image_filenames = [], []
+    if args.metrics:
+        metrics.enable()
+    metrics.start('ingest')
+
+    #only files that are new or changed since the last run are processed
+    manifest_path = manifest.manifest_path(dir_path)
+    previous = manifest.load_manifest(manifest_path)
+
+    # images
+    if not image_store.is_store(image_store_path) and os.path.exists(legacy_features_path):
+        #dataset processed before the image store existed, its rows still match the manifest
+        image_store.convert_legacy(legacy_features_path, image_store_path)
+
+    previous_images = previous.get('images', {}) if image_store.is_store(image_store_path) else {}
+    with metrics.span('scan_images'):
+        current_images = manifest.scan_folder(images_dir_path, ip.IMAGE_EXTENSIONS, previous_images)
+    added, changed, removed = manifest.diff(previous_images, current_images)
+
+    if added or changed or removed or not image_store.is_store(image_store_path):
+        with metrics.span('preprocess_images'):
+            ip.update_preprocessed_images(images_dir_path, image_store_path, added + changed, removed, img_size=(120, 120))
+        metrics.count('images_preprocessed', len(added) + len(changed))
     else:
-        image_dataset, image_filenames = ip.preprocess_image_from_folder(images_dir_path, output_features_path, img_size=(120, 120))
+        print("Images unchanged, skipping preprocessing.")
+
+    #fit the PCA once here so image queries only have to project the query image
+    with metrics.span('pca'):
+        pca_state = cbir.load_or_fit_pca(image_store_path, refit=args.refit)
+
+    #codes that exist are kept in sync with the PCA model once they were asked for
+    codes_path = quantize.codes_path(dir_path)
+    codes = quantize.load_codes(codes_path, pca_state)
+    if args.image_codes or os.path.exists(codes_path):
+        kind = args.image_codes or quantize.saved_kind(codes_path)
+        if codes is None or str(codes['kind']) != kind or args.subspaces is not None:
+            with metrics.span('image_codes'):
+                codes = quantize.fit_codes(pca_state, kind, args.subspaces or quantize.N_SUBSPACES)
+                quantize.save_codes(codes_path, codes)
+        else:
+            print("Image codes unchanged.")
+        quantize.report(codes, pca_state['pca_features'])
+
+    # WAV files are converted to MIDI next to them, the MIDI files are picked up below
+    previous_wavs = previous.get('wav', {})
+    current_wavs = manifest.scan_folder(audios_dir_path, ('.wav',), previous_wavs)
+    added, changed, _ = manifest.diff(previous_wavs, current_wavs)
+    #a re-upload clears the generated MIDI files, those come back from the transcription cache
+    missing = [name for name in current_wavs if name not in added + changed
+               and not os.path.exists(os.path.join(audios_dir_path, os.path.splitext(name)[0] + ".mid"))]
+    with metrics.span('convert_wavs'):
+        ar.convert_wavs(audios_dir_path, added + changed + missing)
+    metrics.count('wavs_converted', len(added) + len(changed) + len(missing))
+
+    # audio
+    store_path = audio_store.store_dir(dir_path)
+    store = audio_store.load_store(store_path, mmap_mode=None) if audio_store.is_store(store_path) else None
+
+    previous_audio = previous.get('audio', {}) if store is not None else {}
+    with metrics.span('scan_audio'):
+        current_audio = manifest.scan_folder(audios_dir_path, ('.mid',), previous_audio)
+    added, changed, removed = manifest.diff(previous_audio, current_audio)
+
+    if store is None or added or changed or removed or store['encoding'] != args.audio_encoding:
+        with metrics.span('extract_audio_features'):
+            extracted_audio_features = ar.process_database(audios_dir_path, midi_names=added + changed, wav_names=[])
+        metrics.count('songs_extracted', len(extracted_audio_features))
+        with metrics.span('save_audio_store'):
+            store = audio_store.update_store(store, extracted_audio_features, removed, args.audio_encoding)
+            audio_store.save_store(store, store_path)
+        print(f"Audio store updated: {len(added)} added, {len(changed)} changed, {len(removed)} removed")
+    else:
+        print("Audio unchanged, skipping feature extraction.")
+
+    #an index that exists is kept in sync with the store once it was asked for
+    index_path = audio_index.index_path(dir_path)
+    if args.audio_index or os.path.exists(index_path):
+        if args.nlist is not None or audio_index.load_index(index_path, store) is None:
+            with metrics.span('audio_index'):
+                audio_index.save_index(index_path, audio_index.build_index(store, args.nlist))
+        else:
+            print("Audio index unchanged.")
+
+    #sequences that exist are kept in sync with the store once they were asked for
+    sequences_path = dtw.sequences_path(dir_path)
+    if args.dtw or os.path.exists(sequences_path):
+        if added or changed or removed or dtw.load_sequences(sequences_path, store) is None:
+            with metrics.span('melody_sequences'):
+                #only the new and changed songs are parsed again
+                sequences = dtw.build_sequences(store, audios_dir_path, dtw.read_sequences(sequences_path), added + changed)
+                dtw.save_sequences(sequences_path, sequences)
+        else:
+            print("Melody sequences unchanged.")
+
+    report = audio_store.memory_report(store)
+    print(f"Audio store: {report['n_windows']} windows, {report['stored_bytes']} bytes ({report['encoding']}), "
+          f"{report['saved_bytes']} bytes saved against dense float32 ({report['ratio']:.1f}x)")
+
+    manifest.save_manifest(manifest_path, {'images': current_images, 'audio': current_audio, 'wav': current_wavs})
 
-    extracted_audio_features = ar.process_database(audios_dir_path)
-    ar.save_to_npy(extracted_audio_features, audio_features_path)
+    metrics.finish(metrics.metrics_path(dir_path, 'ingest'))
 
     # print(image_dataset)
 
@@ -0,0 +1,153 @@
+import numpy as np
+
+METRICS = ('euclidean', 'cosine')
+
+def row_norms(X: np.ndarray) -> np.ndarray:
+    '''Euclidean norm of every row of X'''
+    return np.sqrt(np.einsum('ij,ij->i', X, X))
+
+def _partial_top_k(distances: np.ndarray, indices: np.ndarray, k: int):
+    '''keep the k smallest distances (unordered) with partial selection'''
+    if len(distances) <= k:
+        return distances, indices
+    keep = np.argpartition(distances, k - 1)[:k]
+    return distances[keep], indices[keep]
+
+def top_k(query: np.ndarray, features: np.ndarray, k: int = 10, metric: str = 'euclidean',
+          chunk_size: int = 8192, feature_norms: np.ndarray = None):
+    '''Find the k rows of features closest to query.
+
+    The dataset is scanned in blocks of chunk_size rows, every block costs one
+    matrix-vector product and a partial selection, so memory stays bounded by the
+    block size no matter how large the dataset is. Returns (indices, distances)
+    sorted from the closest match.'''
+
+    if metric not in METRICS:
+        raise ValueError(f"metric must be one of {METRICS}")
+
+    query = np.asarray(query, dtype=np.float64).reshape(-1)
+    n_samples = len(features)
+    k = min(k, n_samples)
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    query_norm = np.sqrt(query @ query)
+
+    best_distances = np.zeros(0)
+    best_indices = np.zeros(0, dtype=np.int64)
+
+    for start in range(0, n_samples, chunk_size):
+        block = np.asarray(features[start:start + chunk_size], dtype=np.float64)
+        if feature_norms is None:
+            norms = row_norms(block)
+        else:
+            norms = feature_norms[start:start + chunk_size]
+
+        dots = block @ query
+
+        if metric == 'euclidean':
+            #||x - q||^2 = ||x||^2 - 2 x.q + ||q||^2
+            distances = norms ** 2 - 2 * dots + query_norm ** 2
+            np.maximum(distances, 0, out=distances)
+        else:
+            denominator = norms * query_norm
+            similarity = np.divide(dots, denominator, out=np.zeros_like(dots), where=denominator != 0)
+            distances = 1 - similarity
+
+        indices = np.arange(start, start + len(block))
+        distances, indices = _partial_top_k(distances, indices, k)
+
+        best_distances, best_indices = _partial_top_k(
+            np.concatenate([best_distances, distances]),
+            np.concatenate([best_indices, indices]),
+            k,
+        )
+
+    if metric == 'euclidean':
+        #recompute the winners directly, the expanded form loses precision
+        difference = np.asarray(features[best_indices], dtype=np.float64) - query
+        best_distances = row_norms(difference)
+
+    #sort by distance, ties keep the dataset order
+    order = np.lexsort((best_indices, best_distances))
+    return best_indices[order], best_distances[order]
+
+# (dims, keep) of every prefilter stage of coarse_to_fine_top_k: rows are compared
+# on their first dims principal components and the keep closest go to the next stage
+STAGES = ((10, 1000), (30, 200))
+
+def _squared_distances(query: np.ndarray, features: np.ndarray, rows, start_dim: int, end_dim: int) -> np.ndarray:
+    '''squared euclidean distance between query and the given rows over the dimensions start_dim:end_dim'''
+    difference = np.asarray(features[rows, start_dim:end_dim], dtype=np.float64) - query[start_dim:end_dim]
+    return np.einsum('ij,ij->i', difference, difference)
+
+def coarse_to_fine_top_k(query: np.ndarray, features: np.ndarray, k: int = 10, stages=STAGES,
+                         exact: bool = True, chunk_size: int = 8192, leading_features: np.ndarray = None):
+    '''Find the k rows of features closest to query (euclidean), pruning on leading dimensions first.
+
+    Every row is compared on the first dims of the first stage only, each stage
+    keeps its keep closest rows and extends their distance to more dimensions,
+    the last shortlist is reranked at full dimension. On a PCA basis the leading
+    components carry most of the variance, so few true neighbours are lost.
+
+    The basis is orthonormal, so a distance over the first dimensions is a lower
+    bound of the full distance. With exact, every row whose bound is not over
+    the k-th distance found is also checked and the result is the one of top_k.
+
+    leading_features is an optional contiguous copy of the first columns of
+    features (at least the dims of the first stage), the first stage then reads
+    only those instead of striding over the full rows.
+    Returns (indices, distances) sorted from the closest match.'''
+
+    query = np.asarray(query, dtype=np.float64).reshape(-1)
+    n_samples, n_features = features.shape
+    k = min(k, n_samples)
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    stages = sorted((min(dims, n_features), max(keep, k)) for dims, keep in stages)
+    if not stages:
+        stages = [(n_features, k)]
+
+    #the first stage scans every row in blocks, its distances are kept as lower bounds
+    dims = stages[0][0]
+    if leading_features is None or leading_features.shape[1] < dims:
+        leading_features = features
+    bounds = np.empty(n_samples)
+    for start in range(0, n_samples, chunk_size):
+        bounds[start:start + chunk_size] = _squared_distances(query, leading_features, slice(start, start + chunk_size), 0, dims)
+
+    candidates = np.arange(n_samples)
+    distances = bounds
+    for stage_dims, keep in stages:
+        if stage_dims > dims:
+            distances = distances + _squared_distances(query, features, candidates, dims, stage_dims)
+            dims = stage_dims
+        distances, candidates = _partial_top_k(distances, candidates, keep)
+
+    #rerank the shortlist at full dimension
+    distances = distances + _squared_distances(query, features, candidates, dims, n_features)
+    scored = candidates
+    distances, candidates = _partial_top_k(distances, candidates, k)
+
+    if exact:
+        #rows pruned by a stage can only beat the k-th distance if their bound does
+        missed = bounds <= distances.max()
+        missed[scored] = False
+        missed = np.flatnonzero(missed)
+        if len(missed):
+            first_dims = stages[0][0]
+            missed_distances = bounds[missed] + _squared_distances(query, features, missed, first_dims, n_features)
+            distances, candidates = _partial_top_k(
+                np.concatenate([distances, missed_distances]),
+                np.concatenate([candidates, missed]),
+                k,
+            )
+
+    #recompute the winners directly like top_k
+    difference = np.asarray(features[candidates], dtype=np.float64) - query
+    distances = row_norms(difference)
+
+    #sort by distance, ties keep the dataset order
+    order = np.lexsort((candidates, distances))
+    return candidates[order], distances[order]
@@ -0,0 +1,279 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import argparse
+import multiprocessing
+import os
+import time
+import audio_retriev as ar
+import audio_store
+import metrics
+
+# Second stage of the audio search: the histogram shortlist is reranked with a
+# banded DTW between the interval sequence of the hummed melody and every
+# stretch of a song with as many intervals.
+#
+# The interval sequence of a melody is the pitch step between consecutive note
+# onsets of fix_overlap_and_extract_melody, a transposed humming gives the same
+# sequence. A song scores the distance of its closest stretch. The stretches
+# are ordered and pruned by their LB_Keogh bound against the envelope of the
+# query, the DTW of the others runs in batches and abandons a stretch as soon
+# as a row of its matrix is past the k-th best song. The rerank stops at its
+# time budget, the songs it did not reach keep their histogram order.
+#
+# <session>/melody_intervals.npz
+#     intervals  int16 (total intervals,), sequences of all songs one after the other
+#     offsets    int64 (n_songs + 1), sequence of song i is intervals[offsets[i]:offsets[i+1]]
+#     filenames  songs in store order, sequences of another store are not used
+
+SEQUENCES_VERSION = 1
+
+# default knobs: warping band in notes, songs ranked by DTW, histogram songs compared, seconds per query
+BAND = 3
+TOP_K = 5
+SHORTLIST = 100
+BUDGET = 0.05
+
+# stretches whose DTW is computed together, the first batches are smaller so a
+# threshold is known early
+FIRST_BATCH_SIZE = 64
+BATCH_SIZE = 1024
+
+# cost of the cells outside the band, finite so the cumulative sums of a row stay exact
+_OUTSIDE = 1e9
+
+def sequences_path(dir_path: str) -> str:
+    '''the sequences are saved next to the audio features of the session'''
+    return os.path.join(dir_path, "melody_intervals.npz")
+
+def melody_intervals(melody) -> np.ndarray:
+    '''pitch steps between consecutive note onsets of a melody'''
+    pitches = np.array([note[0] for note in melody if note[2]], dtype=np.int16)
+    return np.diff(pitches).astype(np.int16)
+
+def file_intervals(file_path: str) -> np.ndarray:
+    '''interval sequence of the melody track of a MIDI file, empty when it cannot be read'''
+    try:
+        mid = ar.load_midi(file_path)
+    except Exception as e:
+        print(f"Error reading MIDI file: {e}")
+        return np.zeros(0, dtype=np.int16)
+
+    track_idx = ar.choose_melody_track(mid)
+    if track_idx is None:
+        return np.zeros(0, dtype=np.int16)
+    return melody_intervals(ar.fix_overlap_and_extract_melody(mid, track_idx))
+
+def build_sequences(store: dict, folder_path: str, previous: dict = None, changed=()) -> dict:
+    '''interval sequences of the songs of a store, taken from previous for the files not in changed'''
+
+    known = {}
+    if previous is not None:
+        changed = set(changed)
+        offsets = previous['offsets']
+        known = {str(name): previous['intervals'][offsets[i]:offsets[i + 1]]
+                 for i, name in enumerate(previous['filenames']) if str(name) not in changed}
+
+    filenames = [str(name) for name in store['filenames']]
+    missing = [name for name in filenames if name not in known]
+    if missing:
+        with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
+            known.update(zip(missing, pool.map(file_intervals, [os.path.join(folder_path, name) for name in missing])))
+
+    sequences = [known[name] for name in filenames]
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(sequence) for sequence in sequences])
+    intervals = np.concatenate(sequences).astype(np.int16) if sequences else np.zeros(0, dtype=np.int16)
+
+    print(f"Melody sequences built: {len(missing)} songs extracted, {len(filenames) - len(missing)} kept")
+    return {'version': SEQUENCES_VERSION, 'filenames': np.array(filenames), 'offsets': offsets, 'intervals': intervals}
+
+def save_sequences(path: str, sequences: dict):
+    #the row lookup is rebuilt on load
+    np.savez(path, **{key: np.asarray(value) for key, value in sequences.items() if key != 'rows'})
+
+def read_sequences(path: str) -> dict:
+    '''saved sequences whatever store they were built for, None when there are none'''
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as data:
+        sequences = {key: data[key] for key in data.files}
+    if int(sequences['version']) != SEQUENCES_VERSION:
+        return None
+    return sequences
+
+def load_sequences(path: str, store: dict) -> dict:
+    '''load the sequences of a store, None when there are none or they were built for another store'''
+
+    if store is None:
+        return None
+    sequences = read_sequences(path)
+    if sequences is None:
+        return None
+    if not np.array_equal(sequences['filenames'].astype(str), np.asarray(store['filenames']).astype(str)):
+        print("Melody sequences do not match the audio store, ignoring them")
+        return None
+    return sequences
+
+def _rows(sequences: dict) -> dict:
+    if 'rows' not in sequences:
+        sequences['rows'] = {str(name): i for i, name in enumerate(sequences['filenames'])}
+    return sequences['rows']
+
+def envelope(query: np.ndarray, band: int) -> tuple:
+    '''upper and lower envelope of the query, max and min within band notes'''
+    windows = sliding_window_view(np.pad(query, band, mode='edge'), 2 * band + 1)
+    return windows.max(axis=1), windows.min(axis=1)
+
+def lb_terms(stretches: np.ndarray, upper: np.ndarray, lower: np.ndarray) -> np.ndarray:
+    '''distance of every interval of the stretches (rows) to the envelope, LB_Keogh is their sum'''
+    return np.maximum(stretches - upper, 0) + np.maximum(lower - stretches, 0)
+
+def lb_keogh(stretches: np.ndarray, upper: np.ndarray, lower: np.ndarray) -> np.ndarray:
+    '''lower bound of the banded DTW distance of every stretch (row) to the query of the envelope'''
+    return lb_terms(stretches, upper, lower).sum(axis=1)
+
+def banded_dtw(query: np.ndarray, intervals: np.ndarray, starts: np.ndarray, band: int, thresholds: np.ndarray,
+               envelopes: tuple = None) -> np.ndarray:
+    '''DTW distance (absolute step cost) between the query and the stretches intervals[start:start + len(query)]
+
+    Only the cells within band of the diagonal are kept, one row for all the
+    stretches at a time. In a row the horizontal step D[j] = min(T[j], c[j] + D[j-1])
+    is C[j] + running min of T - C, with C the cumulative cost of the row.
+    A stretch is abandoned, with distance inf, once the minimum of a row
+    reaches its threshold. With the (upper, lower) envelopes of intervals the
+    LB_Keogh terms of the query rows not computed yet are added to the row
+    minimum, every path still has to pay them.'''
+
+    m = len(query)
+    #column of every band cell of every row, cells past the stretch cost _OUTSIDE
+    cells = np.arange(m)[:, None] + np.arange(-band, band + 1)
+    costs = np.abs(intervals[starts[:, None, None] + np.clip(cells, 0, m - 1)] - query[:, None])
+    costs[:, (cells < 0) | (cells >= m)] = _OUTSIDE
+    cumulative_costs = np.cumsum(costs, axis=2)
+
+    #tails[:, i] bounds the cost of rows i and on
+    tails = np.zeros((len(starts), m + 1))
+    if envelopes is not None:
+        stretch = starts[:, None] + np.arange(m)
+        terms = lb_terms(query, envelopes[0][stretch], envelopes[1][stretch])
+        tails[:, :m] = np.cumsum(terms[:, ::-1], axis=1)[:, ::-1]
+
+    distances = np.full(len(starts), np.inf)
+    alive = np.arange(len(starts))
+    row = None
+    for i in range(m):
+        cost, cumulative = costs[alive, i], cumulative_costs[alive, i]
+        if i == 0:
+            #the path starts in the first cell of the first row
+            steps = np.where(cells[0] == 0, cost, _OUTSIDE)
+        else:
+            #diagonal from the same band position of the previous row, vertical from the next one
+            up = np.hstack((row[:, 1:], np.full((len(row), 1), _OUTSIDE)))
+            steps = cost + np.minimum(row, up)
+        row = np.minimum(cumulative + np.minimum.accumulate(steps - cumulative, axis=1), _OUTSIDE)
+
+        keep = row.min(axis=1) + tails[alive, i + 1] < thresholds[alive]
+        if not keep.all():
+            alive, row = alive[keep], row[keep]
+            if len(alive) == 0:
+                break
+
+    metrics.count('dtw_abandoned', len(starts) - len(alive))
+    if len(alive):
+        distances[alive] = row[:, band]
+    return distances
+
+def rerank(ranking: dict, query, sequences: dict, top_k: int = TOP_K, shortlist: int = SHORTLIST,
+           band: int = BAND, budget: float = BUDGET) -> dict:
+    '''reorder a histogram ranking (filename -> similarity, best first) with DTW
+
+    The top_k of the first shortlist songs with the smallest DTW distance to
+    the query intervals come first, every other song follows in its histogram
+    order, the similarities are kept. Songs with fewer intervals than the
+    query are not compared, neither are the stretches left once budget
+    seconds passed.'''
+
+    start_time = time.perf_counter()
+    query = np.asarray(query, dtype=np.float64)
+    m = len(query)
+    names = list(ranking)[:shortlist]
+    if m == 0 or not names or top_k <= 0 or budget <= 0:
+        return ranking
+    band = min(band, m - 1)
+
+    upper, lower = envelope(query, band)
+    rows = _rows(sequences)
+    offsets = sequences['offsets']
+
+    #the shortlisted songs long enough to hold the query, one after the other
+    picked = [(i, rows[name]) for i, name in enumerate(names)
+              if name in rows and offsets[rows[name] + 1] - offsets[rows[name]] >= m]
+    if not picked:
+        return ranking
+    sequences_of_songs = [sequences['intervals'][offsets[row]:offsets[row + 1]].astype(np.float64) for _, row in picked]
+    envelopes_of_songs = [envelope(sequence, band) for sequence in sequences_of_songs]
+    intervals = np.concatenate(sequences_of_songs)
+    song_envelopes = (np.concatenate([upper_of_song for upper_of_song, _ in envelopes_of_songs]),
+                      np.concatenate([lower_of_song for _, lower_of_song in envelopes_of_songs]))
+
+    #LB_Keogh both ways for every stretch: the stretch against the query envelope and
+    #the query against the song envelope, which holds the envelope of any of its stretches
+    songs, starts, bounds = [], [], []
+    begin = 0
+    for (i, _), sequence, (upper_of_song, lower_of_song) in zip(picked, sequences_of_songs, envelopes_of_songs):
+        n_stretches = len(sequence) - m + 1
+        bounds.append(np.maximum(lb_keogh(sliding_window_view(sequence, m), upper, lower),
+                                 lb_terms(query, sliding_window_view(upper_of_song, m), sliding_window_view(lower_of_song, m)).sum(axis=1)))
+        songs.append(np.full(n_stretches, i))
+        starts.append(begin + np.arange(n_stretches))
+        begin += len(sequence)
+    songs, starts, bounds = np.concatenate(songs), np.concatenate(starts), np.concatenate(bounds)
+    metrics.count('dtw_stretches', len(starts))
+
+    #smallest bounds first, the first matches found set a tight threshold for the others
+    order = np.argsort(bounds, kind='stable')
+    best = np.full(len(names), np.inf)
+    position = 0
+    batch_size = FIRST_BATCH_SIZE
+    while position < len(order):
+        if time.perf_counter() - start_time > budget:
+            metrics.count('dtw_budget_exceeded')
+            print("DTW rerank stopped at its time budget")
+            break
+
+        kth = np.partition(best, top_k - 1)[top_k - 1] if len(best) >= top_k else np.inf
+        if bounds[order[position]] >= kth:
+            #every stretch left is at least as far as the k-th song
+            break
+
+        batch = order[position:position + batch_size]
+        position += len(batch)
+        batch_size = min(2 * batch_size, BATCH_SIZE)
+
+        #a stretch is only worth computing if it can improve its song and bring it in the top k
+        thresholds = np.minimum(best[songs[batch]], kth)
+        useful = bounds[batch] < thresholds
+        batch, thresholds = batch[useful], thresholds[useful]
+        metrics.count('dtw_computed', len(batch))
+        np.minimum.at(best, songs[batch], banded_dtw(query, intervals, starts[batch], band, thresholds, song_envelopes))
+
+    top = [i for i in np.argsort(best, kind='stable')[:top_k] if np.isfinite(best[i])]
+    reranked = {names[i]: ranking[names[i]] for i in top}
+    for name, similarity in ranking.items():
+        if name not in reranked:
+            reranked[name] = similarity
+    return reranked
+
+def main():
+    parser = argparse.ArgumentParser(description='extract the melody interval sequences of the audio store for the DTW rerank')
+
+    parser.add_argument('--session', type=str, required=True)
+
+    args = parser.parse_args()
+
+    dir_path = "public/temp_uploads/" + args.session
+    store = audio_store.load_store(audio_store.store_dir(dir_path))
+    save_sequences(sequences_path(dir_path), build_sequences(store, os.path.join(dir_path, "audio")))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import numpy as np
+import argparse
+import hashlib
+import json
+import os
+import re
+
+# Pickle-free on-disk store of the preprocessed images.
+#
+# <session>/image_store/
+#     header.json      format version, generation, image size and count, replaced last
+#     pixels.G.npy     uint8 (n_images, width * height), grayscale rows
+#     filenames.G.npy  unicode (n_images,)
+#
+# pixels.G.npy opens with mmap_mode='r', loading is constant time and the pages
+# are shared between readers. Rows stay uint8 on disk, they are converted to
+# float only by the code that needs it (PCA fitting).
+#
+# G is the generation named in the header, like in the audio store. A save
+# writes a new generation and switches to it by replacing the header, the
+# pixels the query server still maps are never replaced. Generations older
+# than the previous one are removed by later saves.
+
+STORE_VERSION = 2
+
+# version 1 stores have no generation, their files have no suffix
+SUPPORTED_VERSIONS = (1, 2)
+
+def store_dir(dir_path: str) -> str:
+    '''path of the image store of a session'''
+    return os.path.join(dir_path, "image_store")
+
+def header_path(path: str) -> str:
+    return os.path.join(path, "header.json")
+
+def is_store(path: str) -> bool:
+    return os.path.isfile(header_path(path))
+
+def array_path(path: str, name: str, generation: int = None) -> str:
+    '''file of an array of the store, stores saved before generations have no suffix'''
+    if generation is None:
+        return os.path.join(path, name + ".npy")
+    return os.path.join(path, f"{name}.{generation}.npy")
+
+def read_header(path: str) -> dict:
+    with open(header_path(path), 'r') as header_file:
+        return json.load(header_file)
+
+def next_generation(path: str) -> int:
+    '''generation the next save writes'''
+    return read_header(path).get('generation', -1) + 1 if is_store(path) else 0
+
+def remove_stale(path: str, generation: int):
+    '''remove the arrays of the generations before generation - 1, the ones still mapped are skipped'''
+    for name in os.listdir(path):
+        match = re.fullmatch(r"[a-z_]+(?:\.(\d+))?\.npy", name)
+        if match is None:
+            continue
+        #arrays of stores saved before generations count as generation -1
+        if (int(match.group(1)) if match.group(1) is not None else -1) < generation - 1:
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+
+def create_pixels(path: str, n_images: int, img_size: tuple) -> np.ndarray:
+    '''writable memory map the rows of the next generation of the store are written into
+
+    Flush and drop every reference to it, then call save_store without pixels
+    to switch to it.'''
+    os.makedirs(path, exist_ok=True)
+    return np.lib.format.open_memmap(array_path(path, "pixels", next_generation(path)), mode='w+', dtype=np.uint8,
+                                     shape=(n_images, img_size[0] * img_size[1]))
+
+def save_store(path: str, filenames, img_size: tuple, pixels: np.ndarray = None) -> dict:
+    '''write the store as a new generation, the header is replaced last so readers never see a partial store
+
+    Without pixels, the rows written through create_pixels are used.'''
+
+    os.makedirs(path, exist_ok=True)
+    generation = next_generation(path)
+
+    if pixels is not None:
+        np.save(array_path(path, "pixels", generation), np.ascontiguousarray(pixels, dtype=np.uint8))
+    n_images = len(np.load(array_path(path, "pixels", generation), mmap_mode='r'))
+
+    np.save(array_path(path, "filenames", generation), np.asarray(filenames, dtype=str))
+
+    header = {
+        'version': STORE_VERSION,
+        'generation': generation,
+        'n_images': n_images,
+        'img_size': list(img_size),
+        'dtype': 'uint8',
+    }
+    temporary_path = header_path(path) + ".tmp"
+    with open(temporary_path, 'w') as header_file:
+        json.dump(header, header_file, indent=4)
+    os.replace(temporary_path, header_path(path))
+
+    remove_stale(path, generation)
+    return load_store(path)
+
+def load_store(path: str, mmap_mode: str = 'r') -> dict:
+    '''open a saved store, the pixels are memory-mapped by default'''
+
+    header = read_header(path)
+
+    if header['version'] not in SUPPORTED_VERSIONS:
+        raise ValueError(f"Unsupported image store version {header['version']}, expected one of {SUPPORTED_VERSIONS}")
+
+    generation = header.get('generation')
+    return {
+        'version': header['version'],
+        'img_size': tuple(header['img_size']),
+        'pixels': np.load(array_path(path, "pixels", generation), mmap_mode=mmap_mode),
+        'filenames': np.load(array_path(path, "filenames", generation)),
+    }
+
+def content_hash(path: str) -> str:
+    '''SHA-1 of the pixels and the filenames of the current generation of the store'''
+    generation = read_header(path).get('generation')
+    sha1 = hashlib.sha1()
+    for name in ("pixels", "filenames"):
+        with open(array_path(path, name, generation), 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+def convert_legacy(npy_path: str, path: str, img_size: tuple = (120, 120)) -> dict:
+    '''convert a pickled features.npy into a store'''
+    data = np.load(npy_path, allow_pickle=True).item()
+    store = save_store(path, data['filenames'], img_size, data['dataset'])
+    print(f"Converted {npy_path} to the image store in {path}")
+    return store
+
+def main():
+    parser = argparse.ArgumentParser(description='convert the pickled image features of a session into the image store')
+
+    parser.add_argument('--session', type=str, required=True)
+
+    args = parser.parse_args()
+
+    dir_path = "public/temp_uploads/" + args.session
+
+    store = convert_legacy(dir_path + "/features.npy", store_dir(dir_path))
+    print(f"Image store: {len(store['filenames'])} images of {store['img_size']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+
+# Per-session record of the files that were ingested, so datasetProcess only
+# extracts features for files that are new or changed since the last run.
+#
+# <session>/manifest.json
+# {
+#     "version": 1,
+#     "images": {"cover.png": {"size": 1234, "mtime": 1700000000.0, "sha1": "..."}},
+#     "audio": {"song.mid": {...}},
+#     "wav": {"song.wav": {...}}
+# }
+
+MANIFEST_VERSION = 1
+
+def manifest_path(dir_path: str) -> str:
+    '''path of the manifest of a session'''
+    return os.path.join(dir_path, "manifest.json")
+
+def file_hash(path: str) -> str:
+    '''SHA-1 of the file content'''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def load_manifest(path: str) -> dict:
+    '''load a manifest, an unreadable or missing one counts as empty'''
+    try:
+        with open(path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return {'version': MANIFEST_VERSION}
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {'version': MANIFEST_VERSION}
+    return manifest
+
+def save_manifest(path: str, manifest: dict):
+    '''write the manifest once the stores it describes have been saved'''
+    manifest['version'] = MANIFEST_VERSION
+    with open(path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+
+def scan_folder(folder_path: str, extensions: tuple, previous: dict = None) -> dict:
+    '''size, mtime and content hash of every file in the folder with one of the extensions
+
+    Files whose size and mtime did not change keep their previous hash, so an
+    unchanged dataset is not read again.'''
+
+    previous = previous or {}
+    entries = {}
+    if not os.path.isdir(folder_path):
+        return entries
+
+    for filename in sorted(os.listdir(folder_path)):
+        if not filename.endswith(extensions):
+            continue
+        filepath = os.path.join(folder_path, filename)
+        if not os.path.isfile(filepath):
+            continue
+        stat = os.stat(filepath)
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        old = previous.get(filename)
+        if old is not None and old['size'] == entry['size'] and old['mtime'] == entry['mtime']:
+            entry['sha1'] = old['sha1']
+        else:
+            entry['sha1'] = file_hash(filepath)
+        entries[filename] = entry
+
+    return entries
+
+def diff(previous: dict, current: dict):
+    '''names of the files that were added, changed (different content) and removed'''
+    added = [name for name in current if name not in previous]
+    changed = [name for name in current if name in previous and previous[name]['sha1'] != current[name]['sha1']]
+    removed = [name for name in previous if name not in current]
+    return added, changed, removed
@@ -0,0 +1,130 @@
+import argparse
+import contextlib
+import json
+import os
+import sqlite3
+import tempfile
+
+# SQLite index of the mapper of a session, so finding the songs of a cover or
+# the cover of a song is an index lookup instead of a scan of mapper.json.
+#
+# <session>/mapper.sqlite
+#     mapper(audio_file, pic_name)  one row per mapper.json entry, in file order (rowid),
+#                                   indexed on both columns
+#     meta(key, value)              version, size and mtime of the mapper.json it was built from
+#
+# mapper.json stays the uploaded file, results are written elsewhere. The index
+# is built by the upload route and rebuilt on open when mapper.json changed.
+
+INDEX_VERSION = 1
+
+# bound parameters per statement, below the SQLite limit of older builds
+BATCH_SIZE = 500
+
+def index_path(dir_path: str) -> str:
+    return os.path.join(dir_path, "mapper.sqlite")
+
+def mapper_path(dir_path: str) -> str:
+    return os.path.join(dir_path, "mapper.json")
+
+def _source(path: str) -> dict:
+    stat = os.stat(path)
+    return {'version': str(INDEX_VERSION), 'size': str(stat.st_size), 'mtime': repr(stat.st_mtime)}
+
+def build_index(dir_path: str) -> str:
+    '''build the index of the mapper.json of a session, returns its path'''
+
+    source_path = mapper_path(dir_path)
+    source = _source(source_path)
+    with open(source_path, 'r') as mapper_file:
+        mapper = json.load(mapper_file)
+
+    #written next to the index and moved in place, readers never see a partial index,
+    #every build has its own temporary file so concurrent uploads do not share one
+    path = index_path(dir_path)
+    handle, temporary_path = tempfile.mkstemp(dir=dir_path, prefix="mapper.", suffix=".sqlite.tmp")
+    os.close(handle)
+
+    try:
+        with contextlib.closing(sqlite3.connect(temporary_path)) as connection:
+            connection.execute("CREATE TABLE mapper (audio_file TEXT NOT NULL, pic_name TEXT NOT NULL)")
+            connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            connection.executemany("INSERT INTO mapper (audio_file, pic_name) VALUES (?, ?)",
+                                   ((entry['audio_file'], entry['pic_name']) for entry in mapper))
+            connection.executemany("INSERT INTO meta (key, value) VALUES (?, ?)", source.items())
+            connection.execute("CREATE INDEX mapper_audio ON mapper (audio_file)")
+            connection.execute("CREATE INDEX mapper_pic ON mapper (pic_name)")
+            connection.commit()
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+    print(f"Mapper index built: {len(mapper)} entries in {path}")
+    return path
+
+def is_current(dir_path: str) -> bool:
+    '''whether the index exists and was built from the current mapper.json'''
+    path = index_path(dir_path)
+    if not os.path.isfile(path):
+        return False
+    try:
+        with contextlib.closing(connect(path)) as connection:
+            meta = dict(connection.execute("SELECT key, value FROM meta"))
+    except sqlite3.DatabaseError:
+        return False
+    return meta == _source(mapper_path(dir_path))
+
+def open_index(dir_path: str) -> str:
+    '''path of the index of a session, built first when it is missing or stale'''
+    if not is_current(dir_path):
+        build_index(dir_path)
+    return index_path(dir_path)
+
+def connect(path: str) -> sqlite3.Connection:
+    return sqlite3.connect(path)
+
+def _batches(values: list):
+    for start in range(0, len(values), BATCH_SIZE):
+        yield values[start:start + BATCH_SIZE]
+
+def audios_for_pics(path: str, pic_names) -> dict:
+    '''songs of every cover, in mapper.json order'''
+    pic_names = list(dict.fromkeys(str(name) for name in pic_names))
+    audios = {name: [] for name in pic_names}
+    with contextlib.closing(connect(path)) as connection:
+        for batch in _batches(pic_names):
+            rows = connection.execute(
+                f"SELECT pic_name, audio_file FROM mapper WHERE pic_name IN ({','.join('?' * len(batch))}) ORDER BY rowid",
+                batch)
+            for pic_name, audio_file in rows:
+                audios[pic_name].append(audio_file)
+    return audios
+
+def pics_for_audios(path: str, audio_files) -> dict:
+    '''cover of every mapped song, the last mapper.json entry wins like a dict built from the file'''
+    audio_files = list(dict.fromkeys(str(name) for name in audio_files))
+    pics = {}
+    with contextlib.closing(connect(path)) as connection:
+        for batch in _batches(audio_files):
+            rows = connection.execute(
+                f"SELECT audio_file, pic_name FROM mapper WHERE audio_file IN ({','.join('?' * len(batch))}) ORDER BY rowid",
+                batch)
+            pics.update(rows)
+    return pics
+
+def mapped_audios(path: str) -> set:
+    '''every song that has a mapper entry'''
+    with contextlib.closing(connect(path)) as connection:
+        return {audio_file for (audio_file,) in connection.execute("SELECT DISTINCT audio_file FROM mapper")}
+
+def main():
+    parser = argparse.ArgumentParser(description='build the lookup index of the mapper of a session')
+
+    parser.add_argument('--session', type=str, required=True)
+
+    args = parser.parse_args()
+
+    build_index("public/temp_uploads/" + args.session)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+# Lightweight instrumentation of queries and ingests: nested timed spans,
+# counters and the peak resident memory of the process.
+#
+#     owner = metrics.start('query')
+#     with metrics.span('distance_scan'):
+#         metrics.count('images_scanned', n)
+#     if owner:
+#         metrics.finish(metrics.metrics_path(dir_path, 'query'))
+#
+# A recording belongs to the thread that started it, a start while one is
+# running is a no-op so the outermost caller owns the file. When metrics are
+# disabled span returns a shared null context and count returns at once.
+# Enable them with RETRIEVAL_METRICS=1 or enable() (the --metrics flags).
+#
+# <session>/<name>_metrics.json
+# {
+#     "name": "query",
+#     "total": 0.42,
+#     "peak_rss_bytes": 123456789,
+#     "counters": {"images_scanned": 1000, "songs_scored": 52},
+#     "spans": [{"name": "load_session", "duration": 0.3, "children": [...]}]
+# }
+
+enabled = os.environ.get('RETRIEVAL_METRICS') == '1'
+
+recording = threading.local()
+
+_DISABLED = contextlib.nullcontext()
+
+def enable(value: bool = True):
+    global enabled
+    enabled = value
+
+def metrics_path(dir_path: str, name: str) -> str:
+    '''the metrics are written in the session folder next to time.txt'''
+    return os.path.join(dir_path, f"{name}_metrics.json")
+
+def _current():
+    return getattr(recording, 'current', None)
+
+def start(name: str) -> bool:
+    '''start recording in this thread, False when disabled or already recording'''
+    if not enabled or _current() is not None:
+        return False
+    root = {'name': name, 'start': time.perf_counter(), 'children': []}
+    recording.current = {'root': root, 'stack': [root], 'counters': {}}
+    return True
+
+def span(name: str):
+    '''context manager timing a stage, nested in the stage it runs in'''
+    if _current() is None:
+        return _DISABLED
+    return _record_span(name)
+
+@contextlib.contextmanager
+def _record_span(name: str):
+    current = _current()
+    node = {'name': name, 'start': time.perf_counter(), 'children': []}
+    current['stack'][-1]['children'].append(node)
+    current['stack'].append(node)
+    try:
+        yield
+    finally:
+        node['duration'] = time.perf_counter() - node.pop('start')
+        current['stack'].pop()
+
+def count(name: str, value: int = 1):
+    '''add value to a counter of the current recording'''
+    current = _current()
+    if current is None:
+        return
+    current['counters'][name] = current['counters'].get(name, 0) + int(value)
+
+def peak_rss():
+    '''peak resident memory of the process in bytes, None when it cannot be read'''
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        pass
+
+    # Windows has no resource module
+    try:
+        import ctypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', ctypes.c_ulong), ('PageFaultCount', ctypes.c_ulong),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(PROCESS_MEMORY_COUNTERS)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    except (AttributeError, OSError):
+        pass
+    return None
+
+def _spans(node: dict) -> list:
+    return [{'name': child['name'], 'duration': round(child.get('duration', 0.0), 6), 'children': _spans(child)}
+            for child in node['children']]
+
+def finish(path: str = None) -> dict:
+    '''stop the recording of this thread, write it to path when given and return it'''
+    current = _current()
+    if current is None:
+        return None
+    recording.current = None
+
+    root = current['root']
+    report = {
+        'name': root['name'],
+        'total': round(time.perf_counter() - root['start'], 6),
+        'peak_rss_bytes': peak_rss(),
+        'counters': current['counters'],
+        'spans': _spans(root),
+    }
+
+    if path is not None:
+        with open(path, 'w') as metrics_file:
+            json.dump(report, metrics_file, indent=4)
+    return report
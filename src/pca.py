@@ -83,6 +83,85 @@ def svd_randomized(X: np.ndarray, n_components: int):
     else:
         return U[:, :n_components], s[:n_components], Vt[:n_components, :]
 
+def blocked_mean(X: np.ndarray, block_size: int = 4096) -> np.ndarray:
+    '''column mean of X read in row blocks, X can be a uint8 memory map'''
+    total = np.zeros(X.shape[1])
+    for start in range(0, X.shape[0], block_size):
+        total += np.sum(X[start:start + block_size], axis=0, dtype=np.float64)
+    return total / X.shape[0]
+
+def centered_product(X: np.ndarray, mean: np.ndarray, M: np.ndarray, block_size: int = 4096, dtype=np.float32) -> np.ndarray:
+    '''(X - mean) @ M without materializing X - mean, one row block of X at a time'''
+    M = M.astype(dtype, copy=False)
+    shift = np.asarray(mean, dtype=dtype) @ M
+    result = np.empty((X.shape[0], M.shape[1]), dtype=dtype)
+    for start in range(0, X.shape[0], block_size):
+        result[start:start + block_size] = np.asarray(X[start:start + block_size], dtype=dtype) @ M - shift
+    return result
+
+def centered_transpose_product(X: np.ndarray, mean: np.ndarray, N: np.ndarray, block_size: int = 4096, dtype=np.float32) -> np.ndarray:
+    '''(X - mean).T @ N without materializing X - mean, one row block of X at a time'''
+    N = N.astype(dtype, copy=False)
+    result = np.zeros((X.shape[1], N.shape[1]), dtype=dtype)
+    for start in range(0, X.shape[0], block_size):
+        result += np.asarray(X[start:start + block_size], dtype=dtype).T @ N[start:start + block_size]
+    result -= np.outer(mean, N.sum(axis=0, dtype=np.float64)).astype(dtype)
+    return result
+
+def svd_randomized_blocked(X: np.ndarray, mean: np.ndarray, n_components: int, block_size: int = 4096, dtype=np.float32):
+    '''randomized SVD of X - mean streaming row blocks of X, X can be a uint8 memory map
+
+    Same algorithm as svd_randomized, the centered matrix is only touched through
+    products with (n + d) x (k + oversamples) matrices, so the working memory is
+    those plus one block of rows in dtype.'''
+
+    #get n_samples and n_features from X.shape
+    n_samples, n_features = X.shape
+
+    #create a random_state array
+    random_state = np.random.mtrand._rand
+
+    n_oversamples = 10
+    n_random = n_components + n_oversamples
+
+    #determine the number of iterations
+    if (n_components < 0.1*min(X.shape)):
+        n_iter = 7
+    else:
+        n_iter = 4
+
+    # A is X - mean, or its transpose when there are fewer samples than features
+    transpose = n_samples < n_features
+    product = partial(centered_product, X, mean, block_size=block_size, dtype=dtype)
+    transpose_product = partial(centered_transpose_product, X, mean, block_size=block_size, dtype=dtype)
+    if transpose:
+        product, transpose_product = transpose_product, product
+
+    qr_normalizer = partial(linalg.qr, mode='economic', check_finite=True)
+    normalizer = partial(linalg.lu, permute_l=True, check_finite=False)
+
+    Q = np.asarray(random_state.normal(size=(n_samples if transpose else n_features, n_random))).astype(dtype)
+
+    # power iterations, then an orthonormal basis of the range of A
+    for _ in range(n_iter):
+        Q, _ = normalizer(product(Q))
+        Q, _ = normalizer(transpose_product(Q))
+    Q, _ = qr_normalizer(product(Q))
+
+    #B = Q.T @ A
+    B = transpose_product(Q).T
+
+    Uhat, s, Vt = linalg.svd(B, full_matrices=False, lapack_driver='gesdd')
+    del B
+
+    U = Q @ Uhat
+
+    #transpose back the results according to the input
+    if transpose:
+        return Vt[:n_components, :].T, s[:n_components], U[:, :n_components].T
+    else:
+        return U[:, :n_components], s[:n_components], Vt[:n_components, :]
+
 def svd_flip(u: np.ndarray,v: np.ndarray, u_based_decision=False):
     '''Sign correction to ensure deterministic output from SVD.'''
 
@@ -130,10 +209,89 @@ def fit_transform(X: np.ndarray, n_components: int):
     
     return U, Vt
 
+def fit_transform_blocked(X: np.ndarray, n_components: int, block_size: int = 4096, dtype=np.float32):
+    '''fit_transform of X - mean for a dataset that does not fit in memory as floats, also returns the mean'''
+
+    mean = blocked_mean(X, block_size)
+    U, S, Vt = svd_randomized_blocked(X, mean, n_components, block_size, dtype)
+    U, Vt = svd_flip(U, Vt, u_based_decision=False)
+
+    #assume no whitten process
+    U *= S[: n_components]
+
+    return U, Vt, mean
+
 def transform(X: np.ndarray, components: np.ndarray, mean):
     '''Transform the query data into the reduced dimension'''
 
     X_transformed = X @ components.T
     X_transformed -= np.reshape(mean, (1, -1)) @ components.T
 
-    return X_transformed
\ No newline at end of file
+    return X_transformed
+
+def incremental_mean(mean: np.ndarray, n_samples_seen: int, X_new: np.ndarray):
+    '''update the column mean with a new batch of rows'''
+    n_total = n_samples_seen + X_new.shape[0]
+    new_mean = (mean * n_samples_seen + X_new.sum(axis=0)) / n_total
+    return new_mean, n_total
+
+def partial_fit(mean: np.ndarray, components: np.ndarray, singular_values: np.ndarray, n_samples_seen: int,
+                X_new: np.ndarray, batch_size: int = None):
+    '''Update a fitted PCA with new rows without revisiting the old ones (incremental PCA of Ross et al.)
+
+    The old data is summarized by its singular values times its components, every
+    batch is stacked under that summary together with a mean correction row and
+    decomposed again, so the cost only depends on the batch size.'''
+
+    n_components = components.shape[0]
+    if batch_size is None:
+        batch_size = 5 * n_components
+
+    X_new = np.asarray(X_new)
+    for start in range(0, X_new.shape[0], batch_size):
+        X_batch = np.asarray(X_new[start:start + batch_size], dtype=np.float64)
+        n_batch = X_batch.shape[0]
+
+        batch_mean = np.mean(X_batch, axis=0)
+        new_mean, n_total = incremental_mean(mean, n_samples_seen, X_batch)
+
+        #the shift of the mean also carries variance
+        mean_correction = np.sqrt((n_samples_seen / n_total) * n_batch) * (mean - batch_mean)
+
+        X_stacked = np.vstack((
+            np.reshape(singular_values, (-1, 1)) * components,
+            X_batch - batch_mean,
+            mean_correction,
+        ))
+
+        U, S, Vt = linalg.svd(X_stacked, full_matrices=False, check_finite=False)
+        U, Vt = svd_flip(U, Vt, u_based_decision=False)
+
+        components = Vt[:n_components]
+        singular_values = S[:n_components]
+        mean = new_mean
+        n_samples_seen = n_total
+
+    return mean, components, singular_values, n_samples_seen
+
+def subspace_drift(old_components: np.ndarray, new_components: np.ndarray) -> float:
+    '''how far the principal subspace moved, 0 for the same subspace and 1 for an orthogonal one'''
+    overlap = old_components @ new_components.T
+    return float(1 - np.sum(overlap ** 2) / min(old_components.shape[0], new_components.shape[0]))
+
+def correct_features(pca_features: np.ndarray, old_mean: np.ndarray, old_components: np.ndarray,
+                     new_mean: np.ndarray, new_components: np.ndarray) -> np.ndarray:
+    '''re-project features of the old model into the updated one without the original rows
+
+    The rows are approximated by their reconstruction from the old model, exact for
+    the part of the data the old components captured.'''
+    return pca_features @ (old_components @ new_components.T) + np.reshape(old_mean - new_mean, (1, -1)) @ new_components.T
+
+def save_model(path: str, model: dict):
+    '''Save a fitted PCA model (mean, components, projected features) without pickling'''
+    np.savez(path, **model)
+
+def load_model(path: str) -> dict:
+    '''Load a PCA model saved with save_model'''
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
@@ -0,0 +1,289 @@
+import numpy as np
+import argparse
+import hashlib
+import os
+import pca as pcakw
+import distance
+import image_store
+
+# Compressed copy of the PCA features of the images, so a session can answer
+# image queries without keeping the float64 projections in memory.
+#
+# int8  every dimension is scaled to [-127, 127] around the middle of its range,
+#       one byte per dimension (8x smaller than float64)
+# pq    product quantization, the dimensions are cut in n_subspaces groups and
+#       every group is replaced by the index of its nearest of 256 centroids,
+#       one byte per group. Queries compare against the centroids once and
+#       sum table lookups (asymmetric distance)
+#
+# The shortlist of the compressed scan is reranked exactly by projecting its
+# images again from the uint8 image store.
+#
+# <session>/pca_codes.npz
+#     kind        'int8' or 'pq'
+#     codes       int8 (n_images, n_dims) or uint8 (n_images, n_subspaces)
+#     center, scale          float64 (n_dims,), int8 only
+#     codebooks, sub_offsets float32 (n_subspaces, 256, max group size), int64 (n_subspaces + 1), pq only
+#     model_hash  hash of the PCA model the codes were built for
+
+CODES_VERSION = 1
+KINDS = ('int8', 'pq')
+
+# images of the compressed shortlist reranked exactly, 0 keeps the approximate distances
+RERANK = 100
+N_SUBSPACES = 25
+N_CENTROIDS = 256
+
+def codes_path(dir_path: str) -> str:
+    '''the codes are saved next to the PCA model of the session'''
+    return os.path.join(dir_path, "pca_codes.npz")
+
+def model_hash(pca_state: dict) -> str:
+    '''hash of the components and mean of a PCA model and its number of images'''
+    sha1 = hashlib.sha1()
+    sha1.update(np.ascontiguousarray(pca_state['components']).tobytes())
+    sha1.update(np.ascontiguousarray(pca_state['mean']).tobytes())
+    sha1.update(str(len(pca_state['filenames'])).encode())
+    return sha1.hexdigest()
+
+def fit_int8(features: np.ndarray) -> dict:
+    '''per-dimension scalar quantization of the features to int8'''
+
+    low, high = features.min(axis=0), features.max(axis=0)
+    center = (high + low) / 2
+    scale = (high - low) / 254
+    #constant dimensions, any scale works
+    scale[scale == 0] = 1
+
+    codes = np.clip(np.rint((features - center) / scale), -127, 127).astype(np.int8)
+    return {'version': CODES_VERSION, 'kind': 'int8', 'codes': codes, 'center': center, 'scale': scale}
+
+def _kmeans(points: np.ndarray, n_clusters: int, n_iter: int, rng) -> np.ndarray:
+    '''Lloyd k-means, returns the centroids'''
+
+    centroids = points[rng.choice(len(points), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = _nearest(points, centroids)
+        counts = np.bincount(labels, minlength=n_clusters)
+        sums = np.stack([np.bincount(labels, weights=points[:, i], minlength=n_clusters)
+                         for i in range(points.shape[1])], axis=1)
+
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+        #clusters that lost all their points restart from a random point
+        empty = np.flatnonzero(~non_empty)
+        if len(empty):
+            centroids[empty] = points[rng.choice(len(points), len(empty))]
+    return centroids
+
+def _nearest(points: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    #argmin ||x - c||^2 = argmax x.c - ||c||^2 / 2
+    half_norms = 0.5 * np.einsum('ij,ij->i', centroids, centroids)
+    return np.argmax(points @ centroids.T - half_norms, axis=1)
+
+def fit_pq(features: np.ndarray, n_subspaces: int = N_SUBSPACES, n_centroids: int = N_CENTROIDS,
+           n_iter: int = 20, sample_size: int = 50000, chunk_size: int = 65536, seed: int = 0) -> dict:
+    '''product quantization of the features, one byte per group of dimensions'''
+
+    n_images, n_dims = features.shape
+    n_subspaces = max(1, min(n_subspaces, n_dims))
+    n_centroids = max(1, min(n_centroids, N_CENTROIDS, n_images))
+    sub_offsets = np.linspace(0, n_dims, n_subspaces + 1).astype(np.int64)
+    max_size = int(np.max(np.diff(sub_offsets)))
+
+    rng = np.random.default_rng(seed)
+    sample = features[np.sort(rng.choice(n_images, min(n_images, sample_size), replace=False))]
+
+    #groups smaller than the largest one are padded with zeros, that adds nothing to the distances
+    codebooks = np.zeros((n_subspaces, n_centroids, max_size), dtype=np.float32)
+    codes = np.zeros((n_images, n_subspaces), dtype=np.uint8)
+    for j in range(n_subspaces):
+        start, end = sub_offsets[j], sub_offsets[j + 1]
+        centroids = _kmeans(sample[:, start:end], n_centroids, n_iter, rng)
+        codebooks[j, :, :end - start] = centroids
+        for row in range(0, n_images, chunk_size):
+            codes[row:row + chunk_size, j] = _nearest(features[row:row + chunk_size, start:end], centroids)
+
+    return {'version': CODES_VERSION, 'kind': 'pq', 'codes': codes, 'codebooks': codebooks, 'sub_offsets': sub_offsets}
+
+def fit_codes(pca_state: dict, kind: str = 'int8', n_subspaces: int = N_SUBSPACES) -> dict:
+    '''compress the PCA features of a fitted model'''
+
+    if kind not in KINDS:
+        raise ValueError(f"kind must be one of {KINDS}")
+
+    features = pca_state['pca_features']
+    codes = fit_int8(features) if kind == 'int8' else fit_pq(features, n_subspaces)
+    codes['model_hash'] = model_hash(pca_state)
+    return codes
+
+def approximate_distances(codes: dict, query: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    '''approximate squared euclidean distance between the query and every compressed image'''
+
+    query = np.asarray(query, dtype=np.float64).reshape(-1)
+    n_images = len(codes['codes'])
+    distances = np.empty(n_images)
+
+    if str(codes['kind']) == 'int8':
+        #||q - (center + scale c)||^2 = sum scale^2 ((q - center) / scale - c)^2
+        #                            = ||r||^2 - 2 (scale^2 r').c + sum scale^2 c^2, r = q - center, r' = r / scale
+        weights = (codes['scale'] ** 2).astype(np.float32)
+        if 'code_norms' not in codes:
+            #only depends on the codes, computed once per loaded codes
+            codes['code_norms'] = np.concatenate([
+                (codes['codes'][start:start + chunk_size].astype(np.float32) ** 2) @ weights
+                for start in range(0, n_images, chunk_size)]) if n_images else np.zeros(0, dtype=np.float32)
+
+        residual = query - codes['center']
+        weighted_query = (residual / codes['scale']).astype(np.float32) * weights
+        for start in range(0, n_images, chunk_size):
+            dots = codes['codes'][start:start + chunk_size].astype(np.float32) @ weighted_query
+            distances[start:start + chunk_size] = codes['code_norms'][start:start + chunk_size] - 2 * dots
+        distances += residual @ residual
+        return np.maximum(distances, 0, out=distances)
+
+    #distance of every query group to every centroid of its subspace, then one lookup per group
+    codebooks, sub_offsets = codes['codebooks'], codes['sub_offsets']
+    n_subspaces, _, max_size = codebooks.shape
+    query_groups = np.zeros((n_subspaces, 1, max_size), dtype=np.float32)
+    for j in range(n_subspaces):
+        query_groups[j, 0, :sub_offsets[j + 1] - sub_offsets[j]] = query[sub_offsets[j]:sub_offsets[j + 1]]
+    tables = np.sum((codebooks - query_groups) ** 2, axis=2)
+
+    for start in range(0, n_images, chunk_size):
+        block = codes['codes'][start:start + chunk_size]
+        total = np.zeros(len(block), dtype=np.float32)
+        for j in range(n_subspaces):
+            total += tables[j].take(block[:, j])
+        distances[start:start + chunk_size] = total
+    return distances
+
+def search(codes: dict, query: np.ndarray, k: int = 10, rerank: int = RERANK, exact_rows=None):
+    '''Find the k images closest to query on their compressed features.
+
+    exact_rows maps image indices to their exact PCA features, the rerank
+    closest images of the compressed scan are reranked with it. Without it
+    or with rerank 0 the approximate distances are returned. Returns
+    (indices, distances) sorted from the closest match.'''
+
+    query = np.asarray(query, dtype=np.float64).reshape(-1)
+    approximate = approximate_distances(codes, query)
+    k = min(k, len(approximate))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    indices = np.arange(len(approximate))
+    if exact_rows is None or rerank <= 0:
+        distances, indices = distance._partial_top_k(approximate, indices, k)
+        distances = np.sqrt(np.maximum(distances, 0))
+    else:
+        _, indices = distance._partial_top_k(approximate, indices, max(rerank, k))
+        indices = np.sort(indices)
+        distances = distance.row_norms(exact_rows(indices) - query)
+        distances, indices = distance._partial_top_k(distances, indices, k)
+
+    #sort by distance, ties keep the dataset order
+    order = np.lexsort((indices, distances))
+    return indices[order], distances[order]
+
+def memory_report(codes: dict) -> dict:
+    '''bytes taken by the codes against the float64 PCA features'''
+
+    n_images = len(codes['codes'])
+    if str(codes['kind']) == 'int8':
+        n_dims = codes['codes'].shape[1]
+        extra_bytes = codes['center'].nbytes + codes['scale'].nbytes
+    else:
+        n_dims = int(codes['sub_offsets'][-1])
+        extra_bytes = codes['codebooks'].nbytes + codes['sub_offsets'].nbytes
+    float_bytes = n_images * n_dims * np.dtype(np.float64).itemsize
+    stored_bytes = codes['codes'].nbytes + extra_bytes
+
+    return {
+        'kind': str(codes['kind']),
+        'n_images': n_images,
+        'float_bytes': float_bytes,
+        'stored_bytes': stored_bytes,
+        'ratio': float_bytes / stored_bytes if n_images else 0.0,
+    }
+
+def recall_at_k(codes: dict, features: np.ndarray, k: int = 10, rerank: int = RERANK,
+                n_queries: int = 100, seed: int = 0) -> float:
+    '''share of the exact k nearest images found by the compressed search, dataset rows are the queries'''
+
+    n_images = len(features)
+    if n_images == 0:
+        return 1.0
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(n_images, min(n_queries, n_images), replace=False)
+
+    found = 0
+    expected = 0
+    for i in queries:
+        exact, _ = distance.top_k(features[i], features, k)
+        approximate, _ = search(codes, features[i], k, rerank, lambda rows: features[rows])
+        found += len(np.intersect1d(exact, approximate))
+        expected += len(exact)
+    return found / expected
+
+def report(codes: dict, features: np.ndarray, rerank: int = RERANK):
+    '''print the compression ratio and the recall@10 of the codes with and without rerank'''
+    memory = memory_report(codes)
+    print(f"Image codes: {memory['n_images']} images, {memory['stored_bytes']} bytes ({memory['kind']}), "
+          f"{memory['ratio']:.1f}x smaller than float64 features")
+    print(f"Recall@10: {recall_at_k(codes, features, 10, 0):.3f} compressed, "
+          f"{recall_at_k(codes, features, 10, rerank):.3f} with a rerank of {rerank}")
+
+def save_codes(path: str, codes: dict):
+    #code_norms is recomputed on load
+    np.savez(path, **{key: np.asarray(value) for key, value in codes.items() if key != 'code_norms'})
+
+def saved_kind(path: str) -> str:
+    '''kind of the codes saved at path, even stale ones'''
+    with np.load(path) as data:
+        return str(data['kind'])
+
+def load_codes(path: str, pca_state: dict) -> dict:
+    '''load the codes of a PCA model, None when there are none or they were built for another model'''
+
+    if pca_state is None or not os.path.isfile(path):
+        return None
+    with np.load(path) as data:
+        codes = {key: data[key] for key in data.files}
+
+    if int(codes['version']) != CODES_VERSION:
+        return None
+    if str(codes['model_hash']) != model_hash(pca_state):
+        print("Image codes do not match the PCA model, ignoring them")
+        return None
+    return codes
+
+def attach_codes(pca_state: dict, codes: dict, image_store_path: str):
+    '''answer the queries of a loaded PCA state from codes, the float64 features are dropped
+
+    The reranked images are projected again from the memory-mapped image store.'''
+
+    pca_state['codes'] = codes
+    pca_state['pixels'] = image_store.load_store(image_store_path)['pixels']
+    for key in ('pca_features', 'feature_norms', 'leading_features'):
+        pca_state.pop(key, None)
+
+def main():
+    parser = argparse.ArgumentParser(description='compress the PCA features of the images of a session')
+
+    parser.add_argument('--session', type=str, required=True)
+    parser.add_argument('--kind', type=str, choices=KINDS, default='int8')
+    parser.add_argument('--subspaces', type=int, default=N_SUBSPACES, help='number of groups of dimensions of pq')
+    parser.add_argument('--rerank', type=int, default=RERANK, help='images reranked exactly for the recall report')
+
+    args = parser.parse_args()
+
+    dir_path = "public/temp_uploads/" + args.session
+    pca_state = pcakw.load_model(os.path.join(dir_path, "pca_model.npz"))
+
+    codes = fit_codes(pca_state, args.kind, args.subspaces)
+    save_codes(codes_path(dir_path), codes)
+    report(codes, pca_state['pca_features'], args.rerank)
+
+if __name__ == "__main__":
+    main()
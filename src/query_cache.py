@@ -0,0 +1,111 @@
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+
+# On-disk cache of query results and query intermediates of a session, so a
+# repeated query against an unchanged dataset skips the PCA projection and
+# the audio scoring.
+#
+# <session>/query_cache/
+#     version.txt            dataset version the entries were computed for
+#     results_<key>.json     ranked results of a query
+#     <name>_<hash>.npy      intermediates (projected query image, hummed window features)
+#
+# Result keys hash the query files and the query parameters, the dataset
+# version is checked once when the cache is opened and the whole cache is
+# dropped when it changed. Entries are touched when read, the least recently
+# used ones are evicted once the cache is over its size limit.
+
+CACHE_SIZE = 64 * 1024 * 1024
+
+def cache_dir(dir_path: str) -> str:
+    return os.path.join(dir_path, "query_cache")
+
+def dataset_version(session: dict) -> str:
+    '''hash of the modification times of the files a loaded session was built from'''
+    return hashlib.sha1(json.dumps(session['signature']).encode()).hexdigest()
+
+def open_cache(dir_path: str, version: str) -> str:
+    '''path of the cache of a session, emptied when it was filled for another dataset version'''
+
+    path = cache_dir(dir_path)
+    version_path = os.path.join(path, "version.txt")
+    if os.path.isfile(version_path):
+        with open(version_path, 'r') as version_file:
+            if version_file.read() == version:
+                return path
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+    os.makedirs(path, exist_ok=True)
+    with open(version_path, 'w') as version_file:
+        version_file.write(version)
+    return path
+
+def result_key(image_hash: str, audio_hash: str, params: dict) -> str:
+    '''key of the results of a query, None hashes stand for a missing query file'''
+    key = json.dumps({'image': image_hash, 'audio': audio_hash, 'params': params}, sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def _hit(path: str) -> bool:
+    if not os.path.isfile(path):
+        return False
+    #the modification time is the last use
+    os.utime(path)
+    return True
+
+def _write(path: str, write):
+    '''write through a temporary file so a concurrent reader never sees half an entry'''
+    temporary_path = path + ".tmp"
+    with open(temporary_path, 'wb') as file:
+        write(file)
+    os.replace(temporary_path, path)
+
+def evict(path: str, max_bytes: int = CACHE_SIZE):
+    '''remove the least recently used entries until the cache fits in max_bytes'''
+
+    entries = []
+    for entry in os.scandir(path):
+        if entry.is_file() and entry.name != "version.txt":
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def load_results(path: str, key: str) -> list:
+    '''cached results of a query, None on a miss'''
+    results_path = os.path.join(path, f"results_{key}.json")
+    if not _hit(results_path):
+        return None
+    with open(results_path, 'r') as results_file:
+        return json.load(results_file)
+
+def save_results(path: str, key: str, results: list, max_bytes: int = CACHE_SIZE):
+    _write(os.path.join(path, f"results_{key}.json"),
+           lambda file: file.write(json.dumps(results, separators=(',', ':'), allow_nan=False).encode()))
+    evict(path, max_bytes)
+
+def cached_array(path: str, name: str, file_hash: str, compute, max_bytes: int = CACHE_SIZE) -> np.ndarray:
+    '''intermediate array of a query file, computed and stored on a miss, computed only without a cache'''
+
+    if path is None:
+        return compute()
+
+    array_path = os.path.join(path, f"{name}_{file_hash}.npy")
+    if _hit(array_path):
+        return np.load(array_path)
+
+    array = np.asarray(compute())
+    _write(array_path, lambda file: np.save(file, array))
+    evict(path, max_bytes)
+    return array
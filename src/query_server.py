@@ -0,0 +1,154 @@
+import os
+import threading
+from typing import Optional
+import time
+import numpy as np
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from starlette.concurrency import run_in_threadpool
+import retrieval
+import audio_index
+import dtw
+import stream_query
+
+# long-lived query service, keeps every session that has been queried in memory
+# so a search does not pay for interpreter startup and dataset loading again
+# run from the project root with: python -m uvicorn --app-dir src query_server:app
+
+app = FastAPI()
+
+sessions = {}
+# sessions_lock guards the two dicts, a session lock is held while that session loads
+# so a slow cold load only blocks the queries of its own session
+session_locks = {}
+sessions_lock = threading.Lock()
+
+def session_lock(session_id: str) -> threading.Lock:
+    with sessions_lock:
+        return session_locks.setdefault(session_id, threading.Lock())
+
+def get_session(session_id: str) -> dict:
+    '''return the in-memory session, reloading it when its files changed on disk'''
+
+    # the session id comes from a cookie, never let it escape temp_uploads
+    if not session_id or os.path.basename(session_id) != session_id or session_id in (".", ".."):
+        raise HTTPException(status_code=400, detail="Invalid session ID")
+
+    dir_path = retrieval.session_dir(session_id)
+    if not os.path.isdir(dir_path):
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    with session_lock(session_id):
+        with sessions_lock:
+            session = sessions.get(session_id)
+        if session is None or session['signature'] != retrieval.session_signature(dir_path):
+            #release the memory maps of the old files before mapping the new generation
+            with sessions_lock:
+                sessions.pop(session_id, None)
+            session = None
+            session = retrieval.load_session(dir_path)
+            with sessions_lock:
+                sessions[session_id] = session
+        return session
+
+def check_paging(top_k: int, page: int, per_page: int):
+    '''top_k, page and per_page start at 1, a query over HTTP always keeps at most top_k results'''
+    if top_k < 1 or page < 1 or per_page < 1:
+        raise HTTPException(status_code=400, detail="top_k, page and per_page must be at least 1")
+
+@app.get("/health")
+def health():
+    return {"success": True, "sessions": len(sessions)}
+
+@app.get("/query")
+def query(session: str, nprobe: int = audio_index.NPROBE, shortlist: int = audio_index.SHORTLIST,
+          top_k: int = retrieval.TOP_K, page: int = 1, per_page: int = 10, image_exact: bool = True, cache: bool = True,
+          image_candidates: int = retrieval.IMAGE_CANDIDATES, audio_candidates: int = retrieval.AUDIO_CANDIDATES,
+          order: str = 'image', fusion_weight: Optional[float] = None, dtw_budget: float = dtw.BUDGET):
+    if order not in retrieval.ORDERS:
+        raise HTTPException(status_code=400, detail=f"order must be one of {retrieval.ORDERS}")
+    check_paging(top_k, page, per_page)
+    state = get_session(session)
+    results = retrieval.run_query(state, nprobe=nprobe, shortlist=shortlist, top_k=top_k, page=page, per_page=per_page,
+                                  image_exact=image_exact, use_cache=cache, image_candidates=image_candidates,
+                                  audio_candidates=audio_candidates, order=order, fusion_weight=fusion_weight,
+                                  dtw_budget=dtw_budget)
+    return {"success": True, **results}
+
+def provisional_results(state: dict, stream: dict, top_k: int, nprobe: int, shortlist: int) -> list:
+    '''rank the songs against the melody transcribed so far'''
+    features = stream_query.stream_features(stream)
+    ranking = retrieval.rank_audio(state, features, top_k, nprobe, shortlist)
+    return retrieval.audio_results(state, ranking)
+
+def final_results(state: dict, stream: dict, start_time: float, top_k: int, per_page: int, nprobe: int,
+                  shortlist: int, dtw_budget: float, cache: bool) -> dict:
+    '''answer the transcribed melody like /query, straight from memory, None when no note was heard'''
+    midi_file = stream_query.stream_midi(stream)
+    if midi_file is None:
+        return None
+
+    return retrieval.run_query(state, start_time, nprobe=nprobe, shortlist=shortlist, top_k=top_k,
+                               per_page=per_page, use_cache=cache, dtw_budget=dtw_budget,
+                               query_melody=retrieval.melody_query(midi_file))
+
+# streaming humming query: the client sends mono float32 little-endian PCM chunks
+# as binary messages and the text message "end" when the recording stops. A
+# provisional top-k is sent back every time a model window is transcribed. On
+# "end" the melody is answered by run_query like /query (DTW rerank, result
+# cache, results.json), together with the query image when one is uploaded.
+# The melody never goes through a MIDI file on disk.
+# Backend only: the recorder (MicrophoneParse.tsx) still records a whole WAV and
+# uploads it through /api/upload-audio. This service listens on localhost and
+# Next.js route handlers cannot proxy a WebSocket, so wiring the recorder needs
+# a custom server or an exposed query service first.
+@app.websocket("/stream")
+async def stream(websocket: WebSocket, session: str, sample_rate: int = stream_query.AUDIO_SAMPLE_RATE,
+                 top_k: int = retrieval.TOP_K, per_page: int = 10, nprobe: int = audio_index.NPROBE,
+                 shortlist: int = audio_index.SHORTLIST, dtw_budget: float = dtw.BUDGET, cache: bool = True):
+    try:
+        check_paging(top_k, 1, per_page)
+        state = get_session(session)
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=e.detail)
+        return
+
+    await websocket.accept()
+    if state['audio_store'] is None:
+        await websocket.send_json({"success": False, "message": "Session has no audio dataset"})
+        await websocket.close()
+        return
+
+    query_stream = stream_query.new_stream(sample_rate)
+    try:
+        while True:
+            message = await websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                return
+
+            if message.get('bytes') is not None:
+                samples = np.frombuffer(message['bytes'], dtype='<f4')
+                if await run_in_threadpool(stream_query.add_audio, query_stream, samples):
+                    results = await run_in_threadpool(provisional_results, state, query_stream, per_page, nprobe, shortlist)
+                    await websocket.send_json({"success": True, "final": False, "total": len(results), "results": results})
+
+            elif message.get('text') == 'end':
+                start_time = time.time()
+                await run_in_threadpool(stream_query.finish, query_stream)
+                results = await run_in_threadpool(final_results, state, query_stream, start_time, top_k, per_page,
+                                                  nprobe, shortlist, dtw_budget, cache)
+                if results is None:
+                    await websocket.send_json({"success": False, "final": True, "message": "No melody was transcribed"})
+                else:
+                    await websocket.send_json({"success": True, "final": True, **results,
+                                               "time": round(time.time() - start_time, 2)})
+                await websocket.close()
+                return
+    except WebSocketDisconnect:
+        return
+
+@app.delete("/session")
+def drop_session(session: str):
+    #waits for a load of the session in progress, its maps are released too
+    with session_lock(session), sessions_lock:
+        dropped = sessions.pop(session, None) is not None
+    return {"success": True, "dropped": dropped}
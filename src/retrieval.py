@@ -1,172 +1,442 @@
-import ImageProcessing as ip
 import os
 import argparse
-from CBIR import CBIR
+import hashlib
+import CBIR as cbir
 import audio_retriev as ar
+import audio_store
+import image_store
+import audio_index
+import dtw
+import distance
+import quantize
+import metrics
+import manifest
+import query_cache
+import mapper_index
 import json
 import numpy as np
-import pandas as pd
 import time
 
-def main():
-    isImage = False
-    isAudio = False
-
-    #set the timer at start of the program
-    start_time = time.time()
+# results kept per query, a few pages of the UI, the rest is never looked at
+TOP_K = 50
 
-    parser = argparse.ArgumentParser(description='Process query image to dataset')
+# candidate set sizes of a combined image and audio query, see rank_combined
+IMAGE_CANDIDATES = 10
+AUDIO_CANDIDATES = 100
+ORDERS = ('auto', 'image', 'audio')
 
-    parser.add_argument('--session', type=str, required=True)
-
-    args = parser.parse_args()
+def session_dir(session_id: str) -> str:
+    '''path of the session upload folder'''
+    return "public/temp_uploads/" + session_id
 
-    dir_path = args.session
+def session_signature(dir_path: str):
+    '''modification times of the files a loaded session depends on'''
+    signature = []
+    for name in ("features.npy", "image_store/header.json", "pca_model.npz", "audio_features.npy", "audio_store/header.json", "audio_ivf.npz", "pca_codes.npz", "melody_intervals.npz", "mapper.json"):
+        path = os.path.join(dir_path, name)
+        signature.append(os.path.getmtime(path) if os.path.isfile(path) else None)
+    return tuple(signature)
 
-    dir_path = "public/temp_uploads/" + dir_path
-
-    #define the path to the dataset
-    images_dir_path = dir_path + "/images"
+def load_session(dir_path: str) -> dict:
+    '''load the dataset, features and mapper of a session into memory'''
 
     #define the path to the features
     image_features_path = dir_path + "/features.npy"
     audio_features_path = dir_path + "/audio_features.npy"
 
-    #transform the query image
-    query_image_path = dir_path + "/query/image/input.png"
-    query_audio_path = dir_path + "/query/audio/input.mid"
-
-    #define the path to the mapper
-    mapper_path = dir_path + "/mapper.json"
-
-    # Load the mapper.json
-    with open(mapper_path, 'r') as mapper_file:
-        mapper = json.load(mapper_file)
-
-    if os.path.isfile(query_image_path):
-        isImage = True
+    session = {
+        'dir_path': dir_path,
+        'signature': session_signature(dir_path),
+        'pca_state': None,
+        'audio_store': None,
+        'audio_index': None,
+        'sequences': None,
+    }
+
+    #lookups go through the index of mapper.json, built here for sessions uploaded before it existed
+    with metrics.span('load_mapper'):
+        session['mapper_index'] = mapper_index.open_index(dir_path)
+
+    image_store_path = image_store.store_dir(dir_path)
+    if not image_store.is_store(image_store_path) and os.path.isfile(image_features_path):
+        #dataset processed before the image store existed
+        with metrics.span('convert_image_features'):
+            image_store.convert_legacy(image_features_path, image_store_path)
+    if image_store.is_store(image_store_path):
+        with metrics.span('load_pca'):
+            session['pca_state'] = cbir.load_or_fit_pca(image_store_path)
+
+        #optional compressed image features built at ingest, they replace the float ones in memory
+        with metrics.span('load_image_codes'):
+            codes = quantize.load_codes(quantize.codes_path(dir_path), session['pca_state'])
+            if codes is not None:
+                quantize.attach_codes(session['pca_state'], codes, image_store_path)
+
+    audio_store_path = audio_store.store_dir(dir_path)
+    with metrics.span('load_audio_store'):
+        if audio_store.is_store(audio_store_path):
+            session['audio_store'] = audio_store.load_store(audio_store_path)
+        elif os.path.isfile(audio_features_path):
+            #dataset processed before the audio store existed
+            session['audio_store'] = audio_store.convert_legacy(audio_features_path, audio_store_path)
+
+    #optional approximate index built at ingest, exhaustive search without it
+    with metrics.span('load_audio_index'):
+        session['audio_index'] = audio_index.load_index(audio_index.index_path(dir_path), session['audio_store'])
+
+    #optional melody sequences stored at ingest, the audio ranking is not reranked without them
+    with metrics.span('load_melody_sequences'):
+        session['sequences'] = dtw.load_sequences(dtw.sequences_path(dir_path), session['audio_store'])
+
+    return session
+
+def results_path(dir_path: str) -> str:
+    '''path of the result file of the last query of a session'''
+    return os.path.join(dir_path, "results.json")
+
+def mapped_songs(session: dict) -> np.ndarray:
+    '''indices of the store songs that have an entry in the mapper, computed once per loaded session'''
+    if 'mapped_songs' not in session:
+        mapped = mapper_index.mapped_audios(session['mapper_index'])
+        filenames = session['audio_store']['filenames']
+        session['mapped_songs'] = np.array([i for i, name in enumerate(filenames) if str(name) in mapped], dtype=np.int64)
+    return session['mapped_songs']
+
+def rank_audio(session: dict, hummed_feature, top_k: int = None, nprobe: int = audio_index.NPROBE,
+               shortlist: int = audio_index.SHORTLIST, mapped_only: bool = True) -> dict:
+    '''rank the songs of the session against the window features of a hummed query'''
+
+    query = ar.query_vector(hummed_feature)
+    candidates = None
+    if session['audio_index'] is not None and top_k is not None and top_k <= shortlist:
+        #only the songs shortlisted by the index are scored exactly, a longer
+        #ranking than the shortlist (or all of it) is scored without the index
+        candidates = audio_index.candidate_songs(session['audio_index'], session['audio_store'], query, nprobe, shortlist)
+
+    #songs without a mapper entry are never shown, the best k are taken among the others
+    songs = mapped_songs(session) if mapped_only else None
+    if candidates is not None:
+        shortlisted = candidates if songs is None else np.intersect1d(songs, candidates)
+        #the probed lists can hold fewer songs than asked for, the page would come up short
+        if len(shortlisted) >= top_k:
+            songs = shortlisted
+    return ar.rank_store(hummed_feature, session['audio_store'], songs, query, top_k)
+
+def rerank_audio(session: dict, ranking: dict, query_audio_path: str, dtw_shortlist: int = dtw.SHORTLIST,
+                 dtw_budget: float = dtw.BUDGET, cache_path: str = None, audio_hash: str = None,
+                 query_melody: dict = None) -> dict:
+    '''rerank the head of a histogram ranking with DTW on the melody intervals (see dtw.rerank)'''
+    if session['sequences'] is None or dtw_budget <= 0:
+        return ranking
+    with metrics.span('dtw_rerank'):
+        if query_melody is not None:
+            query = query_melody['intervals']
+        else:
+            query = query_cache.cached_array(cache_path, 'intervals', audio_hash, lambda: dtw.file_intervals(query_audio_path))
+        return dtw.rerank(ranking, query, session['sequences'], shortlist=dtw_shortlist, budget=dtw_budget)
+
+def audio_results(session: dict, ranking: dict) -> list:
+    '''result entries of an audio only query, songs without a mapper entry are skipped'''
+    audio_to_image_map = mapper_index.pics_for_audios(session['mapper_index'], ranking.keys())
+    return [{
+        'audio_file': audio_file,
+        'pic_name': audio_to_image_map[audio_file],
+        'audio_similarity': similarity,
+        'image_distance': None  # No associated image
+    } for audio_file, similarity in ranking.items() if audio_file in audio_to_image_map]
+
+def write_results(dir_path: str, combined_results: list):
+    '''the results go to their own compact file, mapper.json is left untouched'''
+    with open(results_path(dir_path), 'w') as results_file:
+        json.dump({'total': len(combined_results), 'results': combined_results}, results_file, separators=(',', ':'), allow_nan=False)
+    print(f"{len(combined_results)} results written to {results_path(dir_path)}")
+
+def hummed_matrix(hummed_feature: list) -> np.ndarray:
+    '''window features of process_file as one (windows x 637) matrix, ar.split_features turns it back'''
+    return np.array([np.concatenate(feature) for feature in hummed_feature]).reshape(-1, ar.ATB_BINS + ar.RTB_BINS + ar.FTB_BINS)
+
+def song_rows(session: dict) -> dict:
+    '''store index of every song filename, computed once per loaded session'''
+    if 'song_rows' not in session:
+        session['song_rows'] = {str(name): i for i, name in enumerate(session['audio_store']['filenames'])}
+    return session['song_rows']
+
+def image_rows(session: dict) -> dict:
+    '''row of every dataset image in the PCA state, computed once per loaded session'''
+    if 'image_rows' not in session:
+        session['image_rows'] = {str(name): i for i, name in enumerate(session['pca_state']['filenames'])}
+    return session['image_rows']
+
+def query_costs(session: dict, nprobe: int, shortlist: int) -> tuple:
+    '''rough multiply-adds of a full image search and of a full audio ranking of the session'''
+
+    pca_state = session['pca_state']
+    features = pca_state['codes']['codes'] if pca_state.get('codes') is not None else pca_state['pca_features']
+    image_cost = features.shape[0] * features.shape[1]
+
+    store = session['audio_store']
+    windows = audio_store.n_windows(store)
+    width = ar.ATB_BINS + ar.RTB_BINS + ar.FTB_BINS
+    index = session['audio_index']
+    if index is not None:
+        #centroids, the probed lists and the windows of the shortlisted songs
+        nlist = len(index['centroids'])
+        per_song = windows / max(len(store['filenames']), 1)
+        windows = min(windows, nlist + windows * min(nprobe, nlist) / nlist + shortlist * per_song)
+    return image_cost, windows * width
+
+def plan_order(session: dict, nprobe: int, shortlist: int, order: str = 'image') -> str:
+    '''modality a combined query ranks first, 'auto' picks the cheaper one'''
+    if order not in ORDERS:
+        raise ValueError(f"order must be one of {ORDERS}")
+    if order != 'auto':
+        return order
+    image_cost, audio_cost = query_costs(session, nprobe, shortlist)
+    return 'image' if image_cost <= audio_cost else 'audio'
+
+def fuse_scores(combined_results: list, fusion_weight: float) -> list:
+    '''order combined results by fusion_weight * audio score + (1 - fusion_weight) * image score
+
+    The audio similarity is divided by the best one and the image distance
+    turned into 1 - distance / largest distance, both over the given results.'''
+
+    if not combined_results:
+        return combined_results
+    best_similarity = max(entry['audio_similarity'] for entry in combined_results)
+    worst_distance = max(entry['image_distance'] for entry in combined_results)
+    for entry in combined_results:
+        audio_score = entry['audio_similarity'] / best_similarity if best_similarity > 0 else 0.0
+        image_score = 1.0 - entry['image_distance'] / worst_distance if worst_distance > 0 else 1.0
+        entry['fused_score'] = fusion_weight * audio_score + (1 - fusion_weight) * image_score
+    return sorted(combined_results, key=lambda entry: -entry['fused_score'])
+
+def query_image_features(session: dict, query_image_path: str, cache_path: str, image_hash: str) -> np.ndarray:
+    img_size = (120, 120)
+    return query_cache.cached_array(cache_path, 'image', image_hash,
+                                    lambda: cbir.project_query(session['pca_state'], query_image_path, img_size))
+
+def melody_query(midi_file) -> dict:
+    '''window features and intervals of a query melody that only exists in memory (a streamed recording)'''
+    return {'hummed_feature': ar.process_file(midi_file), 'intervals': dtw.file_intervals(midi_file)}
+
+def melody_hash(query_melody: dict) -> str:
+    '''cache key of an in-memory query melody, in place of the hash of its file'''
+    sha1 = hashlib.sha1(hummed_matrix(query_melody['hummed_feature']).tobytes())
+    sha1.update(np.asarray(query_melody['intervals'], dtype=np.int16).tobytes())
+    return sha1.hexdigest()
+
+def query_hummed_feature(query_audio_path: str, cache_path: str, audio_hash: str, query_melody: dict = None) -> list:
+    if query_melody is not None:
+        return query_melody['hummed_feature']
+    with metrics.span('parse_query_midi'):
+        return ar.split_features(query_cache.cached_array(
+            cache_path, 'hummed', audio_hash, lambda: hummed_matrix(ar.process_file(query_audio_path))))
+
+def rank_combined(session: dict, query_image_path: str, query_audio_path: str, nprobe: int, shortlist: int,
+                  image_stages, image_exact: bool, image_rerank: int, image_candidates: int = IMAGE_CANDIDATES,
+                  audio_candidates: int = AUDIO_CANDIDATES, order: str = 'image', fusion_weight: float = None,
+                  cache_path: str = None, image_hash: str = None, audio_hash: str = None,
+                  dtw_shortlist: int = dtw.SHORTLIST, dtw_budget: float = dtw.BUDGET, query_melody: dict = None) -> list:
+    '''results of an image and audio query, the second modality is only scored on the candidates of the first
+
+    Image first: the songs of the image_candidates closest images are the only
+    songs scored. Audio first: the covers of the audio_candidates best mapped
+    songs are the only images compared, and the image_candidates closest of
+    them are kept. Either way a song is a result when its cover is one of the
+    kept images, ordered by audio similarity (after the DTW rerank when the
+    session has melody sequences), or by the fused score when fusion_weight
+    is given (see fuse_scores). The two orders can return different songs,
+    image first is the default, order='auto' trades that for the cheaper plan.'''
+
+    hummed_feature = query_hummed_feature(query_audio_path, cache_path, audio_hash, query_melody)
+    order = plan_order(session, nprobe, shortlist, order)
+    print(f"Combined query planned {order} first")
+
+    if order == 'image':
+        with metrics.span('image_search'):
+            query_features = query_image_features(session, query_image_path, cache_path, image_hash)
+            sorted_filenames, distance_between_query = cbir.search_features(session['pca_state'], query_features, image_candidates,
+                                                                            'euclidean', image_stages, image_exact, image_rerank)
+
+        #only the songs of the kept images can be results, the others are not scored at all
+        audios_of_images = mapper_index.audios_for_pics(session['mapper_index'], sorted_filenames)
+        rows = song_rows(session)
+        songs = np.array(sorted({rows[audio_file] for audios in audios_of_images.values() for audio_file in audios
+                                 if audio_file in rows}), dtype=np.int64)
+        with metrics.span('rank_audio'):
+            ranking = ar.rank_store(hummed_feature, session['audio_store'], songs)
+        ranking = rerank_audio(session, ranking, query_audio_path, dtw_shortlist, dtw_budget, cache_path, audio_hash,
+                               query_melody)
     else:
-        json_image_data = json.dumps([], indent=4)
+        with metrics.span('rank_audio'):
+            ranking = rank_audio(session, hummed_feature, audio_candidates, nprobe, shortlist, mapped_only=True)
+        ranking = rerank_audio(session, ranking, query_audio_path, dtw_shortlist, dtw_budget, cache_path, audio_hash,
+                               query_melody)
+
+        #only the covers of the best songs are compared to the query image
+        rows = image_rows(session)
+        pics = mapper_index.pics_for_audios(session['mapper_index'], ranking.keys()).values()
+        images = sorted({rows[pic_name] for pic_name in pics if pic_name in rows})
+        with metrics.span('image_search'):
+            query_features = query_image_features(session, query_image_path, cache_path, image_hash)
+            sorted_filenames, distance_between_query = cbir.search_rows(session['pca_state'], query_features, images, image_candidates)
+
+    top_images = {str(filename): float(image_distance) for filename, image_distance in zip(sorted_filenames, distance_between_query)}
+    audio_to_image_map = mapper_index.pics_for_audios(session['mapper_index'], ranking.keys())
+
+    # Filter audio results based on top-ranked images
+    combined_results = []
+    for audio_file, similarity in ranking.items():
+        image_name = audio_to_image_map.get(audio_file)
+        if image_name in top_images:
+            combined_results.append({
+                'audio_file': audio_file,
+                'pic_name': image_name,
+                'audio_similarity': similarity,
+                'image_distance': top_images[image_name]  # Include the image distance
+            })
 
-    if os.path.isfile(query_audio_path):
-        isAudio = True
-    else:
-        json_audio_data = json.dumps([], indent=4)
+    if fusion_weight is not None:
+        combined_results = fuse_scores(combined_results, fusion_weight)
 
-    sorted_filenames = []
-    distance_between_query = []
+    return combined_results
 
-    if (isImage):
-        image_dataset, image_filenames = ip.load_preprocessed_images(image_features_path)
+def rank_query(session: dict, query_image_path: str, query_audio_path: str, nprobe: int, shortlist: int, top_k: int,
+               image_stages, image_exact: bool, image_rerank: int, cache_path: str = None,
+               image_hash: str = None, audio_hash: str = None, image_candidates: int = IMAGE_CANDIDATES,
+               audio_candidates: int = AUDIO_CANDIDATES, order: str = 'image', fusion_weight: float = None,
+               dtw_shortlist: int = dtw.SHORTLIST, dtw_budget: float = dtw.BUDGET, query_melody: dict = None) -> list:
+    '''combined results of a query, query_image_path / query_audio_path are None for a missing query
 
-        img_size = (120, 120)
-        sorted_filenames, distance_between_query = CBIR(image_features_path, query_image_path, img_size)
+    With a cache_path the projected query image and the hummed window features
+    are cached under the hash of their query file. A query with both files goes
+    through rank_combined. A query_melody (see melody_query) is the audio query
+    in place of a file.'''
 
-        image_data_array = []
+    isImage = query_image_path is not None
+    isAudio = query_audio_path is not None or query_melody is not None
 
-        for filename, distance in zip(sorted_filenames[:10], distance_between_query[:10]):
-            # Find all audio files that correspond to the image
-            corresponding_audios = [
-                entry['audio_file'] for entry in mapper if entry['pic_name'] == filename
-            ]
+    combined_results = []
+
+    if isAudio and isImage:
+        combined_results = rank_combined(session, query_image_path, query_audio_path, nprobe, shortlist,
+                                         image_stages, image_exact, image_rerank, image_candidates, audio_candidates,
+                                         order, fusion_weight, cache_path, image_hash, audio_hash, dtw_shortlist, dtw_budget,
+                                         query_melody)
 
+    # Process image results if any
+    elif (isImage):
+        #every image has at least one song, top_k images are enough for top_k results
+        n_images = top_k if top_k is not None else image_candidates
+        with metrics.span('image_search'):
+            query_features = query_image_features(session, query_image_path, cache_path, image_hash)
+            sorted_filenames, distance_between_query = cbir.search_features(session['pca_state'], query_features, n_images, 'euclidean',
+                                                                            image_stages, image_exact, image_rerank)
+
+        # Find all audio files that correspond to the images
+        audios_of_images = mapper_index.audios_for_pics(session['mapper_index'], sorted_filenames[:n_images])
+
+        for filename, image_distance in zip(sorted_filenames[:n_images], distance_between_query[:n_images]):
             # Create a separate entry for each corresponding audio file
-            for audio_file in corresponding_audios:
-                image_data_array.append({
-                    "filename": filename,
-                    "distance": distance,
-                    "corresponding_audios": audio_file
+            for audio_file in audios_of_images[str(filename)]:
+                combined_results.append({
+                    'audio_file': audio_file,
+                    'pic_name': filename,
+                    'audio_similarity': None ,
+                    'image_distance': float(image_distance)
                 })
 
-        json_image_data = json.dumps(image_data_array, indent=4)
-        print(json_image_data)
+    # Process audio results if any
+    elif (isAudio):
+        hummed_feature = query_hummed_feature(query_audio_path, cache_path, audio_hash, query_melody)
+
+        with metrics.span('rank_audio'):
+            ranking = rank_audio(session, hummed_feature, top_k, nprobe, shortlist, mapped_only=True)
+        ranking = rerank_audio(session, ranking, query_audio_path, dtw_shortlist, dtw_budget, cache_path, audio_hash,
+                               query_melody)
+
+        combined_results = audio_results(session, ranking)
+
+    if top_k is not None:
+        combined_results = combined_results[:top_k]
+
+    return combined_results
+
+def run_query(session: dict, start_time: float = None, nprobe: int = audio_index.NPROBE,
+              shortlist: int = audio_index.SHORTLIST, top_k: int = TOP_K, page: int = 1, per_page: int = 10,
+              image_stages=distance.STAGES, image_exact: bool = True, image_rerank: int = quantize.RERANK,
+              use_cache: bool = True, image_candidates: int = IMAGE_CANDIDATES, audio_candidates: int = AUDIO_CANDIDATES,
+              order: str = 'image', fusion_weight: float = None, dtw_shortlist: int = dtw.SHORTLIST,
+              dtw_budget: float = dtw.BUDGET, query_melody: dict = None):
+    '''answer the image and/or audio query currently uploaded to the session
+
+    nprobe and shortlist tune the approximate audio index when the session has one
+    (it is only used when top_k is at most shortlist), image_stages and image_exact the prefilter of the image search (see
+    distance.coarse_to_fine_top_k), image_rerank the exact rerank of the
+    compressed image features when the session has them. Only the best top_k
+    results (all of them when None) are kept and written to results.json, the
+    requested page of it is returned. With metrics enabled the stages are
+    recorded to query_metrics.json. With use_cache the results of a query
+    already answered on the same dataset with the same parameters are reused.
+    image_candidates, audio_candidates, order and fusion_weight plan a query
+    with both an image and an audio file (see rank_combined). When the session
+    has melody sequences the dtw_shortlist best songs of the audio ranking are
+    reranked with DTW within dtw_budget seconds, 0 turns the rerank off. A
+    query_melody (see melody_query) is the audio query instead of
+    query/audio/input.mid, nothing is read from or written to that file.'''
+
+    if (top_k is not None and top_k < 1) or page < 1 or per_page < 1:
+        raise ValueError("top_k, page and per_page must be at least 1, top_k None keeps every result")
 
-    else:
-        json_image_data = json.dumps([], indent=4)
+    isImage = False
+    isAudio = False
 
+    #set the timer at start of the program
+    if start_time is None:
+        start_time = time.time()
 
-    if (isAudio):
-        
-        loaded_data = np.load(audio_features_path, allow_pickle=True).item()
+    #the caller owns the recording when it started one, for example to include the session load
+    owner = metrics.start('query')
 
-        hummed_feature = ar.process_file(query_audio_path)
+    dir_path = session['dir_path']
 
-        ranking = ar.rank_best_match(hummed_feature, loaded_data)
-        
-        df = pd.DataFrame(list(ranking.items()), columns=['filename', 'similarity'])
-        
-        json_audio_data = df.to_json(orient='records', indent=4)
+    #transform the query image
+    query_image_path = dir_path + "/query/image/input.png"
+    query_audio_path = dir_path + "/query/audio/input.mid"
 
+    if os.path.isfile(query_image_path):
+        isImage = session['pca_state'] is not None
+
+    if query_melody is not None or os.path.isfile(query_audio_path):
+        isAudio = session['audio_store'] is not None
+
+    #repeated queries against an unchanged session come back from the cache
+    cache_path = query_cache.open_cache(dir_path, query_cache.dataset_version(session)) if use_cache else None
+    image_hash = manifest.file_hash(query_image_path) if isImage and use_cache else None
+    audio_hash = None
+    if isAudio and use_cache:
+        audio_hash = melody_hash(query_melody) if query_melody is not None else manifest.file_hash(query_audio_path)
+    params = {'nprobe': nprobe, 'shortlist': shortlist, 'top_k': top_k, 'image_stages': image_stages,
+              'image_exact': image_exact, 'image_rerank': image_rerank, 'image_candidates': image_candidates,
+              'audio_candidates': audio_candidates, 'order': order, 'fusion_weight': fusion_weight,
+              'dtw_shortlist': dtw_shortlist, 'dtw_budget': dtw_budget}
+    key = query_cache.result_key(image_hash, audio_hash, params)
+
+    combined_results = query_cache.load_results(cache_path, key) if use_cache else None
+    if combined_results is not None:
+        metrics.count('result_cache_hits')
     else:
-        json_audio_data = json.dumps([], indent=4)
-
-    # Create a dictionary from the mapper for fast lookup
-    audio_to_image_map = {entry['audio_file']: entry['pic_name'] for entry in mapper}
-
-    # Combine results with priority for audio
-    combined_results = []
-    added_images = set()  # To avoid duplicates
-
-    # Process audio results if any
-    if (isAudio and not isImage):
-        audio_data = json.loads(json_audio_data)  # Convert JSON string to Python list
-        for entry in audio_data:
-            audio_file = entry['filename']
-            similarity = entry['similarity']
-            if audio_file in audio_to_image_map:
-                image_name = audio_to_image_map[audio_file]
-                combined_results.append({
-                    'audio_file': audio_file,
-                    'pic_name': image_name,
-                    'audio_similarity': similarity,
-                    'image_distance': None  # No associated image
-                })
-                added_images.add(image_name)
-
-    # Process image results if any
-    if (not isAudio and isImage):
-        image_data = json.loads(json_image_data)  # Convert JSON string to Python list
-        for entry in image_data:
-            audio_file = entry['corresponding_audios']
-            image_name = entry['filename']
-            distance = entry['distance']
-            combined_results.append({
-                'audio_file': audio_file,
-                'pic_name': image_name,
-                'audio_similarity': None ,
-                'image_distance': distance
-            })
-
-    if isAudio and isImage:
-        audio_data = json.loads(json_audio_data)  # Convert JSON string to Python list
-        image_data = json.loads(json_image_data)  # Convert JSON string to Python list
-
-        # Extract top image filenames and their distances for filtering
-        top_images = {entry['filename']: entry['distance'] for entry in image_data[:10]}
-
-        # Filter audio results based on top-ranked images
-        for audio_entry in audio_data:
-            audio_file = audio_entry['filename']
-            similarity = audio_entry['similarity']
-            if audio_file in audio_to_image_map:
-                image_name = audio_to_image_map[audio_file]
-                if image_name in top_images:
-                    combined_results.append({
-                        'audio_file': audio_file,
-                        'pic_name': image_name,
-                        'audio_similarity': similarity,
-                        'image_distance': top_images[image_name]  # Include the image distance
-                    })
-                    added_images.add(image_name)
-
-    # Convert the combined results to JSON for output or further use
-    json_combined_results = json.dumps(combined_results, indent=4)
-
-    print(json_combined_results)
-
-    # Write the combined results back to the mapper.json file
-    with open(mapper_path, 'w') as mapper_file:
-        mapper_file.write(json_combined_results)
+        combined_results = rank_query(session, query_image_path if isImage else None,
+                                      query_audio_path if isAudio and query_melody is None else None,
+                                      nprobe, shortlist, top_k, image_stages, image_exact, image_rerank,
+                                      cache_path, image_hash, audio_hash, image_candidates, audio_candidates,
+                                      order, fusion_weight, dtw_shortlist, dtw_budget,
+                                      query_melody if isAudio else None)
+        if use_cache:
+            query_cache.save_results(cache_path, key, combined_results)
+
+    with metrics.span('write_results'):
+        write_results(dir_path, combined_results)
 
     #stop the timer
     end_time = time.time()
@@ -184,5 +454,71 @@ def main():
     with open(time_path, 'w') as file:
         file.write(f"Total estimated time: {total_time}\n")
 
+    if owner:
+        metrics.finish(metrics.metrics_path(dir_path, 'query'))
+
+    first = (page - 1) * per_page
+    return {'total': len(combined_results), 'page': page, 'per_page': per_page,
+            'results': combined_results[first:first + per_page]}
+
+def parse_stages(text: str) -> tuple:
+    '''parse "10:1000,30:200" into the (dims, keep) stages of the image search'''
+    if text.lower() == 'none':
+        return ()
+    return tuple(tuple(int(value) for value in stage.split(':')) for stage in text.split(','))
+
+def parse_top_k(text: str) -> int:
+    '''parse the number of results kept, "all" (None) keeps every result'''
+    if text.lower() == 'all':
+        return None
+    return int(text)
+
+def main():
+    parser = argparse.ArgumentParser(description='Process query image to dataset')
+
+    parser.add_argument('--session', type=str, required=True)
+    parser.add_argument('--nprobe', type=int, default=audio_index.NPROBE, help='clusters of the audio index probed per query')
+    parser.add_argument('--shortlist', type=int, default=audio_index.SHORTLIST, help='songs scored exactly after probing the audio index')
+    parser.add_argument('--top-k', type=parse_top_k, default=TOP_K, help='number of results kept, "all" keeps every result')
+    parser.add_argument('--page', type=int, default=1)
+    parser.add_argument('--per-page', type=int, default=10)
+    parser.add_argument('--image-stages', type=parse_stages, default=distance.STAGES,
+                        help='image prefilter stages as dims:keep,dims:keep, "none" scans at full dimension')
+    parser.add_argument('--approximate', action='store_true', help='only rerank the last image shortlist, skip the exact check')
+    parser.add_argument('--image-rerank', type=int, default=quantize.RERANK, help='images reranked exactly after scanning the compressed image features')
+    parser.add_argument('--metrics', action='store_true', help='write the stage timings and counters of the query to query_metrics.json')
+    parser.add_argument('--no-cache', action='store_true', help='recompute the query even if its results are cached')
+    parser.add_argument('--image-candidates', type=int, default=IMAGE_CANDIDATES, help='images whose songs can be results of an image and audio query')
+    parser.add_argument('--audio-candidates', type=int, default=AUDIO_CANDIDATES, help='songs whose covers are compared when the audio is ranked first')
+    parser.add_argument('--order', type=str, choices=ORDERS, default='image', help='modality an image and audio query ranks first, auto picks the cheaper one')
+    parser.add_argument('--fusion-weight', type=float, default=None,
+                        help='order image and audio results by this weight of the audio score plus the rest of the image score')
+
+    parser.add_argument('--dtw-shortlist', type=int, default=dtw.SHORTLIST, help='best songs of the audio ranking reranked with DTW')
+    parser.add_argument('--dtw-budget', type=float, default=dtw.BUDGET, help='seconds the DTW rerank may take per query, 0 turns it off')
+
+    args = parser.parse_args()
+    if args.top_k is not None and args.top_k < 1:
+        parser.error('--top-k must be at least 1, or "all"')
+    if args.page < 1 or args.per_page < 1:
+        parser.error('--page and --per-page must be at least 1')
+
+    #set the timer at start of the program
+    start_time = time.time()
+
+    if args.metrics:
+        metrics.enable()
+    owner = metrics.start('query')
+
+    with metrics.span('load_session'):
+        session = load_session(session_dir(args.session))
+
+    run_query(session, start_time, args.nprobe, args.shortlist, args.top_k, args.page, args.per_page,
+              args.image_stages, not args.approximate, args.image_rerank, not args.no_cache,
+              args.image_candidates, args.audio_candidates, args.order, args.fusion_weight, args.dtw_shortlist, args.dtw_budget)
+
+    if owner:
+        metrics.finish(metrics.metrics_path(session['dir_path'], 'query'))
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,152 @@
+import io
+import librosa
+import mido
+import numpy as np
+from math import gcd
+from scipy.signal import resample_poly
+from basic_pitch import note_creation
+from basic_pitch.constants import AUDIO_SAMPLE_RATE, AUDIO_N_SAMPLES, FFT_HOP, ANNOTATIONS_FPS
+import audio_retriev as ar
+
+# Streaming transcription of a humming query. The audio arrives in chunks, every
+# basic_pitch model window is run as soon as the audio it covers is complete,
+# so when the recording stops only the last window is left to transcribe.
+# The notes and the MIDI stay in memory, nothing is written to disk.
+#
+# The framing is the one of basic_pitch.inference.run_inference: the audio is
+# padded with half an overlap, cut in AUDIO_N_SAMPLES windows every HOP_SIZE
+# samples and half of the overlapping frames are dropped on both sides of
+# every window output.
+#
+# The same framing transcribes whole WAV files at ingest (file_stream and
+# transcribe_streams), the windows of several files are stacked into one
+# model call instead of one call per window.
+
+N_OVERLAPPING_FRAMES = 30
+OVERLAP_LEN = N_OVERLAPPING_FRAMES * FFT_HOP
+HOP_SIZE = AUDIO_N_SAMPLES - OVERLAP_LEN
+
+# defaults of basic_pitch.inference.predict, used by convert_wav_to_midi
+ONSET_THRESHOLD = 0.5
+FRAME_THRESHOLD = 0.3
+MINIMUM_NOTE_LENGTH = 127.70
+
+OUTPUTS = ('note', 'onset', 'contour')
+
+# model windows stacked in one predict call when whole files are transcribed
+BATCH_WINDOWS = 16
+
+def new_stream(sample_rate: int = AUDIO_SAMPLE_RATE) -> dict:
+    '''state of one streaming query, sample_rate is the rate of the chunks the client sends'''
+    return {
+        'sample_rate': sample_rate,
+        'audio': np.zeros(OVERLAP_LEN // 2, dtype=np.float32),
+        'original_length': 0,
+        'next_window': 0,
+        'outputs': {key: [] for key in OUTPUTS},
+    }
+
+def _resample(samples: np.ndarray, sample_rate: int) -> np.ndarray:
+    if sample_rate == AUDIO_SAMPLE_RATE:
+        return samples
+    divisor = gcd(AUDIO_SAMPLE_RATE, sample_rate)
+    return resample_poly(samples, AUDIO_SAMPLE_RATE // divisor, sample_rate // divisor).astype(np.float32)
+
+def file_stream(wav_path: str) -> dict:
+    '''stream holding the whole audio of a file, loaded like basic_pitch.inference.get_audio_input'''
+    audio, _ = librosa.load(str(wav_path), sr=AUDIO_SAMPLE_RATE, mono=True)
+    stream = new_stream()
+    stream['audio'] = np.concatenate([stream['audio'], audio.astype(np.float32)])
+    stream['original_length'] = len(audio)
+    return stream
+
+def _window(stream: dict, start: int) -> np.ndarray:
+    '''model input of the window starting at start, zero padded past the audio'''
+    window = stream['audio'][start:start + AUDIO_N_SAMPLES]
+    if len(window) < AUDIO_N_SAMPLES:
+        window = np.pad(window, (0, AUDIO_N_SAMPLES - len(window)))
+    return window
+
+def _keep_frames(stream: dict, output: dict, index: int):
+    '''keep the frames window index of a batched model output owns'''
+    n_olap = N_OVERLAPPING_FRAMES // 2
+    for key in OUTPUTS:
+        stream['outputs'][key].append(np.asarray(output[key])[index][n_olap:-n_olap])
+
+def _run_window(stream: dict, start: int):
+    '''run the model on the window starting at start and keep the frames it owns'''
+    output = ar.init_transcription_worker().predict(_window(stream, start).reshape(1, AUDIO_N_SAMPLES, 1))
+    _keep_frames(stream, output, 0)
+
+def transcribe_streams(streams: list, batch_windows: int = BATCH_WINDOWS):
+    '''transcribe the windows left in several streams, batch_windows of them per model call'''
+    pending = [(stream, start) for stream in streams
+               for start in range(stream['next_window'], len(stream['audio']), HOP_SIZE)]
+    model = ar.init_transcription_worker()
+    for first in range(0, len(pending), batch_windows):
+        batch = pending[first:first + batch_windows]
+        output = model.predict(np.stack([_window(stream, start) for stream, start in batch])[:, :, np.newaxis])
+        for index, (stream, _) in enumerate(batch):
+            _keep_frames(stream, output, index)
+    for stream in streams:
+        stream['next_window'] = len(stream['audio'])
+
+def add_audio(stream: dict, samples: np.ndarray) -> int:
+    '''append a chunk of mono samples, returns the number of model windows it completed'''
+
+    samples = _resample(np.asarray(samples, dtype=np.float32), stream['sample_rate'])
+    stream['audio'] = np.concatenate([stream['audio'], samples])
+    stream['original_length'] += len(samples)
+
+    completed = 0
+    while stream['next_window'] + AUDIO_N_SAMPLES <= len(stream['audio']):
+        _run_window(stream, stream['next_window'])
+        stream['next_window'] += HOP_SIZE
+        completed += 1
+    return completed
+
+def finish(stream: dict):
+    '''transcribe the windows that still miss audio, padded like the end of a file'''
+    transcribe_streams([stream])
+
+def model_output(stream: dict) -> dict:
+    '''frames transcribed so far, trimmed to the length of the audio received'''
+    n_frames = int(np.floor(stream['original_length'] * (ANNOTATIONS_FPS / AUDIO_SAMPLE_RATE)))
+    return {key: np.concatenate(stream['outputs'][key])[:n_frames] for key in OUTPUTS}
+
+def stream_notes(stream: dict):
+    '''pretty_midi notes transcribed so far like basic_pitch.inference.predict, None before the first window'''
+
+    if not stream['outputs']['note']:
+        return None
+
+    output = model_output(stream)
+    if len(output['note']) == 0:
+        return None
+
+    min_note_len = int(np.round(MINIMUM_NOTE_LENGTH / 1000 * (AUDIO_SAMPLE_RATE / FFT_HOP)))
+    midi_data, _ = note_creation.model_output_to_notes(
+        output,
+        onset_thresh=ONSET_THRESHOLD,
+        frame_thresh=FRAME_THRESHOLD,
+        min_note_len=min_note_len,
+    )
+    return midi_data
+
+def stream_midi(stream: dict) -> mido.MidiFile:
+    '''in-memory MIDI file of the notes transcribed so far, None before the first window'''
+    midi_data = stream_notes(stream)
+    if midi_data is None:
+        return None
+
+    buffer = io.BytesIO()
+    midi_data.write(buffer)
+    buffer.seek(0)
+    return mido.MidiFile(file=buffer)
+
+def stream_features(stream: dict) -> list:
+    '''window features of the melody transcribed so far, the same as process_file on the MIDI file'''
+    midi_file = stream_midi(stream)
+    if midi_file is None:
+        return []
+    return ar.process_file(midi_file)
@@ -0,0 +1,187 @@
+import numpy as np
+import argparse
+import json
+import os
+import mido
+from PIL import Image, ImageDraw, ImageFilter
+import audio_retriev as ar
+
+# Synthetic sessions for the benchmarks, any number of items.
+#
+# <session>/images/cover_<i>.jpg   grayscale covers, a smooth random background
+#                                  with a few random shapes
+# <session>/audio/song_<i>.mid     melodies derived from the files of
+#                                  test/midi_dataset: transposed, tempo shifted
+#                                  and sometimes spliced with a second file
+# <session>/mapper.json            song_<i>.mid -> cover_<i>.jpg
+# <session>/query/image/input.png  a dataset cover with noise
+# <session>/query/audio/input.mid  an excerpt of a dataset song, transposed
+#
+# Everything depends on the seed only, items that already exist are kept so a
+# larger session can grow from a smaller one.
+
+MIDI_SOURCE_DIR = "test/midi_dataset"
+COVER_SIZE = (256, 256)
+
+def cover_image(rng, size: tuple = COVER_SIZE) -> Image.Image:
+    '''random grayscale cover image'''
+
+    background = (rng.random((6, 6)) * 255).astype(np.uint8)
+    image = Image.fromarray(background, mode='L').resize(size, Image.BICUBIC)
+
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.integers(2, 7)):
+        x0, x1 = np.sort(rng.integers(0, size[0], 2))
+        y0, y1 = np.sort(rng.integers(0, size[1], 2))
+        fill = int(rng.integers(0, 256))
+        if rng.random() < 0.5:
+            draw.ellipse((x0, y0, x1, y1), fill=fill)
+        else:
+            draw.rectangle((x0, y0, x1, y1), fill=fill)
+
+    return image.filter(ImageFilter.GaussianBlur(1))
+
+def load_sources(folder_path: str = MIDI_SOURCE_DIR) -> list:
+    '''(ticks per beat, absolute time events of the melody track) of every MIDI file of the folder'''
+
+    sources = []
+    for filename in sorted(os.listdir(folder_path)):
+        if not filename.endswith('.mid'):
+            continue
+        mid = ar.load_midi(os.path.join(folder_path, filename))
+        track_idx = ar.choose_melody_track(mid)
+        if track_idx is None:
+            continue
+        events = absolute_events(mid.tracks[track_idx])
+        if any(msg.type == 'note_on' for _, msg in events):
+            sources.append((mid.ticks_per_beat, events))
+    return sources
+
+def absolute_events(track) -> list:
+    '''(absolute tick, message) of every message of a track but the end of track'''
+    abs_time = 0
+    events = []
+    for msg in track:
+        abs_time += msg.time
+        if msg.type != 'end_of_track':
+            events.append((abs_time, msg))
+    return events
+
+def to_midi(events: list, ticks_per_beat: int) -> mido.MidiFile:
+    '''single track MIDI file of absolute time events'''
+
+    track = mido.MidiTrack()
+    last = 0
+    for abs_time, msg in sorted(events, key=lambda event: event[0]):
+        track.append(msg.copy(time=abs_time - last))
+        last = abs_time
+    track.append(mido.MetaMessage('end_of_track', time=0))
+
+    mid = mido.MidiFile(ticks_per_beat=ticks_per_beat)
+    mid.tracks.append(track)
+    return mid
+
+def transpose(events: list, semitones: int) -> list:
+    return [(abs_time, msg.copy(note=int(np.clip(msg.note + semitones, 0, 127)))
+             if msg.type in ('note_on', 'note_off') else msg) for abs_time, msg in events]
+
+def stretch(events: list, factor: float) -> list:
+    '''scale the event times, a factor over 1 slows the melody down'''
+    return [(int(round(abs_time * factor)), msg) for abs_time, msg in events]
+
+def splice(first: list, second: list, first_cut: int, second_cut: int) -> list:
+    '''events of first before first_cut followed by the events of second after second_cut'''
+    head = [(abs_time, msg) for abs_time, msg in first if abs_time < first_cut]
+    tail = [(abs_time - second_cut + first_cut, msg) for abs_time, msg in second if abs_time >= second_cut]
+    return head + tail
+
+def derived_melody(sources: list, rng) -> tuple:
+    '''(ticks per beat, events) of a new melody derived from one or two source files'''
+
+    ticks_per_beat, events = sources[rng.integers(len(sources))]
+
+    if len(sources) > 1 and rng.random() < 0.5:
+        other_ticks, other = sources[rng.integers(len(sources))]
+        #bring the second file to the resolution of the first one
+        other = stretch(other, ticks_per_beat / other_ticks)
+        first_cut = int(events[-1][0] * rng.uniform(0.3, 0.7))
+        second_cut = int(other[-1][0] * rng.uniform(0.3, 0.7))
+        events = splice(events, other, first_cut, second_cut)
+
+    events = transpose(events, int(rng.integers(-6, 7)))
+    events = stretch(events, rng.uniform(0.8, 1.25))
+    return ticks_per_beat, events
+
+def excerpt(events: list, ticks_per_beat: int, rng, beats: int = 32) -> list:
+    '''a few bars of a melody starting at a random time, shifted to start at 0'''
+    end = events[-1][0]
+    length = beats * ticks_per_beat
+    start = int(rng.integers(0, max(1, end - length)))
+    clip = [(abs_time - start, msg) for abs_time, msg in events if start <= abs_time < start + length]
+    #a silent stretch would make an empty query, use the whole melody then
+    return clip if any(msg.type == 'note_on' for _, msg in clip) else events
+
+def generate_session(dir_path: str, n_items: int, seed: int = 0, source_dir: str = MIDI_SOURCE_DIR) -> dict:
+    '''write a synthetic session of n_items covers and songs, returns its mapper'''
+
+    images_dir_path = os.path.join(dir_path, "images")
+    audios_dir_path = os.path.join(dir_path, "audio")
+    os.makedirs(images_dir_path, exist_ok=True)
+    os.makedirs(audios_dir_path, exist_ok=True)
+
+    sources = load_sources(source_dir)
+    if not sources:
+        raise ValueError(f"No usable MIDI file in {source_dir}")
+
+    mapper = []
+    created = 0
+    for i in range(n_items):
+        pic_name = f"cover_{i}.jpg"
+        audio_file = f"song_{i}.mid"
+        mapper.append({'audio_file': audio_file, 'pic_name': pic_name})
+
+        #every file has its own generator, existing files are skipped without changing the others
+        image_path = os.path.join(images_dir_path, pic_name)
+        audio_path = os.path.join(audios_dir_path, audio_file)
+        if not os.path.exists(image_path):
+            cover_image(np.random.default_rng([seed, i, 0])).save(image_path, quality=90)
+            created += 1
+        if not os.path.exists(audio_path):
+            ticks_per_beat, events = derived_melody(sources, np.random.default_rng([seed, i, 1]))
+            to_midi(events, ticks_per_beat).save(audio_path)
+
+    with open(os.path.join(dir_path, "mapper.json"), 'w') as mapper_file:
+        json.dump(mapper, mapper_file, indent=4)
+
+    #the query is a noisy cover and a transposed excerpt of the matching song
+    rng = np.random.default_rng([seed, n_items, 2])
+    target = int(rng.integers(n_items))
+
+    os.makedirs(os.path.join(dir_path, "query", "image"), exist_ok=True)
+    os.makedirs(os.path.join(dir_path, "query", "audio"), exist_ok=True)
+
+    cover = np.asarray(Image.open(os.path.join(images_dir_path, f"cover_{target}.jpg")).convert('L'), dtype=np.float64)
+    cover = np.clip(cover + rng.normal(0, 8, cover.shape), 0, 255).astype(np.uint8)
+    Image.fromarray(cover, mode='L').save(os.path.join(dir_path, "query", "image", "input.png"))
+
+    song = ar.load_midi(os.path.join(audios_dir_path, f"song_{target}.mid"))
+    events = transpose(excerpt(absolute_events(song.tracks[0]), song.ticks_per_beat, rng), int(rng.integers(-3, 4)))
+    to_midi(events, song.ticks_per_beat).save(os.path.join(dir_path, "query", "audio", "input.mid"))
+
+    print(f"Synthetic session {dir_path}: {n_items} items, {created} new, query is item {target}")
+    return mapper
+
+def main():
+    parser = argparse.ArgumentParser(description='generate a synthetic session for the benchmarks')
+
+    parser.add_argument('--session', type=str, required=True)
+    parser.add_argument('--size', type=int, required=True, help='number of covers and songs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--source', type=str, default=MIDI_SOURCE_DIR, help='folder of the MIDI files the songs are derived from')
+
+    args = parser.parse_args()
+
+    generate_session("public/temp_uploads/" + args.session, args.size, args.seed, args.source)
+
+if __name__ == "__main__":
+    main()